@@ -1,16 +1,29 @@
 # ================================
 #   IMPORTACIONES NECESARIAS
 # ================================
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context, g, has_request_context
+from jinja2 import FileSystemBytecodeCache
 import psycopg2
 import psycopg2.extras
 from dotenv import load_dotenv
 import os
-from datetime import date, datetime
+from datetime import date, datetime, timezone
 import json
-import bcrypt
+import base64
+import hashlib
 from datetime import timedelta
-from groq import Groq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import unicodedata
+import math
+import re
+import secrets
+import socket
+import weakref
+from contextlib import contextmanager
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, defaultdict, deque
 
 # ================================
 #   CONFIGURACIÓN Y CONEXIÓN
@@ -26,11 +39,32 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY", "super-secret-key-change-this")
 app.permanent_session_lifetime = timedelta(days=7)
 
 
+class CacheBytecodeTemplates(FileSystemBytecodeCache):
+    """Caché de bytecode de Jinja que no falla si el directorio es de solo lectura."""
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            print(f"Error al guardar bytecode del template: {e}")
+
+
+# Templates precompilados: compilar_templates.py llena este directorio al desplegar, así una
+# instancia nueva carga el bytecode en lugar de compilar cada template en su primer uso.
+# Jinja descarta por su cuenta el bytecode de un template cuyo archivo cambió.
+# Sin el directorio, cada proceso compila los templates en memoria como siempre.
+TEMPLATES_CACHE_DIR = os.getenv("TEMPLATES_CACHE_DIR", os.path.join(app.root_path, "templates_cache"))
+if os.path.isdir(TEMPLATES_CACHE_DIR):
+    # Debe configurarse antes del primer uso de app.jinja_env (los filtros de abajo lo crean)
+    app.jinja_options = {**app.jinja_options, "bytecode_cache": CacheBytecodeTemplates(TEMPLATES_CACHE_DIR)}
+
+
 # ================================
 #   FUNCIONES DE HASH DE CONTRASEÑAS
 # ================================
 def hash_password(password):
     """Genera hash de contraseña usando bcrypt y devuelve str (utf-8)."""
+    import bcrypt  # solo lo usan login y registro: no se carga en cada arranque en frío
     salt = bcrypt.gensalt()
     # return str so it's stored consistently in DB (text column)
     return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
@@ -40,6 +74,7 @@ def check_password(password, hashed_password):
     """Verifica contraseña contra hash (acepta stored str o bytes)."""
     if not password or not hashed_password:
         return False
+    import bcrypt
     try:
         # ensure hashed_password is bytes for bcrypt.checkpw
         if isinstance(hashed_password, str):
@@ -81,33 +116,1700 @@ def inject_now():
     return {'now': datetime.now}
 
 
+@app.context_processor
+def inject_url_pagina():
+    def url_pagina(**cambios):
+        """URL del endpoint actual conservando filtros y cambiando orden/cursor/tamaño."""
+        args = request.values.to_dict()
+        args.update(cambios)
+        args = {k: v for k, v in args.items() if v not in (None, '')}
+        return url_for(request.endpoint, **(request.view_args or {}), **args)
+    return {'url_pagina': url_pagina}
+
+
+# Los estáticos se piden con ?v=<huella del contenido>: el navegador los guarda un año y un
+# despliegue que los cambie genera otra URL
+ESTATICOS_MAX_AGE = 365 * 24 * 3600
+_huellas_estaticos = {}
+
+
+def url_estatico(archivo):
+    huella = _huellas_estaticos.get(archivo)
+    if huella is None:
+        with open(os.path.join(app.static_folder, archivo), 'rb') as f:
+            huella = _huellas_estaticos[archivo] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return url_for('static', filename=archivo, v=huella)
+
+
+@app.context_processor
+def inject_url_estatico():
+    return {'url_estatico': url_estatico}
+
+
+@app.after_request
+def cache_estaticos_versionados(response):
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = ESTATICOS_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+# ================================
+#   MÉTRICAS DE RENDIMIENTO (PROMETHEUS)
+# ================================
+# Latencia por endpoint, consultas SQL por request, espera del pool de conexiones, requests en
+# curso (la profundidad de la ingesta es endpoint="registrar_lectura") y llamadas al LLM.
+# Se exponen en /metrics con el formato de texto de Prometheus.
+# Token para el scraper (Authorization: Bearer ...); sin token solo un admin con sesión puede verlas
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Etiqueta de endpoint para las consultas hechas fuera de un request (hilos en segundo plano)
+ENDPOINT_FONDO = "(fondo)"
+
+REGISTRO_METRICAS = []
+
+
+def _valor_prometheus(valor):
+    if valor == math.inf:
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def _etiquetas_prometheus(nombres, valores, extra=()):
+    pares = list(zip(nombres, valores)) + list(extra)
+    if not pares:
+        return ""
+    escapar = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{nombre}="{escapar(valor)}"' for nombre, valor in pares) + "}"
+
+
+class Metrica:
+    """Base de las métricas: nombre, ayuda, nombres de etiquetas y valores por combinación de etiquetas."""
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+        self._valores = {}
+        REGISTRO_METRICAS.append(self)
+
+    def muestras(self):
+        """Pares (sufijo + etiquetas, valor) para exponer."""
+        with self._lock:
+            return [(_etiquetas_prometheus(self.etiquetas, clave), valor) for clave, valor in self._valores.items()]
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        lineas += [f"{self.nombre}{sufijo} {_valor_prometheus(valor)}" for sufijo, valor in self.muestras()]
+        return lineas
+
+
+class Contador(Metrica):
+    tipo = "counter"
+
+    def sumar(self, *etiquetas, valor=1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+
+class Medidor(Metrica):
+    """Valor instantáneo. Con `funcion` se calcula al exponer: devuelve un número o {etiquetas: valor}."""
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+
+    def sumar(self, *etiquetas, valor=1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+    def muestras(self):
+        if self.funcion is None:
+            return super().muestras()
+        try:
+            valores = self.funcion()
+        except Exception as e:
+            print(f"Error al calcular métrica {self.nombre}: {e}")
+            return []
+        if not isinstance(valores, dict):
+            valores = {(): valores}
+        return [(_etiquetas_prometheus(self.etiquetas, clave), valor) for clave, valor in valores.items()]
+
+
+class Histograma(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observar(self, valor, *etiquetas):
+        # [conteo por bucket (no acumulado), suma, total]
+        posicion = bisect_left(self.buckets, valor)
+        with self._lock:
+            datos = self._valores.get(etiquetas)
+            if datos is None:
+                datos = self._valores[etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            datos[0][posicion] += 1
+            datos[1] += valor
+            datos[2] += 1
+
+    def resumen(self, *etiquetas):
+        """(total, suma) de las observaciones con esas etiquetas."""
+        with self._lock:
+            datos = self._valores.get(etiquetas)
+            return (datos[2], datos[1]) if datos else (0, 0.0)
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            valores = [(clave, list(conteos), suma, total) for clave, (conteos, suma, total) in self._valores.items()]
+        for clave, conteos, suma, total in valores:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, conteos):
+                acumulado += conteo
+                etiquetas = _etiquetas_prometheus(self.etiquetas, clave, [("le", _valor_prometheus(limite))])
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            etiquetas = _etiquetas_prometheus(self.etiquetas, clave)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {_valor_prometheus(suma)}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {total}")
+        return lineas
+
+
+def exponer_metricas():
+    lineas = []
+    for metrica in REGISTRO_METRICAS:
+        lineas += metrica.exponer()
+    return "\n".join(lineas) + "\n"
+
+
+metrica_duracion_http = Histograma("vida_http_duracion_segundos", "Duración de los requests por endpoint",
+                                   ("endpoint", "metodo"))
+metrica_respuestas_http = Contador("vida_http_respuestas_total", "Respuestas por endpoint y código HTTP",
+                                   ("endpoint", "metodo", "codigo"))
+metrica_en_curso_http = Medidor("vida_http_en_curso", "Requests en proceso por endpoint", ("endpoint",))
+metrica_duracion_consulta = Histograma("vida_db_consulta_duracion_segundos", "Duración de cada consulta SQL",
+                                       ("endpoint",))
+metrica_consultas_request = Histograma("vida_db_consultas_por_request", "Consultas SQL ejecutadas por request",
+                                       ("endpoint",), BUCKETS_CONSULTAS)
+metrica_db_request = Histograma("vida_db_duracion_por_request_segundos", "Tiempo en consultas SQL por request",
+                                ("endpoint",))
+metrica_espera_pool = Histograma("vida_db_pool_espera_segundos", "Espera para obtener una conexión del pool")
+metrica_pool_agotado = Contador("vida_db_pool_agotado_total", "Pedidos de conexión que vencieron sin conexión libre")
+metrica_duracion_llm = Histograma("vida_llm_duracion_segundos", "Duración de las llamadas al LLM por resultado",
+                                  ("resultado",))
+metrica_primer_fragmento_llm = Histograma("vida_llm_primer_fragmento_segundos",
+                                          "Tiempo hasta el primer fragmento de respuesta del LLM")
+
+
+def endpoint_actual():
+    if has_request_context():
+        return request.endpoint or "(sin_ruta)"
+    return ENDPOINT_FONDO
+
+
+def registrar_consulta(duracion, cursor=None, query=None, params=None, error=None):
+    """Una consulta SQL terminada: histograma por endpoint y acumulado del request en curso."""
+    medicion = g.get("metricas") if has_request_context() else None
+    if medicion is not None:
+        medicion["consultas"] += 1
+        medicion["tiempo_db"] += duracion
+    metrica_duracion_consulta.observar(duracion, endpoint_actual())
+    if query is not None and duracion >= CONSULTA_LENTA_SEGUNDOS:
+        try:
+            consultas_lentas.registrar(duracion, cursor, query, params, error)
+        except Exception as e:
+            print(f"Error al registrar consulta lenta: {e}")
+
+
+@app.before_request
+def iniciar_medicion():
+    g.metricas = {"inicio": time.perf_counter(), "consultas": 0, "tiempo_db": 0.0, "codigo": None}
+    metrica_en_curso_http.sumar(endpoint_actual())
+
+
+@app.after_request
+def registrar_codigo_respuesta(response):
+    if "metricas" in g:
+        g.metricas["codigo"] = response.status_code
+    return response
+
+
+@app.teardown_request
+def registrar_metricas_request(error=None):
+    # En respuestas con stream_with_context corre al terminar de enviar el cuerpo
+    medicion = g.pop("metricas", None)
+    if medicion is None:
+        return
+    endpoint, metodo = endpoint_actual(), request.method
+    metrica_en_curso_http.sumar(endpoint, valor=-1)
+    metrica_duracion_http.observar(time.perf_counter() - medicion["inicio"], endpoint, metodo)
+    metrica_respuestas_http.sumar(endpoint, metodo, str(medicion["codigo"] or 500))
+    metrica_consultas_request.observar(medicion["consultas"], endpoint)
+    metrica_db_request.observar(medicion["tiempo_db"], endpoint)
+
+
+@app.route("/metrics")
+def metricas():
+    autorizacion = request.headers.get("Authorization", "")
+    if METRICAS_TOKEN and secrets.compare_digest(autorizacion, f"Bearer {METRICAS_TOKEN}"):
+        pass
+    elif not (is_logged_in() and session.get("tipo_usuario") == "admin"):
+        return jsonify({"error": "No autorizado"}), 401
+    return Response(exponer_metricas(), mimetype="text/plain; version=0.0.4")
+
+
+# ================================
+#   CONEXIÓN A LA BASE DE DATOS
+# ================================
+# Conexiones abiertas como máximo por proceso y segundos que se espera una libre
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_ESPERA = float(os.getenv("DB_POOL_ESPERA", "10"))
+# Una conexión libre por más segundos que estos se prueba (SELECT 1) antes de prestarla: el servidor
+# pudo cortarla (reinicio, idle_session_timeout, un proxy) y la ruta fallaría con ella
+DB_POOL_VALIDAR_TRAS = float(os.getenv("DB_POOL_VALIDAR_TRAS", "30"))
+
+# Presupuesto de tiempo (segundos) por clase de ruta. Se aplica como statement_timeout de cada
+# consulta, como espera máxima por una conexión del pool y como connect_timeout al abrir una nueva,
+# para que una consulta lenta del dashboard no retenga workers y conexiones que necesita la ingesta.
+PRESUPUESTOS_RUTA = {
+    "ingesta": float(os.getenv("PRESUPUESTO_INGESTA", "2")),
+    "interactiva": float(os.getenv("PRESUPUESTO_INTERACTIVA", "5")),
+    # Descargas y listados completos (ninguna ruta actual; para las que se agreguen)
+    "exportacion": float(os.getenv("PRESUPUESTO_EXPORTACION", "60")),
+    "chatbot": float(os.getenv("PRESUPUESTO_CHATBOT", "10")),
+    # Hilos en segundo plano (detector de pulseras, llamadas al LLM)
+    "fondo": float(os.getenv("PRESUPUESTO_FONDO", "30")),
+}
+# Endpoint -> clase; los que no están son "interactiva"
+CLASE_RUTA = {
+    "registrar_lectura": "ingesta",
+    "chatbot_api": "chatbot",
+    "chatbot_trabajo": "chatbot",
+}
+
+
+def clase_ruta_actual():
+    if has_request_context():
+        return CLASE_RUTA.get(request.endpoint, "interactiva")
+    return "fondo"
+
+
+class _CursorMedido:
+    """Se combina con cualquier clase de cursor para medir cada execute / executemany."""
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            resultado = super().execute(query, vars)
+        except Exception as e:
+            registrar_consulta(time.perf_counter() - inicio, self, query, vars, e)
+            raise
+        registrar_consulta(time.perf_counter() - inicio, self, query, vars)
+        return resultado
+
+    def executemany(self, query, vars_list):
+        # Los parámetros pueden ser un generador ya consumido: no se registran
+        inicio = time.perf_counter()
+        try:
+            resultado = super().executemany(query, vars_list)
+        except Exception as e:
+            registrar_consulta(time.perf_counter() - inicio, self, query, None, e)
+            raise
+        registrar_consulta(time.perf_counter() - inicio, self, query)
+        return resultado
+
+
+_clases_cursor_medido = {}
+
+
+def clase_cursor_medido(clase):
+    medida = _clases_cursor_medido.get(clase)
+    if medida is None:
+        medida = _clases_cursor_medido[clase] = type(f"{clase.__name__}Medido", (_CursorMedido, clase), {})
+    return medida
+
+
+class ConexionPool(psycopg2.extensions.connection):
+    """Conexión del pool: sus cursores miden cada consulta y close() la devuelve al pool."""
+    _pool = None
+    _prestada = False
+    _finalizador = None
+    _statement_timeout = None   # milisegundos fijados en la sesión
+    _devuelta_en = 0.0          # time.monotonic() de la última devolución al pool
+
+    def cursor(self, *args, **kwargs):
+        clase = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = clase_cursor_medido(clase)
+        return super().cursor(*args, **kwargs)
+
+    def close(self):
+        if self._pool is None:
+            super().close()
+        elif self._prestada:
+            # Un segundo close() no debe cerrar una conexión que ya volvió al pool
+            self._prestada = False
+            self._pool.devolver(self)
+
+
+class PoolAgotado(Exception):
+    """No se liberó ninguna conexión dentro del tiempo de espera."""
+
+
+class PoolConexiones:
+    """
+    Pool de conexiones con espera acotada. get_connection() toma una conexión libre (o abre una
+    nueva mientras no se llegue al máximo) y conn.close() la devuelve, así que las rutas no cambian.
+    Una conexión que se pierde sin close() libera su cupo cuando el recolector la elimina.
+    """
+
+    def __init__(self, dsn, maximo, espera):
+        self.dsn = dsn
+        self.maximo = maximo
+        self.espera = espera
+        self._cond = threading.Condition()
+        self._libres = []
+        self._abiertas = 0
+
+    def obtener(self, espera=None, statement_timeout=None):
+        """
+        Conexión libre del pool. `espera`: segundos máximos esperando una (por defecto los del
+        pool; también es el connect_timeout si hay que abrir otra). `statement_timeout`: segundos
+        por consulta, fijado en la sesión solo si cambia respecto del uso anterior.
+        """
+        espera = self.espera if espera is None else espera
+        inicio = time.perf_counter()
+        while True:
+            with self._cond:
+                while not self._libres and self._abiertas >= self.maximo:
+                    restante = inicio + espera - time.perf_counter()
+                    if restante <= 0:
+                        metrica_pool_agotado.sumar()
+                        raise PoolAgotado(f"Sin conexiones libres después de {espera:g}s (máximo {self.maximo})")
+                    self._cond.wait(restante)
+                conn = self._libres.pop() if self._libres else None
+                if conn is None:
+                    self._abiertas += 1
+            if conn is None or self._sigue_abierta(conn):
+                break
+            # Cortada por el servidor: se descarta y se toma otra (o se abre una nueva)
+            self.descartar(conn)
+        if conn is None:
+            try:
+                # connect_timeout de libpq: segundos enteros, mínimo efectivo 2
+                conn = psycopg2.connect(self.dsn, connection_factory=ConexionPool,
+                                        connect_timeout=max(2, math.ceil(espera)))
+            except Exception:
+                self._liberar_cupo()
+                raise
+            conn._pool = self
+            conn._finalizador = weakref.finalize(conn, self._perdida)
+            conn._finalizador.atexit = False
+        metrica_espera_pool.observar(time.perf_counter() - inicio)
+        if statement_timeout is not None:
+            try:
+                self._fijar_statement_timeout(conn, int(statement_timeout * 1000))
+            except Exception:
+                self.descartar(conn)
+                raise
+        conn._prestada = True
+        return conn
+
+    @staticmethod
+    def _sigue_abierta(conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn._devuelta_en < DB_POOL_VALIDAR_TRAS:
+            return True
+        try:
+            cur = psycopg2.extensions.cursor(conn)
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            print(f"Error en pool de conexiones: conexión inactiva cortada por el servidor, se reemplaza: {e}")
+            return False
+
+    @staticmethod
+    def _fijar_statement_timeout(conn, milisegundos):
+        if conn._statement_timeout == milisegundos:
+            return
+        # SET de sesión fuera de una transacción: un rollback posterior no lo deshace
+        conn.autocommit = True
+        try:
+            cur = psycopg2.extensions.cursor(conn)
+            cur.execute("SET statement_timeout = %s;", (milisegundos,))
+            cur.close()
+        finally:
+            conn.autocommit = False
+        conn._statement_timeout = milisegundos
+
+    def devolver(self, conn):
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError("conexión cerrada")
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except Exception:
+            self.descartar(conn)
+            return
+        conn._devuelta_en = time.monotonic()
+        with self._cond:
+            self._libres.append(conn)
+            self._cond.notify()
+
+    def descartar(self, conn):
+        conn._finalizador.detach()
+        try:
+            psycopg2.extensions.connection.close(conn)
+        except Exception:
+            pass
+        self._liberar_cupo()
+
+    def _liberar_cupo(self):
+        with self._cond:
+            self._abiertas -= 1
+            self._cond.notify()
+
+    def _perdida(self):
+        print("Error en pool de conexiones: una conexión no se devolvió con close(); se libera su cupo")
+        self._liberar_cupo()
+
+    def estadisticas(self):
+        with self._cond:
+            return {"libres": len(self._libres), "en_uso": self._abiertas - len(self._libres), "maximo": self.maximo}
+
+
+_pool_conexiones = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool():
+    """Pool del proceso, creado con la primera conexión."""
+    global _pool_conexiones
+    if _pool_conexiones is None:
+        with _pool_lock:
+            if _pool_conexiones is None:
+                _pool_conexiones = PoolConexiones(DB_URL, DB_POOL_MAX, DB_POOL_ESPERA)
+    return _pool_conexiones
+
+
+def get_connection():
+    """Conexión del pool con el presupuesto de tiempo de la ruta en curso."""
+    presupuesto = PRESUPUESTOS_RUTA[clase_ruta_actual()]
+    return obtener_pool().obtener(espera=min(DB_POOL_ESPERA, presupuesto), statement_timeout=presupuesto)
+
+
+@contextmanager
+def cursor_de(cur=None):
+    """
+    `cur` si se recibe o el cursor de una conexión nueva del pool, que se devuelve al salir.
+    Los helpers que pueden llamarse con una conexión ya tomada reciben su cursor: pedir otra al pool
+    mientras se retiene una agota el pool con muchas rutas a la vez (cada una espera a las demás).
+    """
+    if cur is not None:
+        yield cur
+        return
+    conn = get_connection()
+    propio = conn.cursor()
+    try:
+        yield propio
+    finally:
+        propio.close()
+        conn.close()
+
+
+def _metrica_pool():
+    if _pool_conexiones is None:
+        return {}
+    estado = _pool_conexiones.estadisticas()
+    return {("libres",): estado["libres"], ("en_uso",): estado["en_uso"]}
+
+
+metrica_conexiones_pool = Medidor("vida_db_pool_conexiones", "Conexiones del pool por estado", ("estado",),
+                                  funcion=_metrica_pool)
+
+
+def is_logged_in():
+    return session.get("logged_in") is True
+
+
+# Helper: obtener id_paciente asignado a un familiar
+def get_assigned_patient_id(username, cur=None):
+    try:
+        with cursor_de(cur) as consulta:
+            consulta.execute("SELECT id_paciente_asignado FROM usuarios WHERE username = %s;", (username,))
+            row = consulta.fetchone()
+        if row:
+            return row[0]
+    except Exception:
+        pass
+    return None
+
+
+# ================================
+#   REGISTRO DE CONSULTAS LENTAS
+# ================================
+# Consultas que superan el umbral: SQL normalizado, tipos de los parámetros (nunca sus valores),
+# endpoint y plan. El plan (EXPLAIN sin ANALYZE) se captura como muestra: como máximo una vez
+# por consulta normalizada cada CONSULTA_LENTA_PLAN_INTERVALO segundos.
+CONSULTA_LENTA_SEGUNDOS = float(os.getenv("CONSULTA_LENTA_MS", "500")) / 1000
+CONSULTA_LENTA_PLAN_INTERVALO = float(os.getenv("CONSULTA_LENTA_PLAN_INTERVALO", "300"))
+CONSULTAS_LENTAS_MAX = int(os.getenv("CONSULTAS_LENTAS_MAX", "200"))
+
+# Literales de texto y números (execute_values envía el SQL ya con los valores incrustados)
+PATRON_LITERAL_SQL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Valores de parámetros en los planes: textos y números comparados (no los costos "cost=0.00..")
+PATRON_VALOR_PLAN = re.compile(r"'(?:[^']|'')*'|(?<=\s(?:=|<|>) )-?\d+(?:\.\d+)?|(?<=\s(?:<>|<=|>=) )-?\d+(?:\.\d+)?")
+PATRON_SQL_EXPLICABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|VALUES)\b", re.IGNORECASE)
+
+metrica_consultas_lentas = Contador("vida_db_consultas_lentas_total",
+                                    f"Consultas que tardaron {CONSULTA_LENTA_SEGUNDOS:g}s o más", ("endpoint",))
+
+
+def normalizar_sql(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return PATRON_LITERAL_SQL.sub("?", " ".join(str(query).split()))
+
+
+def _tipo_parametro(valor):
+    if valor is None:
+        return "NULL"
+    if isinstance(valor, (list, tuple)):
+        return f"<{type(valor).__name__}[{len(valor)}]>"
+    if isinstance(valor, str):
+        return f"<str:{len(valor)}>"
+    return f"<{type(valor).__name__}>"
+
+
+def redactar_parametros(params):
+    """Parámetros sin datos de pacientes: solo tipo (y largo de textos y listas)."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {nombre: _tipo_parametro(valor) for nombre, valor in params.items()}
+    return [_tipo_parametro(valor) for valor in params]
+
+
+def capturar_plan(cursor, query, params):
+    """EXPLAIN de la consulta en la misma conexión, sin alterar la transacción en curso."""
+    if not PATRON_SQL_EXPLICABLE.match(query.decode("utf-8", "replace") if isinstance(query, bytes) else query):
+        return None
+    conn = cursor.connection
+    en_transaccion = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    # Cursor común: no se mide ni pisa los resultados del cursor original
+    cur = psycopg2.extensions.cursor(conn)
+    try:
+        if en_transaccion:
+            cur.execute("SAVEPOINT plan_consulta_lenta;")
+        explicar = b"EXPLAIN " if isinstance(query, bytes) else "EXPLAIN "
+        cur.execute(explicar + query, params)
+        plan = PATRON_VALOR_PLAN.sub("?", "\n".join(fila[0] for fila in cur.fetchall()))
+        if en_transaccion:
+            cur.execute("RELEASE SAVEPOINT plan_consulta_lenta;")
+        return plan
+    except Exception as e:
+        if en_transaccion:
+            try:
+                cur.execute("ROLLBACK TO SAVEPOINT plan_consulta_lenta;")
+            except Exception:
+                pass
+        return f"(no se pudo obtener el plan: {e})"
+    finally:
+        cur.close()
+
+
+class RegistroConsultasLentas:
+    """Últimas consultas lentas en un buffer circular, para la página de administración."""
+
+    def __init__(self, max_entradas, intervalo_plan):
+        self.intervalo_plan = intervalo_plan
+        self._lock = threading.Lock()
+        self._entradas = deque(maxlen=max_entradas)
+        self._ultimo_plan = {}   # huella -> time.monotonic() del último EXPLAIN
+        self.total = 0
+
+    def registrar(self, duracion, cursor, query, params, error=None):
+        endpoint = endpoint_actual()
+        metrica_consultas_lentas.sumar(endpoint)
+        sql = normalizar_sql(query)
+        huella = hashlib.sha1(sql.encode("utf-8")).hexdigest()[:12]
+
+        plan = None
+        ahora = time.monotonic()
+        with self._lock:
+            tomar_plan = error is None and ahora - self._ultimo_plan.get(huella, -math.inf) >= self.intervalo_plan
+            if tomar_plan:
+                self._ultimo_plan[huella] = ahora
+        if tomar_plan and cursor is not None:
+            plan = capturar_plan(cursor, query, params)
+
+        with self._lock:
+            self.total += 1
+            self._entradas.append({
+                "momento": datetime.now(timezone.utc),
+                "duracion_ms": round(duracion * 1000, 1),
+                "endpoint": endpoint,
+                "huella": huella,
+                "sql": sql,
+                "parametros": redactar_parametros(params),
+                "error": str(error) if error is not None else None,
+                "plan": plan,
+            })
+            # Olvidar huellas viejas para que el diccionario no crezca sin límite
+            if len(self._ultimo_plan) > 10 * self._entradas.maxlen:
+                vigentes = {e["huella"] for e in self._entradas}
+                self._ultimo_plan = {h: t for h, t in self._ultimo_plan.items() if h in vigentes}
+        print(f"Consulta lenta ({duracion * 1000:.0f} ms) en {endpoint}: {sql[:200]}")
+
+    def entradas(self):
+        """Más recientes primero."""
+        with self._lock:
+            return list(reversed(self._entradas))
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._ultimo_plan.clear()
+
+
+consultas_lentas = RegistroConsultasLentas(CONSULTAS_LENTAS_MAX, CONSULTA_LENTA_PLAN_INTERVALO)
+
+
+@app.route("/admin/consultas-lentas", methods=["GET", "POST"])
+def ver_consultas_lentas():
+    """Últimas consultas lentas con su plan (solo administradores). POST vacía el registro."""
+    if not is_logged_in():
+        return redirect(url_for("home"))
+    if session.get("tipo_usuario") != "admin":
+        return render_template("consultas_lentas.html", error="Solo los administradores pueden ver esta página",
+                               entradas=[], total=0, umbral_ms=0, maximo=0), 403
+
+    if request.method == "POST":
+        consultas_lentas.limpiar()
+        return redirect(url_for("ver_consultas_lentas"))
+
+    return render_template("consultas_lentas.html",
+                           entradas=consultas_lentas.entradas(),
+                           total=consultas_lentas.total,
+                           umbral_ms=CONSULTA_LENTA_SEGUNDOS * 1000,
+                           maximo=CONSULTAS_LENTAS_MAX)
+
+
+# ================================
+#   CACHÉ EN MEMORIA (LRU + TTL)
+# ================================
+class CacheTTL:
+    """
+    Caché LRU por proceso con vencimiento por entrada y contadores de aciertos.
+
+    `obtener_o_calcular` serializa el cálculo por clave, de modo que varias peticiones
+    simultáneas con la misma clave ejecutan las consultas una sola vez.
+    """
+
+    def __init__(self, nombre, max_entradas, ttl):
+        self.nombre = nombre
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (vence_en, valor)
+        self._lock = threading.Lock()
+        self._locks_calculo = {}
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def obtener(self, clave, defecto=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[0] <= time.monotonic():
+                if entrada is not None:
+                    del self._datos[clave]
+                self.fallos += 1
+                return defecto
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1]
+
+    def guardar(self, clave, valor, ttl=None):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + (self.ttl if ttl is None else ttl), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.expulsiones += 1
+
+    def invalidar(self, clave=None):
+        """Elimina una clave, o todo el contenido si no se indica ninguna."""
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def invalidar_si(self, predicado):
+        """Elimina las entradas cuya clave cumple `predicado(clave)`."""
+        with self._lock:
+            for clave in [c for c in self._datos if predicado(c)]:
+                del self._datos[clave]
+
+    def obtener_o_calcular(self, clave, calcular):
+        faltante = object()
+        valor = self.obtener(clave, faltante)
+        if valor is not faltante:
+            return valor
+        with self._lock:
+            lock_clave = self._locks_calculo.setdefault(clave, threading.Lock())
+        with lock_clave:
+            # Otro hilo pudo haberlo calculado mientras esperábamos
+            with self._lock:
+                entrada = self._datos.get(clave)
+                if entrada is not None and entrada[0] > time.monotonic():
+                    return entrada[1]
+            valor = calcular()
+            self.guardar(clave, valor)
+        with self._lock:
+            self._locks_calculo.pop(clave, None)
+        return valor
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "tasa_aciertos": round(self.aciertos / total, 3) if total else 0.0,
+            }
+
+
+# ---- Respaldo degradado ----
+# Último resultado bueno de las pantallas de monitoreo (dashboard, semáforo, lista de pacientes).
+# Si la base no responde dentro del presupuesto de la ruta se muestran esos datos con un aviso,
+# en lugar de una pantalla vacía o un error.
+RESPALDO_DEGRADADO_TTL = float(os.getenv("RESPALDO_DEGRADADO_TTL", "900"))
+cache_respaldo = CacheTTL("respaldo_degradado", max_entradas=500, ttl=RESPALDO_DEGRADADO_TTL)
+metrica_respuestas_degradadas = Contador("vida_respuestas_degradadas_total",
+                                         "Respuestas con datos en caché por exceder el presupuesto de la ruta",
+                                         ("endpoint",))
+
+
+def presupuesto_excedido(error):
+    """El error es por tiempo: statement_timeout, sin conexión libre del pool o connect_timeout."""
+    if isinstance(error, (psycopg2.extensions.QueryCanceledError, PoolAgotado)):
+        return True
+    return isinstance(error, psycopg2.OperationalError) and "timeout expired" in str(error)
+
+
+def obtener_respaldo(clave):
+    respaldo = cache_respaldo.obtener(clave)
+    if respaldo is not None:
+        metrica_respuestas_degradadas.sumar(endpoint_actual())
+    return respaldo
+
+
+# ---- Paciente asignado de familiares ----
+# No se guarda en la sesión (dura 7 días): un cambio de asignación tiene que valer sin volver a
+# iniciar sesión. Se cachea por usuario unos segundos para no consultar la BD en cada tecla de la
+# búsqueda; cada proceso ve el cambio a más tardar al vencer la entrada.
+ASIGNACION_FAMILIAR_TTL = float(os.getenv("ASIGNACION_FAMILIAR_TTL", "30"))
+cache_asignaciones = CacheTTL("asignaciones_familiares", max_entradas=2000, ttl=ASIGNACION_FAMILIAR_TTL)
+
+
+def paciente_asignado_actual(cur=None):
+    """Paciente asignado del familiar en sesión (None si no tiene)."""
+    username = session.get("username")
+    faltante = object()
+    asignado = cache_asignaciones.obtener(username, faltante)
+    if asignado is faltante:
+        asignado = get_assigned_patient_id(username, cur)
+        cache_asignaciones.guardar(username, asignado)
+    return asignado
+
+
+def invalidar_asignacion(username=None):
+    """Tras cambiar la asignación de un familiar (o de todos, sin username)."""
+    cache_asignaciones.invalidar(username)
+
+
+# ================================
+#   ÍNDICE DE BÚSQUEDA DE PACIENTES (TRIGRAMAS)
+# ================================
+# El índice se recarga cuando cambia el contador de `pacientes` en versiones_datos (cualquier alta,
+# edición o baja, de este worker, de otro o de un script). Además, como respaldo si la versión no
+# se puede leer, a los segundos que indica este TTL
+INDICE_PACIENTES_TTL = int(os.getenv("INDICE_PACIENTES_TTL", "300"))
+# Máximo de resultados devueltos por una búsqueda por nombre
+LIMITE_RESULTADOS_BUSQUEDA = int(os.getenv("LIMITE_RESULTADOS_BUSQUEDA", "100"))
+# Fracción mínima de trigramas del término que deben aparecer en el nombre
+SIMILITUD_MINIMA_BUSQUEDA = 0.5
+
+
+def normalizar_texto(texto):
+    """Minúsculas, sin acentos y con espacios colapsados ("  Gómez " -> "gomez")."""
+    if not texto:
+        return ""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    sin_acentos = "".join(c for c in descompuesto if not unicodedata.combining(c))
+    return " ".join(sin_acentos.lower().split())
+
+
+def trigramas(texto_normalizado):
+    """Trigramas por palabra al estilo pg_trgm (cada palabra con dos espacios al inicio y uno al final)."""
+    resultado = set()
+    for palabra in texto_normalizado.split():
+        relleno = f"  {palabra} "
+        for i in range(len(relleno) - 2):
+            resultado.add(relleno[i:i + 3])
+    return resultado
+
+
+class IndicePacientes:
+    """Índice invertido de trigramas sobre los nombres completos de los pacientes.
+
+    Se construye una vez desde la tabla `pacientes` y se mantiene en memoria, de modo que
+    una búsqueda no recorre la tabla ni ejecuta el LATERAL de lecturas para cada paciente.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recarga = threading.Lock()    # una sola recarga desde la BD a la vez
+        self._nombres = {}                  # id_paciente -> nombre completo normalizado
+        self._mostrar = {}                  # id_paciente -> nombre completo tal como se muestra
+        self._trigramas = defaultdict(set)  # trigrama -> {id_paciente}
+        self._prefijos = []                 # [(sufijo del nombre desde cada palabra, id_paciente)] ordenado
+        self._cargado_en = 0.0
+        self._version = None                # versión de `pacientes` con la que se cargó
+
+    @staticmethod
+    def _claves_prefijo(normalizado):
+        """'juan gomez perez' -> ['juan gomez perez', 'gomez perez', 'perez']."""
+        palabras = normalizado.split()
+        return [" ".join(palabras[i:]) for i in range(len(palabras))]
+
+    def _agregar_sin_lock(self, id_paciente, nombre, apellido_paterno, apellido_materno, ordenar=True):
+        anterior = self._nombres.get(id_paciente)
+        if anterior is not None:
+            for t in trigramas(anterior):
+                self._trigramas[t].discard(id_paciente)
+            for clave in self._claves_prefijo(anterior):
+                i = bisect_left(self._prefijos, (clave, id_paciente))
+                if i < len(self._prefijos) and self._prefijos[i] == (clave, id_paciente):
+                    del self._prefijos[i]
+        mostrar = " ".join(p for p in (nombre, apellido_paterno, apellido_materno) if p)
+        normalizado = normalizar_texto(mostrar)
+        self._nombres[id_paciente] = normalizado
+        self._mostrar[id_paciente] = mostrar
+        for t in trigramas(normalizado):
+            self._trigramas[t].add(id_paciente)
+        for clave in self._claves_prefijo(normalizado):
+            if ordenar:
+                insort(self._prefijos, (clave, id_paciente))
+            else:
+                self._prefijos.append((clave, id_paciente))
+
+    def reconstruir(self, filas, version=None):
+        """
+        Reemplaza el contenido del índice con filas (id, nombre, apellido_paterno, apellido_materno).
+        Se arma aparte y se intercambia de una vez: total() y nombre() leen sin lock y nunca ven
+        un índice a medio cargar.
+        """
+        nuevo = IndicePacientes()
+        for fila in filas:
+            nuevo._agregar_sin_lock(*fila, ordenar=False)
+        nuevo._prefijos.sort()
+        with self._lock:
+            self._nombres, self._mostrar = nuevo._nombres, nuevo._mostrar
+            self._trigramas, self._prefijos = nuevo._trigramas, nuevo._prefijos
+            self._cargado_en = time.monotonic()
+            self._version = version
+
+    def agregar(self, id_paciente, nombre, apellido_paterno, apellido_materno):
+        with self._lock:
+            self._agregar_sin_lock(id_paciente, nombre, apellido_paterno, apellido_materno)
+
+    def total(self):
+        return len(self._nombres)
+
+    def nombre(self, id_paciente):
+        return self._mostrar.get(id_paciente)
+
+    def es_palabra_de_nombre(self, palabra):
+        """True si `palabra` (normalizada) es una palabra completa de algún nombre."""
+        with self._lock:
+            # 'perez' y 'perez ...' quedan antes que 'perezoso' en el orden de las claves
+            i = bisect_left(self._prefijos, (palabra,))
+            if i == len(self._prefijos):
+                return False
+            clave = self._prefijos[i][0]
+            return clave == palabra or clave.startswith(palabra + " ")
+
+    def vigente(self, version=None):
+        """Cargado hace menos de INDICE_PACIENTES_TTL y, si se conoce `version`, con esa versión de pacientes."""
+        if version is not None and version != self._version:
+            return False
+        return self._cargado_en > 0 and time.monotonic() - self._cargado_en < INDICE_PACIENTES_TTL
+
+    def buscar(self, termino, limite=LIMITE_RESULTADOS_BUSQUEDA):
+        """Devuelve [(id_paciente, puntaje)] ordenado de mejor a peor coincidencia.
+
+        El puntaje es la fracción de trigramas del término presentes en el nombre
+        (similar a `word_similarity` de pg_trgm), con bonificación si el término aparece
+        literalmente o como inicio de una palabra.
+        """
+        consulta = normalizar_texto(termino)
+        if not consulta:
+            return []
+        trigramas_consulta = trigramas(consulta)
+
+        with self._lock:
+            coincidencias = Counter()
+            for t in trigramas_consulta:
+                for id_paciente in self._trigramas.get(t, ()):
+                    coincidencias[id_paciente] += 1
+
+            resultados = []
+            for id_paciente, n in coincidencias.items():
+                puntaje = n / len(trigramas_consulta)
+                if puntaje < SIMILITUD_MINIMA_BUSQUEDA:
+                    continue
+                nombre = self._nombres[id_paciente]
+                if consulta in nombre:
+                    puntaje += 1.0
+                    if nombre.startswith(consulta) or f" {consulta}" in nombre:
+                        puntaje += 0.5
+                resultados.append((id_paciente, puntaje, nombre))
+
+        resultados.sort(key=lambda r: (-r[1], r[2], r[0]))
+        return [(id_paciente, puntaje) for id_paciente, puntaje, _ in resultados[:limite]]
+
+    def sugerir(self, prefijo, limite=8, solo_ids=None):
+        """Autocompletado: pacientes cuyo nombre, o alguna palabra de él, empieza por `prefijo`.
+
+        Búsqueda binaria sobre la lista ordenada de claves; primero las coincidencias con el
+        inicio del nombre completo y luego por orden alfabético. `solo_ids` restringe el
+        resultado (p. ej. al paciente asignado de un familiar).
+        """
+        consulta = normalizar_texto(prefijo)
+        if not consulta:
+            return []
+        with self._lock:
+            inicio_nombre, resto, vistos = [], [], set()
+            i = bisect_left(self._prefijos, (consulta,))
+            while i < len(self._prefijos) and self._prefijos[i][0].startswith(consulta):
+                clave, id_paciente = self._prefijos[i]
+                i += 1
+                if id_paciente in vistos or (solo_ids is not None and id_paciente not in solo_ids):
+                    continue
+                vistos.add(id_paciente)
+                if clave == self._nombres[id_paciente]:
+                    inicio_nombre.append(id_paciente)
+                else:
+                    resto.append(id_paciente)
+                # Las de inicio de nombre siempre caben; no hace falta seguir si ya hay suficientes
+                if len(inicio_nombre) >= limite:
+                    break
+            ids = (inicio_nombre + resto)[:limite]
+            return [{"id_paciente": id_paciente, "nombre": self._mostrar[id_paciente]} for id_paciente in ids]
+
+
+indice_pacientes = IndicePacientes()
+
+
+def obtener_indice_pacientes(cur=None):
+    """
+    Devuelve el índice de pacientes, recargándolo desde la BD si cambió la tabla o expiró. Recarga
+    un solo hilo; mientras tanto los demás usan el índice vencido (solo esperan si nunca se cargó).
+    """
+    version = version_tabla("pacientes", cur)
+    if indice_pacientes.vigente(version):
+        return indice_pacientes
+    cargado = indice_pacientes._cargado_en > 0
+    if not indice_pacientes._recarga.acquire(blocking=not cargado):
+        return indice_pacientes
+    try:
+        if not indice_pacientes.vigente(version):
+            with cursor_de(cur) as consulta:
+                consulta.execute("SELECT id_paciente, nombre, apellido_paterno, apellido_materno FROM pacientes;")
+                filas = consulta.fetchall()
+            indice_pacientes.reconstruir(filas, version)
+    finally:
+        indice_pacientes._recarga.release()
+    return indice_pacientes
+
+
+# ================================
+#   UMBRALES DE SIGNOS VITALES
+# ================================
+# Los rangos del semáforo están en la tabla `umbrales_vitales`: una fila por signo con id_paciente
+# NULL (valores generales) y, opcionalmente, filas por paciente que los reemplazan (p. ej. un
+# residente con bradicardia crónica). En Python se compilan en un ClasificadorVitales que queda en
+# caché y que usan el registro de lecturas, las vistas, el motor de alertas y el chatbot:
+# clasificar una lectura es una búsqueda en un dict. Las consultas SQL (ordenar, filtrar y contar
+# por estado) leen la tabla directamente con sql_join_umbrales(): fila del paciente o, si no hay,
+# la general (COALESCE), así la consulta no crece con la cantidad de excepciones.
+# Modificar umbrales por /api/umbrales invalida el caché de este proceso; los demás procesos ven
+# el cambio al vencer UMBRALES_TTL.
+UMBRALES_TTL = int(os.getenv("UMBRALES_TTL", "60"))
+
+# signo -> (crítico si <, estable desde, estable hasta, crítico si >). Valores generales mientras no
+# haya una fila general en la tabla, y los que se usan si la tabla no se puede leer.
+UMBRALES_DEFECTO = {
+    "temperatura": (35.0, 36.0, 37.5, 39.5),
+    "ritmo": (40.0, 60.0, 100.0, 130.0),
+}
+CAMPOS_UMBRAL = ("critico_min", "estable_min", "estable_max", "critico_max")
+
+TEXTO_ESTADO = {"rojo": "Crítico", "verde": "Estable", "azul": "Advertencia"}
+# Estado como número para ordenar en SQL: 0 = rojo (crítico), 1 = azul (advertencia), 2 = verde (estable)
+CODIGO_ESTADO = {"rojo": 0, "azul": 1, "verde": 2}
+
+
+def sql_join_umbrales(paciente="pu.id_paciente"):
+    """
+    LEFT JOINs a umbrales_vitales con la fila general y la del paciente (columna `paciente`) de
+    cada signo. El índice único (COALESCE(id_paciente, 0), signo) asegura a lo sumo una fila por
+    join, así que no multiplican filas. Las columnas las combina sql_estado().
+    """
+    return "".join(
+        f" LEFT JOIN umbrales_vitales {alias}g ON {alias}g.id_paciente IS NULL AND {alias}g.signo = '{signo}'"
+        f" LEFT JOIN umbrales_vitales {alias}p ON {alias}p.id_paciente = {paciente} AND {alias}p.signo = '{signo}'"
+        for signo, alias in (("temperatura", "u_t"), ("ritmo", "u_r")))
+
+
+def _sql_umbral(signo, alias, campo):
+    """Umbral efectivo: el del paciente, el general o el de UMBRALES_DEFECTO."""
+    defecto = UMBRALES_DEFECTO[signo][CAMPOS_UMBRAL.index(campo)]
+    return f"COALESCE({alias}p.{campo}, {alias}g.{campo}, {defecto!r})"
+
+
+def sql_estado(lectura="l"):
+    """
+    Expresión SQL con el código de estado (CODIGO_ESTADO) de la lectura con alias `lectura`.
+    La consulta debe incluir sql_join_umbrales() para el paciente de esa lectura.
+    """
+    t, r = f"{lectura}.temperatura_c", f"{lectura}.ritmo_cardiaco"
+    t_bajo, t_desde, t_hasta, t_alto = (_sql_umbral("temperatura", "u_t", c) for c in CAMPOS_UMBRAL)
+    r_bajo, r_desde, r_hasta, r_alto = (_sql_umbral("ritmo", "u_r", c) for c in CAMPOS_UMBRAL)
+    return (f"(CASE WHEN ({t} < {t_bajo} OR {t} > {t_alto}) OR ({r} < {r_bajo} OR {r} > {r_alto}) THEN 0"
+            f" WHEN ({t} BETWEEN {t_desde} AND {t_hasta}) AND ({r} BETWEEN {r_desde} AND {r_hasta})"
+            f" AND {lectura}.esta_puesta = true THEN 2 ELSE 1 END)")
+
+
+class ClasificadorVitales:
+    """Umbrales compilados: generales + excepciones por paciente (ya combinadas con los generales)."""
+
+    def __init__(self, generales, excepciones):
+        self.generales = generales      # signo -> tupla de UMBRALES_DEFECTO
+        self.excepciones = excepciones  # id_paciente -> {signo: tupla}, solo lo que está en la tabla
+        self.por_paciente = {id_paciente: {**generales, **signos} for id_paciente, signos in excepciones.items()}
+        # Cambia con cualquier modificación de umbrales; entra en el ETag de las vistas
+        huella = repr((sorted(generales.items()), sorted((k, sorted(v.items())) for k, v in excepciones.items())))
+        self.version = hashlib.sha1(huella.encode("utf-8")).hexdigest()[:12]
+
+    def umbrales(self, id_paciente=None):
+        return self.por_paciente.get(id_paciente, self.generales)
+
+    def estado(self, temp, ritmo, esta_puesta, id_paciente=None):
+        """'rojo' (crítico), 'verde' (estable) o 'azul' (advertencia / sin datos)."""
+        if temp is None or ritmo is None:
+            return "azul"
+        umbrales = self.por_paciente.get(id_paciente, self.generales)
+        t_bajo, t_desde, t_hasta, t_alto = umbrales["temperatura"]
+        r_bajo, r_desde, r_hasta, r_alto = umbrales["ritmo"]
+        if (temp < t_bajo or temp > t_alto) or (ritmo < r_bajo or ritmo > r_alto):
+            return "rojo"
+        if (t_desde <= temp <= t_hasta) and (r_desde <= ritmo <= r_hasta) and esta_puesta:
+            return "verde"
+        return "azul"
+
+    def texto_rangos(self, id_paciente=None):
+        umbrales = self.umbrales(id_paciente)
+        (_, t_desde, t_hasta, _), (_, r_desde, r_hasta, _) = umbrales["temperatura"], umbrales["ritmo"]
+        return f"temperatura {t_desde:g}-{t_hasta:g} °C, ritmo cardíaco {r_desde:g}-{r_hasta:g} bpm"
+
+
+CLASIFICADOR_DEFECTO = ClasificadorVitales(dict(UMBRALES_DEFECTO), {})
+cache_umbrales = CacheTTL("umbrales", max_entradas=1, ttl=UMBRALES_TTL)
+
+
+def cargar_clasificador(cur=None):
+    with cursor_de(cur) as consulta:
+        consulta.execute("""
+            SELECT id_paciente, signo, critico_min, estable_min, estable_max, critico_max
+            FROM umbrales_vitales;
+        """)
+        filas = consulta.fetchall()
+
+    generales = dict(UMBRALES_DEFECTO)
+    excepciones = defaultdict(dict)
+    for id_paciente, signo, *valores in filas:
+        if signo not in UMBRALES_DEFECTO:
+            continue
+        valores = tuple(float(v) for v in valores)
+        if id_paciente is None:
+            generales[signo] = valores
+        else:
+            excepciones[id_paciente][signo] = valores
+    return ClasificadorVitales(generales, dict(excepciones))
+
+
+def obtener_clasificador(cur=None):
+    try:
+        return cache_umbrales.obtener_o_calcular("clasificador", lambda: cargar_clasificador(cur))
+    except Exception as e:
+        print(f"Error al cargar umbrales, usando los valores por defecto: {e}")
+        return CLASIFICADOR_DEFECTO
+
+
+def sql_filtro_estado(color, lectura="l"):
+    """Condición SQL 'la lectura está en este estado' ('rojo' / 'verde' / 'azul'); requiere sql_join_umbrales()."""
+    return f"{sql_estado(lectura)} = {CODIGO_ESTADO[color]}"
+
+
+# Lecturas críticas / estables de las últimas 24h (dashboard y chatbot); {filtro} restringe l / pu
+SQL_ESTADISTICAS_24H = """
+    SELECT COUNT(*) FILTER (WHERE {estado} = 0) as criticos,
+           COUNT(*) FILTER (WHERE {estado} = 2) as estables
+    FROM lecturas l
+    LEFT JOIN pulseras pu ON pu.id_pulsera = l.id_pulsera
+    {umbrales}
+    WHERE l.momento_lectura > NOW() - INTERVAL '24 hours' {filtro};
+"""
+
+
+def consulta_estadisticas_24h(id_pulsera=None):
+    """(sql, params) de SQL_ESTADISTICAS_24H, global o de una pulsera (con los umbrales de su paciente)."""
+    sql = SQL_ESTADISTICAS_24H.format(estado=sql_estado(), umbrales=sql_join_umbrales(),
+                                      filtro="" if id_pulsera is None else "AND l.id_pulsera = %s")
+    return sql, (() if id_pulsera is None else (id_pulsera,))
+
+
+def validar_umbrales(datos):
+    """Tupla (critico_min, estable_min, estable_max, critico_max) desde un JSON, o ValueError."""
+    try:
+        valores = tuple(float(datos[campo]) for campo in CAMPOS_UMBRAL)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Se requieren valores numéricos: {', '.join(CAMPOS_UMBRAL)}")
+    if not all(math.isfinite(v) for v in valores):
+        raise ValueError("Los umbrales deben ser números finitos")
+    if not (valores[0] <= valores[1] <= valores[2] <= valores[3]):
+        raise ValueError("Debe cumplirse critico_min <= estable_min <= estable_max <= critico_max")
+    return valores
+
+
+def umbrales_como_dict(umbrales):
+    return {signo: dict(zip(CAMPOS_UMBRAL, valores)) for signo, valores in umbrales.items()}
+
+
+@app.route("/api/umbrales", methods=["GET"])
+def listar_umbrales():
+    """Umbrales generales y excepciones por paciente (?id_paciente=N: los efectivos de ese paciente)."""
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+
+    clasificador = obtener_clasificador()
+    id_paciente = request.args.get("id_paciente", type=int)
+    if id_paciente is not None:
+        return jsonify({
+            "id_paciente": id_paciente,
+            "personalizado": sorted(clasificador.excepciones.get(id_paciente, {})),
+            "umbrales": umbrales_como_dict(clasificador.umbrales(id_paciente)),
+        })
+    return jsonify({
+        "version": clasificador.version,
+        "generales": umbrales_como_dict(clasificador.generales),
+        "pacientes": {str(id_p): umbrales_como_dict(signos) for id_p, signos in clasificador.excepciones.items()},
+    })
+
+
+@app.route("/api/umbrales/<signo>", methods=["PUT", "DELETE"])
+def modificar_umbrales(signo):
+    """
+    PUT: guarda los umbrales de un signo. Body JSON: {critico_min, estable_min, estable_max,
+    critico_max, id_paciente?}; sin id_paciente se modifican los generales.
+    DELETE ?id_paciente=N: quita la excepción del paciente (vuelve a los generales).
+    Solo médicos y administradores.
+    """
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+    if session.get("tipo_usuario") not in ["medico", "admin"]:
+        return jsonify({"error": "Solo médicos y administradores pueden modificar umbrales"}), 403
+    if signo not in UMBRALES_DEFECTO:
+        return jsonify({"error": f"Signo desconocido: {signo}", "signos": sorted(UMBRALES_DEFECTO)}), 404
+
+    # Validar antes de tomar una conexión
+    if request.method == "PUT":
+        datos = request.get_json(silent=True) or {}
+        try:
+            valores = validar_umbrales(datos)
+            id_paciente = int(datos["id_paciente"]) if datos.get("id_paciente") is not None else None
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        id_paciente = request.args.get("id_paciente", type=int)
+        if id_paciente is None:
+            return jsonify({"error": "Los umbrales generales no se borran; usa PUT para cambiarlos"}), 400
+
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            if request.method == "PUT":
+                cur.execute("""
+                    INSERT INTO umbrales_vitales
+                        (id_paciente, signo, critico_min, estable_min, estable_max, critico_max, modificado_por)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT ((COALESCE(id_paciente, 0)), signo) DO UPDATE SET
+                        critico_min = EXCLUDED.critico_min, estable_min = EXCLUDED.estable_min,
+                        estable_max = EXCLUDED.estable_max, critico_max = EXCLUDED.critico_max,
+                        modificado_por = EXCLUDED.modificado_por, actualizado = NOW();
+                """, (id_paciente, signo, *valores, session.get("username")))
+            else:
+                cur.execute("DELETE FROM umbrales_vitales WHERE id_paciente = %s AND signo = %s;",
+                            (id_paciente, signo))
+            conn.commit()
+        finally:
+            # close() devuelve la conexión al pool, que deshace una transacción abortada
+            cur.close()
+            conn.close()
+    except psycopg2.IntegrityError:
+        return jsonify({"error": "Paciente no encontrado"}), 404
+    except Exception as e:
+        print(f"Error al modificar umbrales: {e}")
+        return jsonify({"error": "Error interno al modificar umbrales"}), 500
+
+    cache_umbrales.invalidar()
+    invalidar_contexto_chatbot()
+    clasificador = obtener_clasificador()
+    return jsonify({
+        "success": True,
+        "version": clasificador.version,
+        "id_paciente": id_paciente,
+        "umbrales": umbrales_como_dict(clasificador.umbrales(id_paciente)),
+    })
+
+
+# ================================
+#   PAGINACIÓN Y ORDENAMIENTO DE TABLAS DE PACIENTES
+# ================================
+TAMANO_PAGINA_DEFECTO = 50
+TAMANO_PAGINA_MAXIMO = 200
+
+# Ordenamientos disponibles: clave -> (expresión SQL, descendente, admite NULL)
+# Todas desempatan por p.id_paciente en la misma dirección, lo que permite paginar con keyset.
+# Una expresión invocable se genera en cada consulta.
+ORDENES_PACIENTES = {
+    'id': (None, False, False),
+    'nombre': ("lower(concat_ws(' ', p.nombre, p.apellido_paterno, p.apellido_materno))", False, False),
+    'estado': (sql_estado(), False, False),
+    'lectura': ("l.momento_lectura", True, True),
+    'relevancia': ("array_position(%(ranking)s::int[], p.id_paciente)", False, False),
+}
+
+# Lectura más reciente por paciente; {clave_orden}, {where}, {orden} se completan en consultar_pagina_pacientes
+SQL_PACIENTES_ULTIMA_LECTURA = """
+    SELECT p.id_paciente, p.nombre, p.apellido_paterno, p.apellido_materno,
+           p.fecha_nacimiento, pu.id_pulsera, l.ritmo_cardiaco, l.temperatura_c,
+           l.esta_puesta, l.momento_lectura, {clave_orden} AS clave_orden
+    FROM pacientes p
+    LEFT JOIN pulseras pu ON pu.id_paciente = p.id_paciente
+    LEFT JOIN LATERAL (
+        SELECT * FROM lecturas l
+        WHERE l.id_pulsera = pu.id_pulsera
+        ORDER BY l.momento_lectura DESC LIMIT 1
+    ) l ON TRUE
+    {umbrales}
+    {where}
+    ORDER BY {orden}
+    LIMIT %(limite)s
+"""
+
+# Búsqueda por nombre directa en SQL (respaldo si falla el índice de búsqueda en memoria)
+SQL_FILTRO_NOMBRE_ILIKE = (
+    "(p.nombre ILIKE %(termino)s OR p.apellido_paterno ILIKE %(termino)s OR p.apellido_materno ILIKE %(termino)s)")
+
+
+def codificar_cursor(orden, clave, id_paciente):
+    """Cursor opaco para la URL con la posición de la última fila mostrada."""
+    if isinstance(clave, datetime):
+        clave = clave.isoformat()
+    crudo = json.dumps([orden, clave, id_paciente]).encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor, orden):
+    """Devuelve (clave, id_paciente) o None si el cursor no es válido para este orden."""
+    if not cursor:
+        return None
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        orden_cursor, clave, id_paciente = json.loads(crudo)
+        if orden_cursor != orden:
+            return None
+        if orden == 'lectura' and clave is not None:
+            clave = datetime.fromisoformat(clave)
+        return clave, int(id_paciente)
+    except (ValueError, TypeError):
+        return None
+
+
+def leer_parametros_pagina(orden_defecto='id', permitidos=('id', 'nombre', 'estado', 'lectura')):
+    """Lee orden, cursor (`despues`) y tamaño de página (`por_pagina`) del request."""
+    orden = request.values.get('orden', orden_defecto)
+    if orden not in permitidos:
+        orden = orden_defecto
+    try:
+        por_pagina = int(request.values.get('por_pagina', TAMANO_PAGINA_DEFECTO))
+    except ValueError:
+        por_pagina = TAMANO_PAGINA_DEFECTO
+    por_pagina = min(max(por_pagina, 1), TAMANO_PAGINA_MAXIMO)
+    return orden, decodificar_cursor(request.values.get('despues'), orden), por_pagina
+
+
+def preparar_consulta_pacientes(condiciones, params, orden, despues, por_pagina):
+    """
+    Arma SQL_PACIENTES_ULTIMA_LECTURA con paginación keyset.
+    `condiciones` son fragmentos SQL con parámetros nombrados (%(x)s) presentes en `params`.
+    Devuelve (query, params); la consulta trae una fila de más para saber si hay otra página.
+    """
+    expr, descendente, admite_nulos = ORDENES_PACIENTES[orden]
+    if callable(expr):
+        expr = expr()
+    op = '<' if descendente else '>'
+    direccion = 'DESC' if descendente else 'ASC'
+    condiciones = list(condiciones)
+    params = dict(params)
+
+    if despues is not None:
+        clave, id_ultimo = despues
+        params['cursor_id'] = id_ultimo
+        if expr is None:
+            condiciones.append(f"p.id_paciente {op} %(cursor_id)s")
+        elif clave is None:
+            # Ya estamos en la cola de filas sin valor (NULLS LAST)
+            condiciones.append(f"({expr} IS NULL AND p.id_paciente {op} %(cursor_id)s)")
+        else:
+            params['cursor_clave'] = clave
+            condicion = f"({expr} {op} %(cursor_clave)s OR ({expr} = %(cursor_clave)s AND p.id_paciente {op} %(cursor_id)s)"
+            condiciones.append(condicion + (f" OR {expr} IS NULL)" if admite_nulos else ")"))
+
+    if expr is None:
+        clave_orden = "p.id_paciente"
+        sql_orden = f"p.id_paciente {direccion}"
+    else:
+        clave_orden = expr
+        sql_orden = f"{expr} {direccion}{' NULLS LAST' if admite_nulos else ''}, p.id_paciente {direccion}"
+
+    params['limite'] = por_pagina + 1
+    query = SQL_PACIENTES_ULTIMA_LECTURA.format(
+        clave_orden=clave_orden,
+        umbrales=sql_join_umbrales(),
+        where=("WHERE " + " AND ".join(condiciones)) if condiciones else "",
+        orden=sql_orden,
+    )
+    return query, params
+
+
+def consultar_pagina_pacientes(cur, condiciones, params, orden, despues, por_pagina):
+    """Ejecuta la consulta paginada completa. Devuelve (filas, cursor de la siguiente página o None)."""
+    query, params = preparar_consulta_pacientes(condiciones, params, orden, despues, por_pagina)
+    cur.execute(query, params)
+    filas = cur.fetchall()
+
+    siguiente = None
+    if len(filas) > por_pagina:
+        filas = filas[:por_pagina]
+        ultima = filas[-1]
+        siguiente = codificar_cursor(orden, ultima['clave_orden'], ultima['id_paciente'])
+    return filas, siguiente
+
+
+# ================================
+#   RENDERIZADO EN STREAMING
+# ================================
+# Filas que el cursor del servidor trae por viaje a la BD
+FILAS_POR_LOTE_STREAM = 100
+# Fragmentos de Jinja que se agrupan antes de enviarse al cliente
+FRAGMENTOS_POR_ENVIO = 20
+
+
+class PaginaEnStream:
+    """
+    Página de pacientes leída de un cursor del servidor a medida que la plantilla la recorre.
+
+    Se usa como la lista `pacientes` de las plantillas: `{% if pacientes %}` consulta solo la
+    primera fila y, al terminar el `for`, `pacientes.siguiente` tiene el cursor de la página
+    siguiente. La conexión se cierra al agotar las filas o si el cliente se desconecta.
+
+    Con `respaldo` (clave de cache_respaldo) cada página completa queda guardada; si la primera
+    lectura excede el presupuesto de la ruta se recorren esas filas y `pacientes.degradado` es True.
+    El cursor solo se declara al crearla: la ruta llama a leer_primer_lote() antes de responder
+    para que un error o un respaldo se conozca antes de enviar las cabeceras (y el ETag).
+    """
+
+    def __init__(self, conn, query, params, orden, por_pagina, convertir, respaldo=None):
+        self.siguiente = None
+        self.degradado = False
+        self.fallida = False    # la lectura falló: la tabla sale vacía o incompleta
+        self._respaldo = respaldo
+        self._filas_respaldo = None
+        self._conn = conn
+        if conn is not None:
+            try:
+                self._cur = conn.cursor(name="pagina_pacientes", cursor_factory=psycopg2.extras.DictCursor)
+                self._cur.itersize = FILAS_POR_LOTE_STREAM
+                self._cur.execute(query, params)
+            except Exception:
+                conn.close()
+                raise
+        self._orden = orden
+        self._por_pagina = por_pagina
+        self._convertir = convertir
+        self._pendiente = None
+
+    def cerrar(self):
+        if self._conn is not None:
+            try:
+                self._cur.close()
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _usar_respaldo(self, error):
+        """Antes de emitir filas: si se excedió el presupuesto, pasar a la página guardada."""
+        if self._respaldo is None or not presupuesto_excedido(error):
+            return False
+        respaldo = obtener_respaldo(self._respaldo)
+        if respaldo is None:
+            return False
+        print(f"Presupuesto excedido al leer pacientes, usando datos en caché: {error}")
+        self.cerrar()
+        self._filas_respaldo, self.siguiente = respaldo
+        self.degradado = True
+        return True
+
+    @classmethod
+    def desde_respaldo(cls, error, orden, por_pagina, respaldo):
+        """Página degradada si no se pudo ni abrir el cursor (sin conexión a tiempo); None si no hay respaldo."""
+        pagina = cls(None, None, None, orden, por_pagina, None, respaldo)
+        return pagina if pagina._usar_respaldo(error) else None
+
+    def leer_primer_lote(self):
+        """
+        Trae el primer lote del cursor (FILAS_POR_LOTE_STREAM filas). Devuelve False si la página
+        no refleja la BD (filas del respaldo o error de lectura): esa respuesta no lleva ETag.
+        """
+        bool(self)
+        return not (self.degradado or self.fallida)
+
+    def __bool__(self):
+        if self.degradado:
+            return bool(self._filas_respaldo)
+        if self._pendiente is None and self._conn is not None:
+            try:
+                self._pendiente = next(iter(self._cur), None)
+            except Exception as e:
+                if self._usar_respaldo(e):
+                    return bool(self._filas_respaldo)
+                self.fallida = True
+                print(f"Error al leer pacientes: {e}")
+            if self._pendiente is None:
+                self.cerrar()
+        return self._pendiente is not None
+
+    def __iter__(self):
+        if self.degradado:
+            yield from self._filas_respaldo
+            return
+        if self._conn is None and self._pendiente is None:
+            return
+        emitidas = []
+        completa = False
+        try:
+            filas = iter(self._cur)
+            fila = self._pendiente if self._pendiente is not None else next(filas, None)
+            self._pendiente = None
+            ultima = None
+            while fila is not None:
+                if len(emitidas) == self._por_pagina:
+                    self.siguiente = codificar_cursor(self._orden, ultima['clave_orden'], ultima['id_paciente'])
+                    break
+                convertida = self._convertir(fila)
+                emitidas.append(convertida)
+                yield convertida
+                ultima = fila
+                fila = next(filas, None)
+            completa = True
+        except Exception as e:
+            if not emitidas and self._usar_respaldo(e):
+                yield from self._filas_respaldo
+                return
+            self.fallida = True
+            print(f"Error al leer pacientes: {e}")
+        finally:
+            self.cerrar()
+        if completa and self._respaldo is not None:
+            cache_respaldo.guardar(self._respaldo, (emitidas, self.siguiente))
+
+
+def clave_respaldo_pagina(query, params):
+    """Clave de cache_respaldo para una página de pacientes de la ruta en curso."""
+    huella = hashlib.sha1((query + repr(sorted(params.items()))).encode("utf-8")).hexdigest()
+    return f"{endpoint_actual()}:{huella}"
+
+
+def render_template_stream(nombre, **context):
+    """Como render_template, pero envía el HTML por partes mientras se genera."""
+    app.update_template_context(context)
+    flujo = app.jinja_env.get_template(nombre).stream(context)
+    flujo.enable_buffering(FRAGMENTOS_POR_ENVIO)
+    respuesta = Response(stream_with_context(flujo), mimetype="text/html")
+    # Si el cliente corta antes de llegar a las filas, devolver igual la conexión
+    for valor in context.values():
+        if isinstance(valor, PaginaEnStream):
+            respuesta.call_on_close(valor.cerrar)
+    return respuesta
+
 # ================================
-#   CONEXIÓN A LA BASE DE DATOS
+#   GET CONDICIONAL (ETag / Last-Modified)
 # ================================
+# Segundos durante los que se reutiliza la versión de datos leída de la BD
+VERSION_DATOS_TTL = float(os.getenv("VERSION_DATOS_TTL", "2"))
+
+# Versión de datos compartida por las vistas que dependen de pacientes y lecturas.
+# Las lecturas solo se insertan, así que el id más alto cambia con cada ingesta y se
+# obtiene con un recorrido inverso de la clave primaria. Pacientes, pulseras, asignaciones de
+# familiares, alertas y umbrales llevan un contador de cambios por tabla (versiones_datos,
+# mantenido por triggers; ver migraciones/0004_versiones_datos.sql).
+SQL_VERSION_DATOS = """
+    SELECT ul.id_lectura, ul.momento_lectura, v.versiones, v.cambiado_en
+    FROM (
+        SELECT string_agg(tabla || ':' || version, ',' ORDER BY tabla) AS versiones,
+               MAX(cambiado_en) AS cambiado_en
+        FROM versiones_datos
+    ) v
+    LEFT JOIN LATERAL (
+        SELECT id_lectura, momento_lectura FROM lecturas ORDER BY id_lectura DESC LIMIT 1
+    ) ul ON TRUE;
+"""
+
+SQL_VERSION_PULSERA = """
+    SELECT id_lectura, momento_lectura FROM lecturas
+    WHERE id_pulsera = %s
+    ORDER BY momento_lectura DESC LIMIT 1;
+"""
+
+_version_lock = threading.Lock()
+_version_datos = {
+    "valor": None,
+    "ultima_modificacion": None,
+    "leido_en": 0.0,
+}
+
+
+def _como_utc(momento):
+    """Fechas sin zona de la BD se tratan como UTC para las cabeceras HTTP."""
+    if momento is None:
+        return None
+    if momento.tzinfo is None:
+        momento = momento.replace(tzinfo=timezone.utc)
+    return momento.astimezone(timezone.utc).replace(microsecond=0)
 
-def get_connection():
-    return psycopg2.connect(DB_URL)
 
+def obtener_version_datos(cur=None):
+    """Devuelve (version, ultima_modificacion) de lecturas + pacientes, cacheada VERSION_DATOS_TTL segundos."""
+    with _version_lock:
+        if _version_datos["valor"] is not None and time.monotonic() - _version_datos["leido_en"] < VERSION_DATOS_TTL:
+            return _version_datos["valor"], _version_datos["ultima_modificacion"]
 
-def is_logged_in():
-    return session.get("logged_in") is True
+    with cursor_de(cur) as consulta:
+        consulta.execute(SQL_VERSION_DATOS)
+        id_lectura, momento_lectura, versiones, cambiado_en = consulta.fetchone()
 
+    with _version_lock:
+        _version_datos["valor"] = f"{id_lectura}|{versiones}"
+        _version_datos["ultima_modificacion"] = max(
+            (m for m in (_como_utc(momento_lectura), _como_utc(cambiado_en)) if m is not None), default=None)
+        _version_datos["leido_en"] = time.monotonic()
+        return _version_datos["valor"], _version_datos["ultima_modificacion"]
 
-# Helper: obtener id_paciente asignado a un familiar
-def get_assigned_patient_id(username):
+
+def version_tabla(tabla, cur=None):
+    """Contador de `tabla` en versiones_datos según la versión de datos cacheada (None si no se pudo leer)."""
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id_paciente_asignado FROM usuarios WHERE username = %s;", (username,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        if row:
-            return row[0]
-    except Exception:
-        pass
+        version, _ = obtener_version_datos(cur)
+    except Exception as e:
+        print(f"Error al obtener versión de datos: {e}")
+        return None
+    for parte in version.split("|", 1)[1].split(","):
+        nombre, _, contador = parte.partition(":")
+        if nombre == tabla:
+            return contador
     return None
 
+
+def invalidar_version_datos():
+    """Forzar que la próxima petición condicional vuelva a leer la versión (tras una escritura)."""
+    with _version_lock:
+        _version_datos["leido_en"] = 0.0
+
+
+def verificar_version(*alcance, version=None, ultima_modificacion=None, cur=None):
+    """
+    Calcula el ETag de la vista actual a partir de la versión de datos y de umbrales, la URL, el rol,
+    el usuario y, para familiares, el paciente asignado.
+    Si el cliente ya tiene esa versión devuelve una respuesta 304; si no, devuelve None y deja
+    ETag/Last-Modified en `g` para que `agregar_cabeceras_version` los agregue a la respuesta.
+    Solo se valida el ETag: If-Modified-Since no distingue usuarios (otra sesión en el mismo
+    navegador recibiría 304 con la página del anterior), así que Last-Modified es informativo.
+    `cur`: el de la conexión que la ruta ya tiene, si la tiene.
+    """
+    if version is None:
+        version, ultima_modificacion = obtener_version_datos(cur)
+    user_role = session.get('tipo_usuario')
+    asignado = paciente_asignado_actual(cur) if user_role == 'familiar' else None
+    clave = repr((version, obtener_clasificador(cur).version, request.full_path, user_role,
+                  session.get('username'), asignado) + alcance)
+    etag = hashlib.sha1(clave.encode('utf-8')).hexdigest()
+    g.etag = etag
+    g.ultima_modificacion = ultima_modificacion
+
+    vigente = bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+    if not vigente:
+        return None
+    respuesta = Response(status=304)
+    respuesta.set_etag(etag, weak=True)
+    if ultima_modificacion is not None:
+        respuesta.last_modified = ultima_modificacion
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+
+@app.after_request
+def agregar_cabeceras_version(response):
+    etag = g.pop('etag', None)
+    ultima_modificacion = g.pop('ultima_modificacion', None)
+    if etag and response.status_code == 200:
+        response.set_etag(etag, weak=True)
+        if ultima_modificacion is not None:
+            response.last_modified = ultima_modificacion
+        # private: el contenido depende del usuario; no-cache: revalidar siempre con el ETag
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 # ================================
 #   CONFIGURACIÓN DE SESIÓN PERMANENTE
 # ================================
@@ -138,9 +1840,10 @@ def restrict_familiar_access():
     # Añadimos todas las rutas relacionadas con ver/crear/editar/eliminar historial,
     # además de vistas de pacientes y búsqueda para que puedan abrir el historial.
     allowed = {
-        'home', 'login', 'logout', 'mi_perfil', 'ver_pacientes', 'buscar_pacientes',
+        'home', 'login', 'logout', 'mi_perfil', 'ver_pacientes', 'buscar_pacientes', 'sugerir_pacientes',
         'historial_paciente', 'historial_paciente_nuevo', 'editar_historial', 'eliminar_historial',
-        'cambiar_contrasena', 'tabla_pacientes', 'dashboard', 'semaforo'
+        'cambiar_contrasena', 'tabla_pacientes', 'dashboard', 'semaforo', 'chatbot_api',
+        'chatbot_borrar_historial', 'chatbot_trabajo'
     }
 
     # Si intenta acceder a otra endpoint, redirigirle a su perfil
@@ -284,6 +1987,7 @@ def registro():
             conn.commit()
             cur.close()
             conn.close()
+            invalidar_asignacion(username)
 
             # Auto-login
             session["logged_in"] = True
@@ -304,6 +2008,20 @@ def registro():
 # ================================
 #   DASHBOARD PRINCIPAL
 # ================================
+# Promedios diarios de los últimos 7 días (gráfico de tendencias); {filtro} restringe a una pulsera
+SQL_TENDENCIA_7_DIAS = """
+    SELECT date_trunc('day', momento_lectura) as dia,
+           ROUND(AVG(temperatura_c), 1) as temp_promedio,
+           ROUND(AVG(ritmo_cardiaco), 0) as ritmo_promedio,
+           COUNT(*) as num_lecturas
+    FROM lecturas
+    WHERE momento_lectura > NOW() - INTERVAL '7 days' {filtro}
+      AND temperatura_c IS NOT NULL
+      AND ritmo_cardiaco IS NOT NULL
+    GROUP BY dia
+    ORDER BY dia;
+"""
+
 @app.route("/dashboard")
 def dashboard():
     if not is_logged_in():
@@ -312,6 +2030,20 @@ def dashboard():
     username = session.get("username")
     user_role = session.get("tipo_usuario", "invitado")
 
+    if user_role != 'familiar':
+        try:
+            detector_pulseras.revisar()
+        except Exception as e:
+            print(f"Error en detector de pulseras: {e}")
+
+    # Las estadísticas son de ventanas móviles (24h / 7 días): la versión vence cada minuto aunque no lleguen lecturas
+    try:
+        no_modificado = verificar_version(int(time.time() // 60))
+        if no_modificado is not None:
+            return no_modificado
+    except Exception as e:
+        print(f"Error al obtener versión de datos: {e}")
+
     # Por defecto valores
     total_pacientes = 0
     criticos = 0
@@ -320,6 +2052,10 @@ def dashboard():
     trend_labels = []
     trend_criticos = []
     trend_estables = []
+    dispositivos = None
+    clasificador = obtener_clasificador()
+    # Último dashboard bueno de este alcance, para mostrarlo si la BD no responde a tiempo
+    clave_respaldo = f"dashboard:{username if user_role == 'familiar' else 'todos'}"
 
     try:
         conn = get_connection()
@@ -327,7 +2063,7 @@ def dashboard():
 
         # Si el usuario es familiar, limitar la vista al paciente asignado
         if user_role == 'familiar':
-            assigned = get_assigned_patient_id(username)
+            assigned = get_assigned_patient_id(username, cur)
             if not assigned:
                 # Usuario familiar sin asignación
                 total_pacientes = 0
@@ -354,13 +2090,7 @@ def dashboard():
 
             # Estadísticas (últimas 24h) solo para las lecturas de la pulsera asignada
             if id_pulsera:
-                cur.execute("""
-                    SELECT 
-                        COUNT(CASE WHEN (temperatura_c < 35 OR temperatura_c > 39.5) OR (ritmo_cardiaco < 40 OR ritmo_cardiaco > 130) THEN 1 END) as criticos,
-                        COUNT(CASE WHEN (temperatura_c BETWEEN 36 AND 37.5) AND (ritmo_cardiaco BETWEEN 60 AND 100) AND esta_puesta = true THEN 1 END) as estables
-                    FROM lecturas l
-                    WHERE l.id_pulsera = %s AND l.momento_lectura > NOW() - INTERVAL '24 hours';
-                """, (id_pulsera,))
+                cur.execute(*consulta_estadisticas_24h(id_pulsera))
                 stats = cur.fetchone()
                 criticos = stats[0] if stats else 0
                 estables = stats[1] if stats else 0
@@ -374,12 +2104,7 @@ def dashboard():
                 ritmo = r[6]
                 estado = 'N/A'
                 if temp is not None and ritmo is not None:
-                    if (temp < 35 or temp > 39.5) or (ritmo < 40 or ritmo > 130):
-                        estado = 'Crítico'
-                    elif (36 <= temp <= 37.5) and (60 <= ritmo <= 100):
-                        estado = 'Estable'
-                    else:
-                        estado = 'Advertencia'
+                    estado = TEXTO_ESTADO[clasificador.estado(temp, ritmo, True, r[0])]
                 top_residentes = [{
                     'id_paciente': r[0],
                     'nombre': nombre,
@@ -391,17 +2116,7 @@ def dashboard():
             # Tendencias: promedios de signos vitales por día en últimos 7 días para la pulsera (si existe)
             try:
                 if id_pulsera:
-                    cur.execute("""
-                        SELECT date_trunc('day', momento_lectura) as dia,
-                               ROUND(AVG(temperatura_c), 1) as temp_promedio,
-                               ROUND(AVG(ritmo_cardiaco), 0) as ritmo_promedio
-                        FROM lecturas
-                        WHERE id_pulsera = %s AND momento_lectura > NOW() - INTERVAL '7 days'
-                          AND temperatura_c IS NOT NULL
-                          AND ritmo_cardiaco IS NOT NULL
-                        GROUP BY dia
-                        ORDER BY dia;
-                    """, (id_pulsera,))
+                    cur.execute(SQL_TENDENCIA_7_DIAS.format(filtro="AND id_pulsera = %s"), (id_pulsera,))
                 else:
                     # sin pulsera -> no hay lecturas
                     rows = []
@@ -439,7 +2154,9 @@ def dashboard():
                 trend_temperatura = temp_data
                 trend_ritmo = ritmo_data
 
-            except Exception:
+            except Exception as ex:
+                if presupuesto_excedido(ex):
+                    raise
                 trend_labels = [(datetime.now().date() - timedelta(days=i)).strftime('%d/%m') for i in range(6, -1, -1)]
                 trend_temperatura = [36.5, 36.6, 36.4, 36.7, 36.5, 36.6, 36.5]
                 trend_ritmo = [75, 78, 72, 80, 76, 74, 77]
@@ -451,21 +2168,21 @@ def dashboard():
             total_pacientes = cur.fetchone()[0] or 0
 
             # Estadísticas de últimas 24h (global)
-            cur.execute("""
-                SELECT 
-                    COUNT(CASE WHEN (l.temperatura_c < 35 OR l.temperatura_c > 39.5) 
-                              OR (l.ritmo_cardiaco < 40 OR l.ritmo_cardiaco > 130) THEN 1 END) as criticos,
-                    COUNT(CASE WHEN (l.temperatura_c BETWEEN 36 AND 37.5) AND (l.ritmo_cardiaco BETWEEN 60 AND 100) AND l.esta_puesta = true THEN 1 END) as estables
-                FROM lecturas l
-                WHERE l.momento_lectura > NOW() - INTERVAL '24 hours';
-            """)
+            cur.execute(*consulta_estadisticas_24h())
             stats = cur.fetchone()
             criticos = stats[0] if stats else 0
             estables = stats[1] if stats else 0
 
+            # Pulseras sin datos / retiradas (pulsera_estado)
+            try:
+                dispositivos = detector_pulseras.resumen(cur)
+            except Exception as ex:
+                conn.rollback()
+                print(f"Error en detector de pulseras: {ex}")
+
             # TOP RESIDENTES: lectura más reciente por paciente, ordenar por severidad y fecha
             try:
-                cur.execute("""
+                cur.execute(f"""
                     SELECT p.id_paciente, p.nombre, p.apellido_paterno, p.apellido_materno,
                            pu.id_pulsera, l.temperatura_c, l.ritmo_cardiaco, l.momento_lectura
                     FROM pacientes p
@@ -475,51 +2192,39 @@ def dashboard():
                         WHERE l.id_pulsera = pu.id_pulsera
                         ORDER BY l.momento_lectura DESC LIMIT 1
                     ) l ON TRUE
+                    {sql_join_umbrales()}
                     ORDER BY
-                      (CASE WHEN (l.temperatura_c < 35 OR l.temperatura_c > 39.5) OR (l.ritmo_cardiaco < 40 OR l.ritmo_cardiaco > 130) THEN 1
-                            WHEN (l.temperatura_c BETWEEN 36 AND 37.5) AND (l.ritmo_cardiaco BETWEEN 60 AND 100) AND l.esta_puesta = true THEN 2
-                            ELSE 3 END) ASC NULLS LAST,
+                      -- críticos, luego estables, luego el resto
+                      array_position(ARRAY[0, 2, 1], {sql_estado()}) ASC NULLS LAST,
                       l.momento_lectura DESC
                     LIMIT 5;
                 """)
                 top_rows = cur.fetchall()
                 top_residentes = []
+                anomalos = obtener_pacientes_anomalos(cur)
                 for r in top_rows:
                     nombre = f"{r[1]} {r[2]} {r[3]}".strip()
                     temp = r[5]
                     ritmo = r[6]
                     estado = 'N/A'
                     if temp is not None and ritmo is not None:
-                        if (temp < 35 or temp > 39.5) or (ritmo < 40 or ritmo > 130):
-                            estado = 'Crítico'
-                        elif (36 <= temp <= 37.5) and (60 <= ritmo <= 100):
-                            estado = 'Estable'
-                        else:
-                            estado = 'Advertencia'
+                        estado = TEXTO_ESTADO[clasificador.estado(temp, ritmo, True, r[0])]
                     top_residentes.append({
                         'id_paciente': r[0],
                         'nombre': nombre,
                         'id_pulsera': r[4] or 'Sin asignar',
                         'estado': estado,
+                        'tendencia': texto_tendencia(anomalos, r[0]),
                         'momento_lectura': r[7]
                     })
-            except Exception:
+            except Exception as ex:
+                if presupuesto_excedido(ex):
+                    raise
                 top_residentes = []
 
             # Tendencias últimos 7 días (global) - PROMEDIOS DE SIGNOS VITALES
             try:
-                cur.execute("""
-                    SELECT date_trunc('day', momento_lectura) as dia,
-                           ROUND(AVG(temperatura_c), 1) as temp_promedio,
-                           ROUND(AVG(ritmo_cardiaco), 0) as ritmo_promedio,
-                           COUNT(*) as num_lecturas
-                    FROM lecturas
-                    WHERE momento_lectura > NOW() - INTERVAL '7 days'
-                      AND temperatura_c IS NOT NULL
-                      AND ritmo_cardiaco IS NOT NULL
-                    GROUP BY dia
-                    ORDER BY dia;
-                """)
+                cur.execute(SQL_TENDENCIA_7_DIAS.format(filtro=""))
                 rows = cur.fetchall()
                 # usar timedelta importado a nivel de módulo
                 labels = []
@@ -537,16 +2242,35 @@ def dashboard():
                 trend_temperatura = temp_data
                 trend_ritmo = ritmo_data
             except Exception as ex:
+                if presupuesto_excedido(ex):
+                    raise
                 print(f"Error en tendencias: {ex}")
-                from datetime import timedelta
                 trend_labels = [(datetime.now().date() - timedelta(days=i)).strftime('%d/%m') for i in range(6, -1, -1)]
                 trend_temperatura = [36.5, 36.6, 36.4, 36.7, 36.5, 36.6, 36.5]
                 trend_ritmo = [75, 78, 72, 80, 76, 74, 77]
 
         cur.close()
         conn.close()
+        cache_respaldo.guardar(clave_respaldo, {
+            "total_pacientes": total_pacientes,
+            "criticos": criticos,
+            "estables": estables,
+            "top_residentes": top_residentes,
+            "trend_labels": trend_labels,
+            "trend_temperatura": trend_temperatura,
+            "trend_ritmo": trend_ritmo,
+            "dispositivos": dispositivos,
+        })
 
     except Exception as e:
+        if 'conn' in locals():
+            conn.close()
+        respaldo = obtener_respaldo(clave_respaldo) if presupuesto_excedido(e) else None
+        if respaldo is not None:
+            print(f"Presupuesto excedido en dashboard, usando datos en caché: {e}")
+            g.pop('etag', None)
+            return render_template("dashboard.html", username=username, user_role=user_role,
+                                   degradado=True, **respaldo)
         # si ocurre un error de BD, devolver valores por defecto y mostrar dashboard vacío/moderado
         total_pacientes = total_pacientes or 0
         criticos = criticos or 0
@@ -565,7 +2289,8 @@ def dashboard():
                            top_residentes=top_residentes,
                            trend_labels=trend_labels,
                            trend_temperatura=trend_temperatura,
-                           trend_ritmo=trend_ritmo)
+                           trend_ritmo=trend_ritmo,
+                           dispositivos=dispositivos)
 
 
 # ================================
@@ -646,45 +2371,28 @@ def ver_pacientes():
 
     username = session.get("username")
     user_role = session.get("tipo_usuario", "invitado")
+    orden, despues, por_pagina = leer_parametros_pagina()
 
-    # Base query
-    base_query = """
-        SELECT p.*, pu.id_pulsera, l.temperatura_c, l.ritmo_cardiaco, l.esta_puesta, l.momento_lectura
-        FROM pacientes p
-        LEFT JOIN pulseras pu ON pu.id_paciente = p.id_paciente
-        LEFT JOIN LATERAL (
-            SELECT * FROM lecturas l
-            WHERE l.id_pulsera = pu.id_pulsera
-            ORDER BY l.momento_lectura DESC LIMIT 1
-        ) l ON TRUE
-    """
+    # La edad mostrada depende de la fecha
+    try:
+        no_modificado = verificar_version(date.today().isoformat())
+        if no_modificado is not None:
+            return no_modificado
+    except Exception as e:
+        print(f"Error al obtener versión de datos: {e}")
 
-    params = []
+    condiciones = []
+    params = {}
 
     # If user is a familiar, only show their assigned patient
     if user_role == 'familiar':
         assigned = get_assigned_patient_id(username)
         if not assigned:
             # no assigned patient - render empty list
-            return render_template("tabla_pacientes.html", username=username, pacientes=[])
-        base_query += " WHERE p.id_paciente = %s"
-        params.append(assigned)
-
-    base_query += " ORDER BY p.id_paciente;"
-
-    try:
-        conn = get_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        if params:
-            cur.execute(base_query, tuple(params))
-        else:
-            cur.execute(base_query)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print(f"Error al consultar pacientes: {e}")
-        return render_template("tabla_pacientes.html", username=session.get("username"), pacientes=[])
+            return render_template("tabla_pacientes.html", username=username, pacientes=[],
+                                   total_pacientes=0, orden=orden)
+        condiciones.append("p.id_paciente = %(asignado)s")
+        params['asignado'] = assigned
 
     def calcular_edad(fecha_nacimiento):
         if not fecha_nacimiento:
@@ -693,10 +2401,9 @@ def ver_pacientes():
         return hoy.year - fecha_nacimiento.year - (
                     (hoy.month, hoy.day) < (fecha_nacimiento.month, fecha_nacimiento.day))
 
-    pacientes = []
-    for r in rows:
+    def convertir(r):
         nombre_completo = f"{r['nombre']} {r['apellido_paterno']} {r['apellido_materno']}"
-        pacientes.append({
+        return {
             "id_paciente": r["id_paciente"],
             "nombre": nombre_completo,
             "edad": calcular_edad(r["fecha_nacimiento"]),
@@ -705,46 +2412,92 @@ def ver_pacientes():
             "ritmo_cardiaco": r["ritmo_cardiaco"],
             "esta_puesta": r["esta_puesta"],
             "momento_lectura": r["momento_lectura"],
-        })
+        }
 
-    return render_template("tabla_pacientes.html",
-                           username=username,
-                           pacientes=pacientes)
+    respaldo = None
+    try:
+        # El total sale del índice en memoria: no hace falta un COUNT(*) por página
+        total_pacientes = 1 if user_role == 'familiar' else obtener_indice_pacientes().total()
+        query, params = preparar_consulta_pacientes(condiciones, params, orden, despues, por_pagina)
+        respaldo = clave_respaldo_pagina(query, params)
+        pacientes = PaginaEnStream(get_connection(), query, params, orden, por_pagina, convertir, respaldo)
+        # Primer lote antes de las cabeceras: con datos del respaldo o sin datos, sin ETag
+        if not pacientes.leer_primer_lote():
+            g.pop('etag', None)
+    except Exception as e:
+        print(f"Error al consultar pacientes: {e}")
+        pacientes = PaginaEnStream.desde_respaldo(e, orden, por_pagina, respaldo)
+        if pacientes is not None:
+            g.pop('etag', None)
+            return render_template_stream("tabla_pacientes.html", username=username, pacientes=pacientes,
+                                          total_pacientes=total_pacientes, orden=orden)
+        return render_template("tabla_pacientes.html", username=session.get("username"), pacientes=[],
+                               total_pacientes=0, orden=orden)
+
+    # Las filas se leen y se envían mientras se renderiza la tabla
+    return render_template_stream("tabla_pacientes.html",
+                                  username=username,
+                                  pacientes=pacientes,
+                                  total_pacientes=total_pacientes,
+                                  orden=orden)
 
 
 # ================================
 #   BUSCADOR DE PACIENTES
 # ================================
+# Coincidencias de los filtros que no dependen de lecturas (nombre, id, pulsera)
+SQL_CONTAR_PACIENTES = """
+    SELECT COUNT(*)
+    FROM pacientes p
+    LEFT JOIN pulseras pu ON pu.id_paciente = p.id_paciente
+    {where};
+"""
+
+
+def contar_resultados_busqueda(cur, condiciones, params, ranking, por_estado, despues, siguiente, en_pagina):
+    """
+    Total de coincidencias de la búsqueda: (total, exacto).
+
+    Si todo entra en una página es el largo de la página. Si no, sale del índice en memoria (sin
+    filtros o solo por nombre) o de un COUNT sobre pacientes y pulseras, que no toca lecturas. El
+    filtro de estado depende de la última lectura de cada paciente y contarlo recorrería todas:
+    en ese caso se informa lo que se ve en la página como cota inferior.
+    """
+    if despues is None and siguiente is None:
+        return en_pagina, True
+    if por_estado:
+        return en_pagina, False
+    if not condiciones:
+        return obtener_indice_pacientes(cur).total(), True
+    if ranking and len(condiciones) == 1:
+        return len(ranking), True
+    cur.execute(SQL_CONTAR_PACIENTES.format(where="WHERE " + " AND ".join(condiciones)), params)
+    return cur.fetchone()[0], True
+
+
 @app.route("/buscar-pacientes", methods=["GET", "POST"])
 def buscar_pacientes():
     if not is_logged_in():
         return redirect(url_for("home"))
 
     pacientes = []
-    params = []
+    condiciones = []
+    params = {}
+    ranking = {}
+    siguiente = None
+    total_resultados, total_exacto = 0, True
 
     username = session.get('username')
     user_role = session.get('tipo_usuario', 'invitado')
 
-    if request.method == "POST":
-        busqueda = request.form.get("busqueda", "").strip()
-        estado_filtro = request.form.get("estado", "")
-        tiene_pulsera = request.form.get("tiene_pulsera", "")
-
-        query = """
-            SELECT DISTINCT p.id_paciente, p.nombre, p.apellido_paterno, p.apellido_materno,
-                   p.fecha_nacimiento, pu.id_pulsera, l.ritmo_cardiaco, l.temperatura_c,
-                   l.esta_puesta, l.momento_lectura
-            FROM pacientes p
-            LEFT JOIN pulseras pu ON pu.id_paciente = p.id_paciente
-            LEFT JOIN LATERAL (
-                SELECT * FROM lecturas l
-                WHERE l.id_pulsera = pu.id_pulsera
-                ORDER BY l.momento_lectura DESC LIMIT 1
-            ) l ON TRUE
-            WHERE 1=1
-        """
+    busqueda = request.values.get("busqueda", "").strip()
+    estado_filtro = request.values.get("estado", "")
+    tiene_pulsera = request.values.get("tiene_pulsera", "")
+    # El formulario usa GET para que los resultados se puedan paginar; POST se mantiene por compatibilidad
+    buscado = request.method == "POST" or any(k in request.args for k in ("busqueda", "estado", "tiene_pulsera"))
+    orden = 'id'
 
+    if buscado:
         # If familiar, restrict to assigned patient regardless of search
         if user_role == 'familiar':
             assigned = get_assigned_patient_id(username)
@@ -756,42 +2509,52 @@ def buscar_pacientes():
                     busqueda=busqueda,
                     estado_filtro=estado_filtro,
                     tiene_pulsera=tiene_pulsera,
-                    total_resultados=0
+                    total_resultados=0,
+                    buscado=buscado,
+                    orden=orden,
+                    siguiente=None
                 )
-            query += " AND p.id_paciente = %s"
-            params.append(int(assigned))
+            condiciones.append("p.id_paciente = %(asignado)s")
+            params['asignado'] = int(assigned)
 
         else:
             if busqueda:
                 if busqueda.isdigit():
-                    query += " AND p.id_paciente = %s"
-                    params.append(int(busqueda))
+                    condiciones.append("p.id_paciente = %(id_buscado)s")
+                    params['id_buscado'] = int(busqueda)
                 else:
-                    query += " AND (p.nombre ILIKE %s OR p.apellido_paterno ILIKE %s OR p.apellido_materno ILIKE %s)"
-                    termino_busqueda = f"%{busqueda}%"
-                    params.extend([termino_busqueda, termino_busqueda, termino_busqueda])
-
-            if estado_filtro:
-                if estado_filtro == "rojo":
-                    query += " AND ((l.temperatura_c < 35 OR l.temperatura_c > 39.5) OR (l.ritmo_cardiaco < 40 OR l.ritmo_cardiaco > 130))"
-                elif estado_filtro == "verde":
-                    query += " AND (l.temperatura_c BETWEEN 36 AND 37.5) AND (l.ritmo_cardiaco BETWEEN 60 AND 100) AND l.esta_puesta = true"
-                elif estado_filtro == "azul":
-                    query += " AND NOT ((l.temperatura_c < 35 OR l.temperatura_c > 39.5) OR (l.ritmo_cardiaco < 40 OR l.ritmo_cardiaco > 130))"
-                    query += " AND NOT ((l.temperatura_c BETWEEN 36 AND 37.5) AND (l.ritmo_cardiaco BETWEEN 60 AND 100) AND l.esta_puesta = true)"
+                    # Candidatos desde el índice de trigramas (sin acentos, ordenados por relevancia)
+                    try:
+                        ranking = {id_p: i for i, (id_p, _) in enumerate(obtener_indice_pacientes().buscar(busqueda))}
+                        condiciones.append("p.id_paciente = ANY(%(ranking)s)")
+                        params['ranking'] = list(ranking)
+                    except Exception as e:
+                        print(f"Error en índice de búsqueda, usando ILIKE: {e}")
+                        condiciones.append(SQL_FILTRO_NOMBRE_ILIKE)
+                        params['termino'] = f"%{busqueda}%"
+
+            if estado_filtro in CODIGO_ESTADO:
+                condiciones.append(sql_filtro_estado(estado_filtro))
 
             if tiene_pulsera == "con":
-                query += " AND pu.id_pulsera IS NOT NULL"
+                condiciones.append("pu.id_pulsera IS NOT NULL")
             elif tiene_pulsera == "sin":
-                query += " AND pu.id_pulsera IS NULL"
+                condiciones.append("pu.id_pulsera IS NULL")
 
-        query += " ORDER BY p.id_paciente"
+        # Si la búsqueda fue por nombre, por defecto se muestran primero las mejores coincidencias
+        if ranking:
+            orden, despues, por_pagina = leer_parametros_pagina(
+                'relevancia', permitidos=('relevancia', 'id', 'nombre', 'estado', 'lectura'))
+        else:
+            orden, despues, por_pagina = leer_parametros_pagina()
 
         try:
             conn = get_connection()
             cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute(query, tuple(params))
-            rows = cur.fetchall()
+            rows, siguiente = consultar_pagina_pacientes(cur, condiciones, params, orden, despues, por_pagina)
+            total_resultados, total_exacto = contar_resultados_busqueda(
+                cur, condiciones, params, ranking, user_role != 'familiar' and estado_filtro in CODIGO_ESTADO,
+                despues, siguiente, len(rows))
             cur.close()
             conn.close()
 
@@ -802,20 +2565,14 @@ def buscar_pacientes():
                 return hoy.year - fecha_nacimiento.year - (
                             (hoy.month, hoy.day) < (fecha_nacimiento.month, fecha_nacimiento.day))
 
+            anomalos = obtener_pacientes_anomalos()
+            clasificador = obtener_clasificador()
             for r in rows:
                 nombre_completo = f"{r['nombre']} {r['apellido_paterno']} {r['apellido_materno']}"
                 temp = r["temperatura_c"]
                 ritmo = r["ritmo_cardiaco"]
                 esta_puesta = r["esta_puesta"]
-                estado = "azul"
-
-                if temp is not None and ritmo is not None:
-                    if (temp < 35 or temp > 39.5) or (ritmo < 40 or ritmo > 130):
-                        estado = "rojo"
-                    elif (36 <= temp <= 37.5) and (60 <= ritmo <= 100) and esta_puesta:
-                        estado = "verde"
-                    else:
-                        estado = "azul"
+                estado = clasificador.estado(temp, ritmo, esta_puesta, r["id_paciente"])
 
                 pacientes.append({
                     "id_paciente": r["id_paciente"],
@@ -827,24 +2584,64 @@ def buscar_pacientes():
                     "esta_puesta": esta_puesta,
                     "momento_lectura": r["momento_lectura"],
                     "estado": estado,
-                    "estado_texto": {"rojo": "Crítico", "verde": "Estable", "azul": "Advertencia"}[estado]
+                    "estado_texto": TEXTO_ESTADO[estado],
+                    "tendencia": texto_tendencia(anomalos, r["id_paciente"])
                 })
 
         except Exception as e:
             print(f"Error en la búsqueda: {e}")
-            return render_template("buscar_pacientes.html", username=session.get("username"), pacientes=[], busqueda=busqueda, estado_filtro=estado_filtro, tiene_pulsera=tiene_pulsera, total_resultados=0)
+            return render_template("buscar_pacientes.html", username=session.get("username"), pacientes=[], busqueda=busqueda, estado_filtro=estado_filtro, tiene_pulsera=tiene_pulsera, total_resultados=0, buscado=buscado, orden=orden, siguiente=None)
 
     return render_template(
         "buscar_pacientes.html",
         username=session.get("username"),
         pacientes=pacientes,
-        busqueda=request.form.get("busqueda", "") if request.method == "POST" else "",
-        estado_filtro=request.form.get("estado", "") if request.method == "POST" else "",
-        tiene_pulsera=request.form.get("tiene_pulsera", "") if request.method == "POST" else "",
-        total_resultados=len(pacientes)
+        busqueda=busqueda,
+        estado_filtro=estado_filtro,
+        tiene_pulsera=tiene_pulsera,
+        total_resultados=total_resultados,
+        total_exacto=total_exacto,
+        buscado=buscado,
+        orden=orden,
+        siguiente=siguiente
     )
 
 
+# ================================
+#   AUTOCOMPLETADO DE PACIENTES (JSON)
+# ================================
+@app.route("/api/pacientes/sugerir")
+def sugerir_pacientes():
+    """
+    Sugerencias por prefijo para el buscador, servidas desde el índice en memoria.
+    Query params:
+        - q: texto escrito por el usuario
+        - limit: número máximo de sugerencias (default 8, max 20)
+    """
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+
+    q = request.args.get("q", "").strip()
+    try:
+        limite = min(max(int(request.args.get("limit", "8")), 1), 20)
+    except ValueError:
+        limite = 8
+
+    solo_ids = None
+    if session.get("tipo_usuario") == "familiar":
+        # El paciente asignado se cachea unos segundos para no consultar la BD en cada tecla
+        asignado = paciente_asignado_actual()
+        solo_ids = {asignado} if asignado else set()
+
+    try:
+        sugerencias = obtener_indice_pacientes().sugerir(q, limite, solo_ids) if q else []
+    except Exception as e:
+        print(f"Error en sugerencias de pacientes: {e}")
+        return jsonify({"error": "Error al obtener sugerencias"}), 500
+
+    return jsonify({"q": q, "sugerencias": sugerencias})
+
+
 # ================================
 #   AGREGAR PACIENTE CON PULSERA
 # ================================
@@ -903,6 +2700,8 @@ def agregar_paciente():
             conn.commit()
             cur.close()
             conn.close()
+            indice_pacientes.agregar(id_paciente, nombre, apellido_paterno, apellido_materno)
+            invalidar_version_datos()
             return redirect(url_for("ver_pacientes"))
 
         except ValueError:
@@ -933,6 +2732,14 @@ def agregar_paciente():
 # ================================
 #   HISTORIAL MÉDICO DE PACIENTE
 # ================================
+SQL_HISTORIAL_PACIENTE = """
+    SELECT id_historial, titulo, descripcion, creado_por, fecha
+    FROM historial_medico
+    WHERE id_paciente = %s
+    ORDER BY fecha DESC;
+"""
+
+
 @app.route("/historial-paciente/<int:id_paciente>")
 def historial_paciente(id_paciente):
     if not is_logged_in():
@@ -969,12 +2776,7 @@ def historial_paciente(id_paciente):
                                    paciente=None, entries=[])
 
         # Obtener historial médico del paciente
-        cur.execute("""
-            SELECT id_historial, titulo, descripcion, creado_por, fecha
-            FROM historial_medico
-            WHERE id_paciente = %s
-            ORDER BY fecha DESC;
-        """, (id_paciente,))
+        cur.execute(SQL_HISTORIAL_PACIENTE, (id_paciente,))
         entries_raw = cur.fetchall()
 
         # Preparar las entradas con permisos de edición
@@ -1218,26 +3020,49 @@ def semaforo():
 
     username = session.get('username')
     user_role = session.get('tipo_usuario', 'invitado')
+    orden, despues, por_pagina = leer_parametros_pagina()
 
-    pacientes = []
-
-    # Query similar a la usada en ver_pacientes/buscar_pacientes: lectura más reciente por pulsera
-    query = """
-        SELECT DISTINCT p.id_paciente, p.nombre, p.apellido_paterno, p.apellido_materno,
-               p.fecha_nacimiento, pu.id_pulsera, l.ritmo_cardiaco, l.temperatura_c,
-               l.esta_puesta, l.momento_lectura
-        FROM pacientes p
-        LEFT JOIN pulseras pu ON pu.id_paciente = p.id_paciente
-        LEFT JOIN LATERAL (
-            SELECT * FROM lecturas l
-            WHERE l.id_pulsera = pu.id_pulsera
-            ORDER BY l.momento_lectura DESC LIMIT 1
-        ) l ON TRUE
-        WHERE 1=1
-        ORDER BY p.id_paciente;
-    """
+    # Pulseras sin datos cambian con el tiempo aunque no lleguen lecturas: la revisión guarda sus
+    # eventos en `alertas`, que forma parte de la versión de datos (y del ETag)
+    try:
+        detector_pulseras.revisar()
+    except Exception as e:
+        print(f"Error en detector de pulseras: {e}")
+    try:
+        no_modificado = verificar_version()
+        if no_modificado is not None:
+            return no_modificado
+    except Exception as e:
+        print(f"Error al obtener versión de datos: {e}")
+
+    # Misma consulta que ver_pacientes/buscar_pacientes: lectura más reciente por pulsera
+    condiciones = []
+    params = {}
+    respaldo = None
+    dispositivos = {}
+    anomalos = obtener_pacientes_anomalos()
+    clasificador = obtener_clasificador()
+
+    def convertir(r):
+        nombre_completo = f"{r['nombre']} {r['apellido_paterno']} {r['apellido_materno']}".strip()
+        temp = r['temperatura_c']
+        ritmo = r['ritmo_cardiaco']
+        esta_puesta = r['esta_puesta']
+        estado = clasificador.estado(temp, ritmo, esta_puesta, r['id_paciente'])
 
-    params = []
+        return {
+            'id_paciente': r['id_paciente'],
+            'nombre': nombre_completo,
+            'id_pulsera': r['id_pulsera'] if r['id_pulsera'] is not None else 'Sin asignar',
+            'temperatura_c': temp,
+            'ritmo_cardiaco': ritmo,
+            'esta_puesta': esta_puesta,
+            'momento_lectura': r['momento_lectura'],
+            'estado': estado,
+            'estado_texto': TEXTO_ESTADO[estado],
+            'dispositivo': TEXTO_DISPOSITIVO.get(dispositivos.get(r['id_pulsera'])),
+            'tendencia': texto_tendencia(anomalos, r['id_paciente'])
+        }
 
     try:
         # Si es familiar, limitar a su paciente asignado
@@ -1245,53 +3070,652 @@ def semaforo():
             assigned = get_assigned_patient_id(username)
             if not assigned:
                 # usuario familiar sin asignación -> lista vacía
-                return render_template('semaforo.html', username=username, pacientes=[])
-            query = query.replace('\n        WHERE 1=1\n', '\n        WHERE p.id_paciente = %s\n')
-            params.append(int(assigned))
+                return render_template('semaforo.html', username=username, pacientes=[],
+                                       total_pacientes=0, orden=orden)
+            condiciones.append("p.id_paciente = %(asignado)s")
+            params['asignado'] = int(assigned)
+
+        total_pacientes = 1 if user_role == 'familiar' else obtener_indice_pacientes().total()
+        query, params = preparar_consulta_pacientes(condiciones, params, orden, despues, por_pagina)
+        respaldo = clave_respaldo_pagina(query, params)
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            dispositivos.update(detector_pulseras.estados(cur))
+            cur.close()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error en detector de pulseras: {e}")
+        pacientes = PaginaEnStream(conn, query, params, orden, por_pagina, convertir, respaldo)
+        # Primer lote antes de las cabeceras: con datos del respaldo o sin datos, sin ETag
+        if not pacientes.leer_primer_lote():
+            g.pop('etag', None)
+
+    except Exception as e:
+        # En caso de error de BD devolvemos lista vacía y lo registramos
+        print(f"Error en semaforo: {e}")
+        pacientes = PaginaEnStream.desde_respaldo(e, orden, por_pagina, respaldo)
+        if pacientes is not None:
+            g.pop('etag', None)
+            return render_template_stream('semaforo.html', username=username, pacientes=pacientes,
+                                          total_pacientes=total_pacientes, orden=orden)
+        return render_template('semaforo.html', username=username, pacientes=[],
+                               total_pacientes=0, orden=orden)
+
+    return render_template_stream('semaforo.html', username=username, pacientes=pacientes,
+                                  total_pacientes=total_pacientes, orden=orden)
+
+
+# ================================
+#   MOTOR DE ALERTAS DE SIGNOS VITALES
+# ================================
+# Cada lectura se evalúa al registrarse. Por paciente solo se guarda el estado de cada signo
+# (crítico o no y cuántas lecturas seguidas lleva en el otro estado) en `estado_alertas`, así que
+# evaluar es O(1) y no hace falta recorrer `lecturas` para saber quién está crítico. El estado se
+# lee con FOR UPDATE y se escribe en la transacción de la lectura: lo comparten todos los procesos
+# y un rollback de la lectura lo deja como estaba.
+#
+# - Umbrales de activación: los límites críticos del semáforo para el paciente (umbrales_vitales).
+# - Histéresis: una alerta activa solo se resuelve cuando el valor vuelve HISTERESIS_ALERTA dentro
+#   del rango, para que un valor que oscila sobre el umbral no active y resuelva en cada lectura.
+# - Antirrebote: hacen falta ALERTA_LECTURAS_CONFIRMACION lecturas seguidas para cambiar de estado.
+# Solo se registran los cambios de estado (eventos 'activada' / 'resuelta') en la tabla `alertas`;
+# el dashboard los consulta con /api/alertas?desde=<id_alerta>.
+ALERTA_LECTURAS_CONFIRMACION = int(os.getenv("ALERTA_LECTURAS_CONFIRMACION", "2"))
+# Segundos entre consultas del dashboard a /api/alertas?desde= (avisos emergentes)
+ALERTAS_INTERVALO_CONSULTA = int(os.getenv("ALERTAS_INTERVALO_CONSULTA", "10"))
+
+
+@app.context_processor
+def inject_intervalo_alertas():
+    return {'alertas_intervalo_ms': ALERTAS_INTERVALO_CONSULTA * 1000}
+
+
+# signo -> margen hacia dentro del rango no crítico que hay que recuperar para resolver
+HISTERESIS_ALERTA = {"temperatura": 0.5, "ritmo": 5.0}
+# signo -> (nombre, adjetivo crítico, unidad) para los mensajes
+TEXTOS_SIGNO = {"temperatura": ("Temperatura", "crítica", "°C"), "ritmo": ("Ritmo cardíaco", "crítico", "bpm")}
+
+# Crea las filas que falten y bloquea las del paciente hasta el commit de la lectura
+SQL_BLOQUEAR_ESTADO_ALERTAS = """
+    INSERT INTO estado_alertas (id_paciente, signo)
+    SELECT %(id_paciente)s, signo FROM unnest(%(signos)s::text[]) AS signo
+    ON CONFLICT (id_paciente, signo) DO NOTHING;
+    SELECT signo, critico, seguidas FROM estado_alertas
+    WHERE id_paciente = %(id_paciente)s
+    FOR UPDATE;
+"""
+
+
+class MotorAlertas:
+    """Evalúa cada lectura contra el estado de alerta del paciente (guardado en la BD)."""
+
+    def evaluar(self, cur, umbrales, id_paciente, id_lectura, temperatura_c, ritmo_cardiaco, esta_puesta):
+        """
+        Actualiza el estado del paciente con una lectura y devuelve los eventos que produce.
+        `cur` es el de la transacción que inserta la lectura y `umbrales` los del paciente
+        (ClasificadorVitales.umbrales, cargados antes de tomar la conexión). Las lecturas con la
+        pulsera quitada no cuentan (sus valores no son del paciente).
+        """
+        if not esta_puesta:
+            return []
+        try:
+            valores = {"temperatura": float(temperatura_c), "ritmo": float(ritmo_cardiaco)}
+        except (TypeError, ValueError):
+            return []
+
+        cur.execute(SQL_BLOQUEAR_ESTADO_ALERTAS, {"id_paciente": id_paciente, "signos": list(valores)})
+        estados = {signo: (critico, seguidas) for signo, critico, seguidas in cur.fetchall()}
+
+        eventos = []
+        cambios = []
+        for signo, valor in valores.items():
+            bajo, _, _, alto = umbrales[signo]
+            margen = HISTERESIS_ALERTA[signo]
+            critico, seguidas_antes = estados[signo]
+            if critico:
+                cambia = bajo + margen <= valor <= alto - margen
+            else:
+                cambia = valor < bajo or valor > alto
+            seguidas = seguidas_antes + 1 if cambia else 0
+            if seguidas >= ALERTA_LECTURAS_CONFIRMACION:
+                critico = not critico
+                seguidas = 0
+                nombre, adjetivo, unidad = TEXTOS_SIGNO[signo]
+                eventos.append({
+                    "id_paciente": id_paciente,
+                    "id_lectura": id_lectura,
+                    "signo": signo,
+                    "evento": "activada" if critico else "resuelta",
+                    "valor": valor,
+                    "mensaje": f"{nombre} {adjetivo if critico else 'de nuevo en rango'}: {valor:g} {unidad}",
+                })
+            if (critico, seguidas) != estados[signo]:
+                cambios.append((id_paciente, signo, critico, seguidas))
+        if cambios:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE estado_alertas e SET critico = v.critico, seguidas = v.seguidas
+                FROM (VALUES %s) AS v (id_paciente, signo, critico, seguidas)
+                WHERE e.id_paciente = v.id_paciente AND e.signo = v.signo;
+            """, cambios)
+        return eventos
+
+    def guardar(self, cur, eventos):
+        """Inserta los eventos en `alertas` (misma transacción que la lectura) y completa id/momento."""
+        for evento in eventos:
+            cur.execute("""
+                INSERT INTO alertas (id_paciente, id_lectura, signo, evento, valor, mensaje)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id_alerta, momento;
+            """, (evento["id_paciente"], evento["id_lectura"], evento["signo"], evento["evento"],
+                  evento["valor"], evento["mensaje"]))
+            id_alerta, momento = cur.fetchone()
+            evento["id_alerta"] = id_alerta
+            evento["momento"] = momento.isoformat() if momento else None
+
+    def estadisticas(self, cur):
+        cur.execute("SELECT COUNT(*) FILTER (WHERE critico), COUNT(DISTINCT id_paciente) FROM estado_alertas;")
+        activas, pacientes = cur.fetchone()
+        return {"alertas_activas": activas, "pacientes_con_estado": pacientes}
+
+
+motor_alertas = MotorAlertas()
+
+
+@app.route("/api/alertas")
+def listar_alertas():
+    """
+    Últimos eventos de alerta (personal).
+    Query params:
+        - limit: número máximo de eventos (default 50, max 500)
+        - activas=1: solo la última activación de cada signo que sigue sin resolverse
+        - desde: solo los eventos con id_alerta mayor, del más viejo al más nuevo (el dashboard
+          consulta así cada ALERTAS_INTERVALO_CONSULTA segundos con el último id que recibió)
+    """
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
 
+    try:
+        limit = min(max(int(request.args.get("limit", "50")), 1), 500)
+    except ValueError:
+        limit = 50
+    desde = request.args.get("desde", type=int)
+
+    try:
+        detector_pulseras.revisar()
+    except Exception as e:
+        print(f"Error en detector de pulseras: {e}")
+
+    try:
         conn = get_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        if params:
-            cur.execute(query, tuple(params))
+        if desde is not None:
+            cur.execute("""
+                SELECT a.*, p.nombre, p.apellido_paterno
+                FROM alertas a
+                JOIN pacientes p ON p.id_paciente = a.id_paciente
+                WHERE a.id_alerta > %s
+                ORDER BY a.id_alerta
+                LIMIT %s;
+            """, (desde, limit))
+        elif request.args.get("activas") == "1":
+            cur.execute("""
+                SELECT * FROM (
+                    SELECT DISTINCT ON (a.id_paciente, a.signo) a.*, p.nombre, p.apellido_paterno
+                    FROM alertas a
+                    JOIN pacientes p ON p.id_paciente = a.id_paciente
+                    ORDER BY a.id_paciente, a.signo, a.momento DESC, a.id_alerta DESC
+                ) ultimas
+                WHERE evento = 'activada'
+                ORDER BY momento DESC
+                LIMIT %s;
+            """, (limit,))
         else:
-            cur.execute(query)
-        rows = cur.fetchall()
+            cur.execute("""
+                SELECT a.*, p.nombre, p.apellido_paterno
+                FROM alertas a
+                JOIN pacientes p ON p.id_paciente = a.id_paciente
+                ORDER BY a.momento DESC, a.id_alerta DESC
+                LIMIT %s;
+            """, (limit,))
+        filas = cur.fetchall()
+        motor = motor_alertas.estadisticas(cur) if desde is None else None
         cur.close()
         conn.close()
+    except Exception as e:
+        print(f"Error al listar alertas: {e}")
+        return jsonify({"error": "Error interno al obtener alertas", "detalle": str(e)}), 500
+
+    return jsonify({
+        "alertas": [{
+            "id_alerta": f["id_alerta"],
+            "id_paciente": f["id_paciente"],
+            "paciente": f"{f['nombre']} {f['apellido_paterno']}",
+            "id_lectura": f["id_lectura"],
+            "signo": f["signo"],
+            "evento": f["evento"],
+            "valor": float(f["valor"]) if f["valor"] is not None else None,
+            "mensaje": f["mensaje"],
+            "momento": f["momento"].isoformat() if f["momento"] else None,
+        } for f in filas],
+        "motor": motor,
+    })
+
+
+# ================================
+#   DETECTOR DE PULSERAS SIN DATOS / RETIRADAS
+# ================================
+# La última lectura de cada pulsera vive en `pulsera_estado`, actualizada en la transacción de
+# cada lectura (O(1), sin recorrer `lecturas`), así que todos los procesos ven el mismo estado.
+# Las pulseras que superan PULSERA_MINUTOS_SIN_DATOS sin reportar las marca `revisar()`: corre
+# en las peticiones del personal (semáforo, dashboard, consulta de alertas) como mucho cada
+# PULSERA_INTERVALO_REVISION segundos por proceso, y solo un proceso a la vez (pg_try_advisory_lock).
+# No hay hilos en segundo plano: en serverless no sobrevivirían a la respuesta.
+PULSERA_MINUTOS_SIN_DATOS = int(os.getenv("PULSERA_MINUTOS_SIN_DATOS", "15"))
+PULSERA_INTERVALO_REVISION = float(os.getenv("PULSERA_INTERVALO_REVISION", "30"))
+
+TEXTO_DISPOSITIVO = {
+    "sin_datos": f"Sin datos hace más de {PULSERA_MINUTOS_SIN_DATOS} min",
+    "retirada": "Pulsera retirada",
+}
+
+# Última lectura de la pulsera (el estado anterior se lee antes con FOR UPDATE)
+SQL_REGISTRAR_PULSERA = """
+    INSERT INTO pulsera_estado (id_pulsera, ultima_lectura, esta_puesta, sin_datos)
+    VALUES (%(id_pulsera)s, %(momento)s, %(esta_puesta)s, FALSE)
+    ON CONFLICT (id_pulsera) DO UPDATE SET
+        ultima_lectura = GREATEST(pulsera_estado.ultima_lectura, EXCLUDED.ultima_lectura),
+        esta_puesta = EXCLUDED.esta_puesta,
+        sin_datos = FALSE;
+"""
+
+# Pulseras que vencieron su plazo desde la última revisión (las marca y las devuelve una sola vez)
+SQL_MARCAR_SIN_DATOS = """
+    UPDATE pulsera_estado e SET sin_datos = TRUE
+    FROM pulseras pu
+    WHERE pu.id_pulsera = e.id_pulsera
+      AND NOT e.sin_datos
+      AND e.ultima_lectura < NOW() - make_interval(secs => %s)
+    RETURNING e.id_pulsera, pu.id_paciente;
+"""
+
+# Estado de las pulseras asignadas. Una pulsera que nunca reportó, o que venció y todavía no se
+# revisó, ya se muestra sin datos.
+SQL_ESTADO_PULSERAS = """
+    SELECT pu.id_pulsera,
+           e.ultima_lectura IS NULL OR e.sin_datos
+               OR e.ultima_lectura < NOW() - make_interval(secs => %(plazo)s) AS sin_datos,
+           COALESCE(e.esta_puesta = FALSE, FALSE) AS retirada
+    FROM pulseras pu
+    LEFT JOIN pulsera_estado e ON e.id_pulsera = pu.id_pulsera
+    WHERE pu.id_paciente IS NOT NULL;
+"""
+
+class DetectorPulseras:
+    """Estado 'sin datos' / 'retirada' de cada pulsera, con eventos en cada cambio."""
+
+    def __init__(self, minutos_sin_datos):
+        self.plazo = minutos_sin_datos * 60
+        self._lock = threading.Lock()
+        self._proxima_revision = 0.0  # solo para no intentar la revisión en cada petición
+
+    def _evento(self, id_pulsera, id_paciente, evento, mensaje, id_lectura=None):
+        return {
+            "id_paciente": id_paciente,
+            "id_pulsera": id_pulsera,
+            "id_lectura": id_lectura,
+            "signo": "pulsera",
+            "evento": evento,
+            "valor": None,
+            "mensaje": f"Pulsera {id_pulsera}: {mensaje}",
+        }
+
+    def registrar(self, cur, id_pulsera, id_paciente, id_lectura, momento_lectura, esta_puesta):
+        """
+        Lectura recibida (con el cursor de su transacción): actualiza pulsera_estado y devuelve
+        eventos de reanudación / retiro / colocación.
+        """
+        cur.execute("SELECT esta_puesta, sin_datos FROM pulsera_estado WHERE id_pulsera = %s FOR UPDATE;",
+                    (id_pulsera,))
+        puesta_antes, sin_datos_antes = cur.fetchone() or (None, False)
+        cur.execute(SQL_REGISTRAR_PULSERA, {"id_pulsera": id_pulsera, "momento": momento_lectura,
+                                            "esta_puesta": esta_puesta})
+        eventos = []
+        if sin_datos_antes:
+            eventos.append(self._evento(id_pulsera, id_paciente, "reanudada", "volvió a enviar datos", id_lectura))
+        if not esta_puesta and puesta_antes is not False:
+            eventos.append(self._evento(id_pulsera, id_paciente, "retirada", "retirada", id_lectura))
+        elif esta_puesta and puesta_antes is False:
+            eventos.append(self._evento(id_pulsera, id_paciente, "colocada", "colocada de nuevo", id_lectura))
+        return eventos
+
+    def revisar(self):
+        """
+        Marca las pulseras que vencieron su plazo y guarda sus eventos 'sin_datos'. Usa su propia
+        conexión: llamarla antes de tomar la de la ruta. Si otro proceso está revisando, no espera.
+        """
+        ahora = time.monotonic()
+        with self._lock:
+            if ahora < self._proxima_revision:
+                return
+            self._proxima_revision = ahora + PULSERA_INTERVALO_REVISION
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('detector_pulseras'));")
+            if not cur.fetchone()[0]:
+                return
+            cur.execute(SQL_MARCAR_SIN_DATOS, (self.plazo,))
+            eventos = [self._evento(id_pulsera, id_paciente, "sin_datos", TEXTO_DISPOSITIVO["sin_datos"].lower())
+                       for id_pulsera, id_paciente in cur.fetchall() if id_paciente is not None]
+            motor_alertas.guardar(cur, eventos)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def estados(self, cur):
+        """id_pulsera -> 'sin_datos' | 'retirada' de las pulseras asignadas con algún problema."""
+        cur.execute(SQL_ESTADO_PULSERAS, {"plazo": self.plazo})
+        resultado = {}
+        for fila in cur.fetchall():
+            id_pulsera, sin_datos, retirada = fila[0], fila[1], fila[2]
+            if sin_datos:
+                resultado[id_pulsera] = "sin_datos"
+            elif retirada:
+                resultado[id_pulsera] = "retirada"
+        return resultado
+
+    def resumen(self, cur):
+        """Conteo de pulseras asignadas sin datos y retiradas."""
+        estados = list(self.estados(cur).values())
+        return {"sin_datos": estados.count("sin_datos"), "retiradas": estados.count("retirada")}
 
-        for r in rows:
-            nombre_completo = f"{r['nombre']} {r['apellido_paterno']} {r['apellido_materno']}".strip()
-            temp = r['temperatura_c']
-            ritmo = r['ritmo_cardiaco']
-            esta_puesta = r['esta_puesta']
-
-            estado = 'azul'
-            if temp is not None and ritmo is not None:
-                if (temp < 35 or temp > 39.5) or (ritmo < 40 or ritmo > 130):
-                    estado = 'rojo'
-                elif (36 <= temp <= 37.5) and (60 <= ritmo <= 100) and esta_puesta:
-                    estado = 'verde'
-                else:
-                    estado = 'azul'
-
-            pacientes.append({
-                'id_paciente': r['id_paciente'],
-                'nombre': nombre_completo,
-                'id_pulsera': r['id_pulsera'] if r['id_pulsera'] is not None else 'Sin asignar',
-                'temperatura_c': temp,
-                'ritmo_cardiaco': ritmo,
-                'esta_puesta': esta_puesta,
-                'momento_lectura': r['momento_lectura'],
-                'estado': estado,
-                'estado_texto': {'rojo': 'Crítico', 'verde': 'Estable', 'azul': 'Advertencia'}[estado]
-            })
 
+detector_pulseras = DetectorPulseras(PULSERA_MINUTOS_SIN_DATOS)
+
+
+# ================================
+#   LÍNEA BASE POR PACIENTE (TENDENCIAS ANÓMALAS)
+# ================================
+# Los umbrales fijos no ven derivas lentas (p. ej. un ritmo que sube de 60 a 95 en dos días sin
+# cruzar nunca 130). Por paciente y signo se mantienen dos medias móviles exponenciales con
+# decaimiento por tiempo (no por número de lecturas, que llegan a intervalos irregulares):
+# - rápida (LINEA_BASE_HORAS_RAPIDA): el nivel actual
+# - lenta (LINEA_BASE_HORAS_LENTA): la línea base del paciente
+# y la varianza del ruido de corto plazo (lectura contra la media rápida), que una deriva lenta no
+# infla. Son medias ponderadas (suma de pesos exp(-edad/τ) guardada aparte), no recursiones
+# iniciadas en la primera lectura: así un historial corto no arrastra el valor inicial. z = (rápida - lenta) / desviación del ruido; la tendencia es anómala si |z| supera
+# LINEA_BASE_Z_ACTIVAR y deja de serlo bajo LINEA_BASE_Z_RESOLVER (histéresis).
+# Se actualiza en O(1) por lectura y se guarda en `lineas_base_vitales`; recalcular_lineas_base()
+# la reconstruye desde el historial con NumPy (ver recalcular_lineas_base.py).
+LINEA_BASE_HORAS_RAPIDA = float(os.getenv("LINEA_BASE_HORAS_RAPIDA", "2"))
+LINEA_BASE_HORAS_LENTA = float(os.getenv("LINEA_BASE_HORAS_LENTA", "48"))
+LINEA_BASE_Z_ACTIVAR = float(os.getenv("LINEA_BASE_Z_ACTIVAR", "3"))
+LINEA_BASE_Z_RESOLVER = float(os.getenv("LINEA_BASE_Z_RESOLVER", "2"))
+# Lecturas antes de evaluar (la línea base de un paciente nuevo aún no es representativa)
+LINEA_BASE_MIN_LECTURAS = int(os.getenv("LINEA_BASE_MIN_LECTURAS", "20"))
+# Días de historial para el recálculo (más allá, el peso en la media lenta es despreciable)
+LINEA_BASE_DIAS_HISTORIA = int(os.getenv("LINEA_BASE_DIAS_HISTORIA", "14"))
+# Pacientes por consulta y transacción en el recálculo: acota la memoria y la duración de cada
+# consulta (statement_timeout de "fondo") aunque haya miles de pacientes
+LINEA_BASE_LOTE_PACIENTES = int(os.getenv("LINEA_BASE_LOTE_PACIENTES", "100"))
+# Desviación mínima del ruido por signo, para no disparar z con series casi constantes
+DESVIACION_MINIMA_SIGNO = {"temperatura": 0.2, "ritmo": 3.0}
+# Segundos que se reutiliza el conjunto de pacientes con tendencia anómala en las vistas
+PACIENTES_ANOMALOS_TTL = int(os.getenv("PACIENTES_ANOMALOS_TTL", "30"))
+
+
+def _segundos(momento):
+    """Fecha de la BD (sin zona = UTC) a segundos epoch."""
+    if momento.tzinfo is None:
+        momento = momento.replace(tzinfo=timezone.utc)
+    return momento.timestamp()
+
+
+class LineaBase:
+    __slots__ = ("rapida", "lenta", "peso_rapida", "peso_lenta", "varianza", "n", "ultima", "anomalo", "z")
+
+    def __init__(self, rapida, lenta, peso_rapida, peso_lenta, varianza, n, ultima, anomalo=False, z=0.0):
+        self.rapida = rapida
+        self.lenta = lenta
+        self.peso_rapida = peso_rapida  # suma de pesos de la media rápida
+        self.peso_lenta = peso_lenta  # suma de pesos de la media lenta y de la varianza
+        self.varianza = varianza
+        self.n = n
+        self.ultima = ultima  # segundos epoch de la última lectura incorporada
+        self.anomalo = anomalo
+        self.z = z
+
+
+def calcular_z(linea, signo):
+    desviacion = max(math.sqrt(linea.varianza), DESVIACION_MINIMA_SIGNO[signo])
+    return (linea.rapida - linea.lenta) / desviacion
+
+
+def evaluar_anomalia(linea, signo):
+    """Actualiza z y el estado anómalo (con histéresis). Devuelve True si el estado cambió."""
+    linea.z = calcular_z(linea, signo)
+    if linea.n < LINEA_BASE_MIN_LECTURAS:
+        return False
+    anterior = linea.anomalo
+    if linea.anomalo:
+        linea.anomalo = abs(linea.z) >= LINEA_BASE_Z_RESOLVER
+    else:
+        linea.anomalo = abs(linea.z) > LINEA_BASE_Z_ACTIVAR
+    return linea.anomalo != anterior
+
+
+SQL_GUARDAR_LINEAS_BASE = """
+    INSERT INTO lineas_base_vitales
+        (id_paciente, signo, rapida, lenta, peso_rapida, peso_lenta, varianza, n, ultima_lectura, anomalo, z)
+    VALUES %s
+    ON CONFLICT (id_paciente, signo) DO UPDATE SET
+        rapida = EXCLUDED.rapida, lenta = EXCLUDED.lenta,
+        peso_rapida = EXCLUDED.peso_rapida, peso_lenta = EXCLUDED.peso_lenta, varianza = EXCLUDED.varianza,
+        n = EXCLUDED.n, ultima_lectura = EXCLUDED.ultima_lectura,
+        anomalo = EXCLUDED.anomalo, z = EXCLUDED.z, actualizado = NOW();
+"""
+
+
+def fila_linea_base(id_paciente, signo, linea, momento_lectura):
+    return (id_paciente, signo, linea.rapida, linea.lenta, linea.peso_rapida, linea.peso_lenta,
+            linea.varianza, linea.n, momento_lectura, linea.anomalo, linea.z)
+
+
+class LineasBaseVitales:
+    """
+    Líneas base por (paciente, signo), guardadas en `lineas_base_vitales`. Cada lectura lee las
+    filas del paciente con FOR UPDATE en la transacción de la ingesta y las actualiza ahí mismo:
+    dos workers con lecturas del mismo paciente se turnan en lugar de pisarse el estado.
+    """
+
+    def _bloquear(self, cur, id_paciente):
+        cur.execute("""
+            SELECT signo, rapida, lenta, peso_rapida, peso_lenta, varianza, n, ultima_lectura, anomalo, z
+            FROM lineas_base_vitales
+            WHERE id_paciente = %s
+            FOR UPDATE;
+        """, (id_paciente,))
+        return {fila[0]: LineaBase(*(float(v) for v in fila[1:6]), fila[6], _segundos(fila[7]), fila[8],
+                                   float(fila[9] or 0))
+                for fila in cur.fetchall()}
+
+    def actualizar(self, cur, id_paciente, id_lectura, momento_lectura, temperatura_c, ritmo_cardiaco, esta_puesta):
+        """
+        Incorpora una lectura (O(1)), guarda la línea base y devuelve eventos de tendencia
+        ('activada' / 'resuelta'). `cur` es el de la transacción que inserta la lectura.
+        Lecturas con la pulsera quitada no se incorporan.
+        """
+        if not esta_puesta or momento_lectura is None:
+            return []
+        try:
+            valores = {"temperatura": float(temperatura_c), "ritmo": float(ritmo_cardiaco)}
+        except (TypeError, ValueError):
+            return []
+
+        lineas = self._bloquear(cur, id_paciente)
+        ahora = _segundos(momento_lectura)
+        eventos = []
+        for signo, x in valores.items():
+            linea = lineas.get(signo)
+            if linea is None:
+                # Primera lectura del signo (no hay fila que bloquear: si otra lectura simultánea
+                # también la crea, queda la última de las dos)
+                lineas[signo] = LineaBase(x, x, 1.0, 1.0, DESVIACION_MINIMA_SIGNO[signo] ** 2, 1, ahora)
+                continue
+            dt_horas = max(ahora - linea.ultima, 0.0) / 3600
+            linea.peso_rapida = linea.peso_rapida * math.exp(-dt_horas / LINEA_BASE_HORAS_RAPIDA) + 1
+            linea.peso_lenta = linea.peso_lenta * math.exp(-dt_horas / LINEA_BASE_HORAS_LENTA) + 1
+            residuo = x - linea.rapida
+            linea.varianza += (residuo * residuo - linea.varianza) / linea.peso_lenta
+            linea.rapida += residuo / linea.peso_rapida
+            linea.lenta += (x - linea.lenta) / linea.peso_lenta
+            linea.n += 1
+            linea.ultima = max(ahora, linea.ultima)
+            if evaluar_anomalia(linea, signo):
+                nombre, _, unidad = TEXTOS_SIGNO[signo]
+                direccion = "al alza" if linea.rapida > linea.lenta else "a la baja"
+                eventos.append({
+                    "id_paciente": id_paciente,
+                    "id_lectura": id_lectura,
+                    "signo": f"tendencia_{signo}",
+                    "evento": "activada" if linea.anomalo else "resuelta",
+                    "valor": round(linea.rapida, 1),
+                    "mensaje": (f"{nombre}: tendencia anómala {direccion} "
+                                f"({linea.lenta:.1f} → {linea.rapida:.1f} {unidad})" if linea.anomalo else
+                                f"{nombre}: tendencia de nuevo estable ({linea.rapida:.1f} {unidad})"),
+                })
+        filas = [fila_linea_base(id_paciente, signo, l, momento_lectura) for signo, l in lineas.items()]
+
+        psycopg2.extras.execute_values(cur, SQL_GUARDAR_LINEAS_BASE, filas)
+        if eventos:
+            cache_pacientes_anomalos.invalidar()
+        return eventos
+
+
+lineas_base = LineasBaseVitales()
+cache_pacientes_anomalos = CacheTTL("pacientes_anomalos", max_entradas=1, ttl=PACIENTES_ANOMALOS_TTL)
+
+
+def obtener_pacientes_anomalos(cur=None):
+    """{id_paciente: [signos]} con tendencia anómala; compartido entre procesos vía la tabla."""
+    def consultar():
+        with cursor_de(cur) as consulta:
+            consulta.execute("SELECT id_paciente, signo FROM lineas_base_vitales WHERE anomalo;")
+            anomalos = defaultdict(list)
+            for id_paciente, signo in consulta.fetchall():
+                anomalos[id_paciente].append(signo)
+            return dict(anomalos)
+    try:
+        return cache_pacientes_anomalos.obtener_o_calcular("anomalos", consultar)
     except Exception as e:
-        # En caso de error de BD devolvemos lista vacía y lo registramos
-        print(f"Error en semaforo: {e}")
-        pacientes = []
+        print(f"Error al obtener tendencias anómalas: {e}")
+        return {}
+
 
-    return render_template('semaforo.html', username=username, pacientes=pacientes)
+def texto_tendencia(anomalos, id_paciente):
+    """'Tendencia anómala: temperatura, ritmo' para las vistas, o None."""
+    signos = anomalos.get(id_paciente)
+    if not signos:
+        return None
+    return "Tendencia anómala: " + ", ".join(TEXTOS_SIGNO[s][0].lower() for s in sorted(signos))
+
+
+def calcular_lineas_base_numpy(tiempos, valores, signo):
+    """
+    Línea base final de una serie (tiempos en segundos epoch, ordenados) de forma vectorizada.
+
+    Cada media es sum(w_i * x_i) / sum(w_i) con w_i = exp(-(t_k - t_i)/τ): sumas acumuladas escaladas
+    por exp(t_i/τ), con t relativo a la primera lectura para que los exponentes queden acotados
+    dentro de LINEA_BASE_DIAS_HISTORIA. La varianza usa los mismos pesos que la media lenta, con la
+    desviación mínima como valor inicial. Da el mismo resultado que aplicar
+    LineasBaseVitales.actualizar lectura por lectura.
+    """
+    import numpy as np
+
+    t = (np.asarray(tiempos, dtype=float) - tiempos[0]) / 3600
+    x = np.asarray(valores, dtype=float)
+
+    def media(tau, serie):
+        pesos = np.exp(t / tau)
+        peso = np.cumsum(pesos)
+        return np.cumsum(serie * pesos) / peso, peso * np.exp(-t / tau)
+
+    rapida, peso_rapida = media(LINEA_BASE_HORAS_RAPIDA, x)
+    lenta, peso_lenta = media(LINEA_BASE_HORAS_LENTA, x)
+    residuos = np.empty_like(x)
+    residuos[0] = DESVIACION_MINIMA_SIGNO[signo]
+    residuos[1:] = x[1:] - rapida[:-1]
+    varianza, _ = media(LINEA_BASE_HORAS_LENTA, residuos ** 2)
+
+    linea = LineaBase(float(rapida[-1]), float(lenta[-1]), float(peso_rapida[-1]), float(peso_lenta[-1]),
+                      float(varianza[-1]), int(len(x)), float(tiempos[-1]))
+    evaluar_anomalia(linea, signo)
+    return linea
+
+
+def recalcular_lineas_base(id_paciente=None):
+    """
+    Reconstruye las líneas base desde `lecturas` (últimos LINEA_BASE_DIAS_HISTORIA días) con NumPy.
+    Para cargar datos históricos, tras cambiar los parámetros o si la tabla quedó desfasada.
+    Recorre los pacientes en lotes de LINEA_BASE_LOTE_PACIENTES: una consulta y un commit por lote.
+    Devuelve la cantidad de líneas guardadas.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        filtro = "AND id_paciente = %s" if id_paciente is not None else ""
+        cur.execute(f"""
+            SELECT DISTINCT id_paciente FROM pulseras
+            WHERE id_paciente IS NOT NULL {filtro}
+            ORDER BY id_paciente;
+        """, (id_paciente,) if id_paciente is not None else None)
+        pacientes = [fila[0] for fila in cur.fetchall()]
+        conn.commit()
+
+        guardadas = 0
+        for inicio in range(0, len(pacientes), LINEA_BASE_LOTE_PACIENTES):
+            guardadas += _recalcular_lote_lineas_base(cur, pacientes[inicio:inicio + LINEA_BASE_LOTE_PACIENTES])
+            conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+    cache_pacientes_anomalos.invalidar()
+    return guardadas
+
+
+def _recalcular_lote_lineas_base(cur, pacientes):
+    cur.execute("""
+        SELECT pu.id_paciente, l.momento_lectura, l.temperatura_c, l.ritmo_cardiaco
+        FROM lecturas l
+        JOIN pulseras pu ON pu.id_pulsera = l.id_pulsera
+        WHERE pu.id_paciente = ANY(%(pacientes)s)
+          AND l.momento_lectura > NOW() - make_interval(days => %(dias)s)
+          AND l.esta_puesta
+          AND l.temperatura_c IS NOT NULL AND l.ritmo_cardiaco IS NOT NULL
+        ORDER BY pu.id_paciente, l.momento_lectura;
+    """, {"dias": LINEA_BASE_DIAS_HISTORIA, "pacientes": pacientes})
+
+    series = defaultdict(lambda: ([], [], []))
+    ultima_por_paciente = {}
+    for id_p, momento, temp, ritmo in cur.fetchall():
+        tiempos, temps, ritmos = series[id_p]
+        tiempos.append(_segundos(momento))
+        temps.append(float(temp))
+        ritmos.append(float(ritmo))
+        ultima_por_paciente[id_p] = momento
+
+    filas = []
+    for id_p, (tiempos, temps, ritmos) in series.items():
+        for signo, valores in (("temperatura", temps), ("ritmo", ritmos)):
+            linea = calcular_lineas_base_numpy(tiempos, valores, signo)
+            filas.append(fila_linea_base(id_p, signo, linea, ultima_por_paciente[id_p]))
+
+    if filas:
+        psycopg2.extras.execute_values(cur, SQL_GUARDAR_LINEAS_BASE, filas, page_size=500)
+    return len(filas)
 
 
 # ================================
@@ -1322,10 +3746,18 @@ def registrar_lectura(id_pulsera):
         if ritmo_cardiaco is None or temperatura_c is None or esta_puesta is None:
             return {"error": "Faltan campos requeridos: ritmo_cardiaco, temperatura_c, esta_puesta"}, 400
 
-        # Verificar que la pulsera existe
+        # Umbrales antes de tomar la conexión: si hay que recargarlos usan otra del pool
+        clasificador = obtener_clasificador()
+
+        # Verificar que la pulsera existe (con el nombre del paciente para los eventos de alerta)
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("SELECT id_paciente FROM pulseras WHERE id_pulsera = %s;", (id_pulsera,))
+        cur.execute("""
+            SELECT pu.id_paciente, concat_ws(' ', p.nombre, p.apellido_paterno, p.apellido_materno)
+            FROM pulseras pu
+            LEFT JOIN pacientes p ON p.id_paciente = pu.id_paciente
+            WHERE pu.id_pulsera = %s;
+        """, (id_pulsera,))
         pulsera = cur.fetchone()
 
         if not pulsera:
@@ -1344,15 +3776,35 @@ def registrar_lectura(id_pulsera):
         id_lectura = result[0]
         momento_lectura = result[1]
 
+        # Estado del semáforo con los umbrales del paciente
+        estado = clasificador.estado(float(temperatura_c), float(ritmo_cardiaco), esta_puesta, pulsera[0])
+
+        # Alertas: cambios de estado del paciente, guardados junto con la lectura
+        eventos_alerta = []
+        if pulsera[0] is not None:
+            eventos_alerta = motor_alertas.evaluar(cur, clasificador.umbrales(pulsera[0]), pulsera[0], id_lectura,
+                                                   temperatura_c, ritmo_cardiaco, esta_puesta)
+            eventos_alerta += detector_pulseras.registrar(cur, id_pulsera, pulsera[0], id_lectura,
+                                                          momento_lectura, bool(esta_puesta))
+            eventos_alerta += lineas_base.actualizar(cur, pulsera[0], id_lectura, momento_lectura,
+                                                     temperatura_c, ritmo_cardiaco, esta_puesta)
+            motor_alertas.guardar(cur, eventos_alerta)
+            for evento in eventos_alerta:
+                evento["paciente"] = pulsera[1]
+
         conn.commit()
         cur.close()
         conn.close()
+        invalidar_version_datos()
+        invalidar_contexto_chatbot(pulsera[0])
 
         return {
             "success": True,
             "id_lectura": id_lectura,
             "id_pulsera": id_pulsera,
             "momento_lectura": momento_lectura.isoformat() if momento_lectura else None,
+            "estado": estado,
+            "alertas": [{"signo": e["signo"], "evento": e["evento"]} for e in eventos_alerta],
             "mensaje": "Lectura registrada correctamente"
         }, 201
 
@@ -1361,6 +3813,15 @@ def registrar_lectura(id_pulsera):
         return {"error": "Error interno al procesar la lectura", "detalle": str(e)}, 500
 
 
+SQL_LECTURAS_PULSERA = """
+    SELECT id_lectura, ritmo_cardiaco, temperatura_c, esta_puesta, momento_lectura
+    FROM lecturas
+    WHERE id_pulsera = %s
+    ORDER BY momento_lectura DESC
+    LIMIT %s;
+"""
+
+
 @app.route("/pulsera/<int:id_pulsera>/lecturas", methods=["GET"])
 def obtener_lecturas(id_pulsera):
     """
@@ -1383,6 +3844,17 @@ def obtener_lecturas(id_pulsera):
         conn = get_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+        # Versión propia de la pulsera: su lectura más reciente (un solo salto por índice)
+        cur.execute(SQL_VERSION_PULSERA, (id_pulsera,))
+        ultima = cur.fetchone()
+        version = f"{ultima['id_lectura']}" if ultima else "sin-lecturas"
+        no_modificado = verificar_version(version=version, cur=cur,
+                                          ultima_modificacion=_como_utc(ultima['momento_lectura']) if ultima else None)
+        if no_modificado is not None:
+            cur.close()
+            conn.close()
+            return no_modificado
+
         # Verificar que la pulsera existe
         cur.execute("SELECT id_paciente FROM pulseras WHERE id_pulsera = %s;", (id_pulsera,))
         pulsera = cur.fetchone()
@@ -1390,16 +3862,11 @@ def obtener_lecturas(id_pulsera):
         if not pulsera:
             cur.close()
             conn.close()
+            g.pop('etag', None)
             return {"error": f"Pulsera {id_pulsera} no encontrada"}, 404
 
         # Obtener lecturas
-        cur.execute("""
-            SELECT id_lectura, ritmo_cardiaco, temperatura_c, esta_puesta, momento_lectura
-            FROM lecturas
-            WHERE id_pulsera = %s
-            ORDER BY momento_lectura DESC
-            LIMIT %s;
-        """, (id_pulsera, limit))
+        cur.execute(SQL_LECTURAS_PULSERA, (id_pulsera, limit))
 
         lecturas_raw = cur.fetchall()
         cur.close()
@@ -1428,40 +3895,94 @@ def obtener_lecturas(id_pulsera):
 
 
 # ================================
-#   DEBUG/TESTING ENDPOINTS
+#   SALUD Y DEBUG/TESTING ENDPOINTS
 # ================================
+# El balanceador consulta estos endpoints continuamente: ninguno recorre tablas.
+# Tiempo máximo (segundos) para obtener conexión y ejecutar SELECT 1 en /health/ready
+SALUD_TIMEOUT = float(os.getenv("SALUD_TIMEOUT", "1"))
+# Segundos que se reutilizan las estadísticas de /debug-conn
+ESTADISTICAS_BD_TTL = float(os.getenv("ESTADISTICAS_BD_TTL", "60"))
+TABLAS_ESTADISTICAS = ("pacientes", "pulseras", "lecturas")
+
+# Filas estimadas por el último ANALYZE / autovacuum (reltuples), sumando las particiones;
+# -1 (nunca analizada) cuenta como 0
+SQL_FILAS_ESTIMADAS = """
+    SELECT t.tabla, COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::bigint
+    FROM unnest(%s::text[]) AS t(tabla)
+    LEFT JOIN pg_class c
+           ON c.relkind <> 'p'
+          AND (c.oid = to_regclass(t.tabla)
+               OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(t.tabla)))
+    GROUP BY t.tabla;
+"""
+
+cache_estadisticas_bd = CacheTTL("estadisticas_bd", max_entradas=1, ttl=ESTADISTICAS_BD_TTL)
+
+
+def comprobar_base_datos():
+    """SELECT 1 con una conexión del pool; lanza excepción si no responde dentro de SALUD_TIMEOUT."""
+    conn = obtener_pool().obtener(espera=SALUD_TIMEOUT)
+    try:
+        cur = conn.cursor()
+        # SET LOCAL: el límite se descarta cuando la conexión vuelve al pool (rollback)
+        cur.execute("SET LOCAL statement_timeout = %s;", (int(SALUD_TIMEOUT * 1000),))
+        cur.execute("SELECT 1;")
+        cur.fetchone()
+        cur.close()
+    finally:
+        conn.close()
 
-@app.route("/debug-conn")
-def debug_conn():
-    """Endpoint para probar la conexión a la base de datos"""
+
+def calcular_estadisticas_bd():
+    conn = get_connection()
     try:
-        conn = get_connection()
         cur = conn.cursor()
         cur.execute("SELECT version();")
         version = cur.fetchone()[0]
+        cur.execute(SQL_FILAS_ESTIMADAS, (list(TABLAS_ESTADISTICAS),))
+        filas = dict(cur.fetchall())
+        cur.close()
+    finally:
+        conn.close()
+    return {
+        "database_version": version,
+        "estadisticas": {tabla: filas.get(tabla, 0) for tabla in TABLAS_ESTADISTICAS},
+        "actualizado": datetime.now(timezone.utc).isoformat(),
+    }
 
-        # Contar registros en tablas principales
-        cur.execute("SELECT COUNT(*) FROM pacientes;")
-        count_pacientes = cur.fetchone()[0]
 
-        cur.execute("SELECT COUNT(*) FROM pulseras;")
-        count_pulseras = cur.fetchone()[0]
+@app.route("/health")
+def salud():
+    """Liveness: el proceso atiende requests. No toca la base de datos."""
+    return {"status": "OK"}, 200
 
-        cur.execute("SELECT COUNT(*) FROM lecturas;")
-        count_lecturas = cur.fetchone()[0]
 
-        cur.close()
-        conn.close()
+@app.route("/health/ready")
+def salud_lista():
+    """Readiness: hay una conexión del pool disponible y la base responde a SELECT 1 a tiempo."""
+    inicio = time.perf_counter()
+    try:
+        comprobar_base_datos()
+    except Exception as e:
+        print(f"Error en readiness: {e}")
+        return {"status": "ERROR", "error": str(e)}, 503
+    return {
+        "status": "OK",
+        "latencia_ms": round((time.perf_counter() - inicio) * 1000, 1),
+        "pool": obtener_pool().estadisticas(),
+    }, 200
 
-        return {
-            "status": "OK",
-            "database_version": version,
-            "estadisticas": {
-                "pacientes": count_pacientes,
-                "pulseras": count_pulseras,
-                "lecturas": count_lecturas
-            }
-        }, 200
+
+@app.route("/debug-conn")
+def debug_conn():
+    """
+    Endpoint para probar la conexión a la base de datos.
+    Los conteos son estimaciones del catálogo (pg_class.reltuples), no COUNT(*), y se guardan
+    ESTADISTICAS_BD_TTL segundos.
+    """
+    try:
+        datos = cache_estadisticas_bd.obtener_o_calcular("estadisticas", calcular_estadisticas_bd)
+        return {"status": "OK", "estimado": True, **datos}, 200
 
     except Exception as e:
         return {
@@ -1480,45 +4001,188 @@ def sensor():
 #   CHATBOT CON IA (GROQ)
 # ================================
 
-@app.route("/api/chatbot", methods=["POST"])
-def chatbot_api():
-    """API del chatbot - recibe mensaje y devuelve respuesta de IA"""
-    if not is_logged_in():
-        return jsonify({"error": "No autorizado"}), 401
+# Modelo y límites de la llamada al LLM
+MODELO_CHATBOT = os.getenv("MODELO_CHATBOT", "llama-3.3-70b-versatile")  # Modelo rápido y capaz
+# Tiempo máximo para conectar y para toda la respuesta del LLM (segundos)
+LLM_TIMEOUT_CONEXION = float(os.getenv("LLM_TIMEOUT_CONEXION", "5"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
 
-    try:
-        data = request.get_json()
-        user_message = data.get("message", "").strip()
+_cliente_llm = None
+_cliente_llm_lock = threading.Lock()
 
-        if not user_message:
-            return jsonify({"error": "Mensaje vacío"}), 400
 
-        # Obtener información del usuario
-        username = session.get("username")
-        user_role = session.get("user_role", "familiar")
+def obtener_cliente_llm():
+    """
+    Cliente de Groq compartido por todo el proceso (o None si falta GROQ_API_KEY).
 
-        # Obtener contexto de la base de datos para la IA
-        conn = get_db_connection()
+    Reutilizarlo mantiene abiertas las conexiones HTTP entre mensajes. GROQ_BASE_URL permite
+    apuntar a un servidor compatible local (ver stub_llm.py) para probar sin red.
+    groq (con pydantic y httpx) se importa recién aquí: es la mitad del tiempo de importar app.py
+    y solo lo necesita el chatbot, no cada arranque en frío de la función serverless.
+    """
+    global _cliente_llm
+    if _cliente_llm is None:
+        groq_api_key = os.getenv("GROQ_API_KEY")
+        if not groq_api_key:
+            return None
+        with _cliente_llm_lock:
+            if _cliente_llm is None:
+                import httpx
+                from groq import Groq
+                _cliente_llm = Groq(
+                    api_key=groq_api_key,
+                    base_url=os.getenv("GROQ_BASE_URL") or None,
+                    timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_TIMEOUT_CONEXION),
+                    max_retries=1,
+                )
+    return _cliente_llm
+
+
+# ---- Historial de conversación ----
+# Se guarda en la BD (conversaciones_chatbot), no en la cookie de sesión ni en memoria del proceso:
+# la pregunta siguiente puede llegar a otro worker o instancia. Acotado en mensajes y con vencimiento.
+MAX_MENSAJES_HISTORIAL = int(os.getenv("MAX_MENSAJES_HISTORIAL", "20"))
+HISTORIAL_CHATBOT_TTL = int(os.getenv("HISTORIAL_CHATBOT_TTL", "3600"))
+# Tokens (aprox.) de historial que se envían al modelo; el resto se resume en una línea
+PRESUPUESTO_TOKENS_HISTORIAL = int(os.getenv("PRESUPUESTO_TOKENS_HISTORIAL", "800"))
+MAX_CARACTERES_MENSAJE_HISTORIAL = 600
+
+SQL_LEER_HISTORIAL = """
+    SELECT mensajes FROM conversaciones_chatbot
+    WHERE id_conversacion = %s AND actualizado > NOW() - make_interval(secs => %s);
+"""
+
+# Agrega los mensajes al final y conserva los últimos MAX_MENSAJES_HISTORIAL, en una sola sentencia
+# (dos turnos simultáneos de la misma conversación no se pisan). Una conversación vencida empieza de cero.
+SQL_AGREGAR_HISTORIAL = """
+    INSERT INTO conversaciones_chatbot (id_conversacion, mensajes, actualizado)
+    VALUES (%(id)s, %(nuevos)s, NOW())
+    ON CONFLICT (id_conversacion) DO UPDATE SET
+        mensajes = jsonb_path_query_array(
+            CASE WHEN conversaciones_chatbot.actualizado > NOW() - make_interval(secs => %(ttl)s)
+                 THEN conversaciones_chatbot.mensajes ELSE '[]' END || EXCLUDED.mensajes,
+            %(recorte)s::jsonpath),
+        actualizado = NOW();
+"""
+
+
+def estimar_tokens(texto):
+    """Aproximación de tokens (~4 caracteres por token) suficiente para presupuestar el prompt."""
+    return len(texto) // 4 + 1
+
+
+def id_conversacion_sesion():
+    if "id_conversacion" not in session:
+        session["id_conversacion"] = secrets.token_hex(16)
+    return session["id_conversacion"]
+
+
+def obtener_historial_chatbot():
+    """Mensajes previos de la conversación de la sesión: deque de (rol, texto) con tamaño máximo."""
+    historial = deque(maxlen=MAX_MENSAJES_HISTORIAL)
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(SQL_LEER_HISTORIAL, (id_conversacion_sesion(), HISTORIAL_CHATBOT_TTL))
+        fila = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    if fila:
+        historial.extend((rol, texto) for rol, texto in fila[0])
+    return historial
+
+
+def registrar_turno_chatbot(id_conversacion, historial, pregunta, respuesta):
+    """Agrega pregunta y respuesta (recortadas) al historial en memoria y en la BD, y renueva su vencimiento."""
+    nuevos = []
+    for rol, texto in (("user", pregunta), ("assistant", respuesta)):
+        if len(texto) > MAX_CARACTERES_MENSAJE_HISTORIAL:
+            texto = texto[:MAX_CARACTERES_MENSAJE_HISTORIAL] + "…"
+        historial.append((rol, texto))
+        nuevos.append([rol, texto])
+    try:
+        conn = get_connection()
         cur = conn.cursor()
-
-        # Contexto según el rol del usuario
-        contexto_db = obtener_contexto_chatbot(cur, user_role, username)
-
+        cur.execute(SQL_AGREGAR_HISTORIAL, {
+            "id": id_conversacion,
+            "nuevos": json.dumps(nuevos, ensure_ascii=False),
+            "ttl": HISTORIAL_CHATBOT_TTL,
+            "recorte": f"$[last-{MAX_MENSAJES_HISTORIAL - 1} to last]",
+        })
+        cur.execute("DELETE FROM conversaciones_chatbot WHERE actualizado < NOW() - make_interval(secs => %s);",
+                    (HISTORIAL_CHATBOT_TTL,))
+        conn.commit()
         cur.close()
         conn.close()
+    except Exception as e:
+        print(f"Error al guardar historial del chatbot: {e}")
 
-        # Llamar a Groq API
-        groq_api_key = os.getenv("GROQ_API_KEY")
-        if not groq_api_key:
-            return jsonify({"error": "API key de Groq no configurada. Agrega GROQ_API_KEY a tu archivo .env"}), 500
 
-        client = Groq(api_key=groq_api_key)
+def empaquetar_historial(historial, presupuesto=PRESUPUESTO_TOKENS_HISTORIAL):
+    """
+    (resumen, mensajes): los mensajes más recientes que caben en el presupuesto de tokens y
+    un resumen de una línea con las preguntas anteriores que quedaron fuera (o None).
+    """
+    turnos = list(historial)
+    seleccion = []
+    usados = 0
+    corte = len(turnos)
+    while corte > 0:
+        rol, texto = turnos[corte - 1]
+        costo = estimar_tokens(texto)
+        if usados + costo > presupuesto:
+            break
+        seleccion.append({"role": rol, "content": texto})
+        usados += costo
+        corte -= 1
+    # La conversación enviada debe empezar con una pregunta del usuario
+    while seleccion and seleccion[-1]["role"] != "user":
+        seleccion.pop()
+        corte += 1
+    seleccion.reverse()
+
+    anteriores = [texto for rol, texto in turnos[:corte] if rol == "user"]
+    resumen = None
+    if anteriores:
+        resumen = "Preguntas anteriores del usuario: " + "; ".join(t[:80] for t in anteriores[-5:])
+    return resumen, seleccion
+
+
+def hechos_paciente_mencionado(user_role, user_message, historial):
+    """
+    Para el personal: datos del paciente que se nombra en la pregunta (o en las dos preguntas
+    anteriores, para seguimientos como "¿y su ritmo?"). Cadena vacía si no se nombra ninguno.
+    """
+    if user_role == "familiar":
+        return ""
+    previas = [texto for rol, texto in reversed(historial) if rol == "user"][:2]
+    for texto in [user_message] + previas:
+        id_paciente, _ = resolver_paciente_mencionado(normalizar_pregunta(texto))
+        if id_paciente is not None:
+            alcance = ("paciente", id_paciente)
+            snapshot = cache_contexto_chatbot.obtener_o_calcular(alcance, lambda: obtener_snapshot_chatbot(alcance))
+            return formatear_paciente_chatbot(snapshot, "PACIENTE CONSULTADO")
+    return ""
+
+
+def construir_mensajes_chatbot(user_role, contexto_db, user_message, historial=(), hechos=""):
+    """
+    Mensajes (system + historial empaquetado + user) que se envían al LLM.
+
+    El prompt no incluye el nombre del usuario: las respuestas se cachean por pregunta, alcance y
+    contexto (clave_respuesta_chatbot) y se sirven a otras personas del mismo alcance.
+    """
+    resumen, mensajes_previos = empaquetar_historial(historial)
+    if hechos:
+        contexto_db += "\n" + hechos
+    if resumen:
+        contexto_db += "\nCONVERSACIÓN PREVIA:\n" + resumen + "\n"
 
-        # Crear el prompt del sistema con contexto
-        system_prompt = f"""Eres un asistente médico virtual para el sistema 'Vida en Mano', un sistema de monitoreo de pacientes en residencias de ancianos.
+    # Crear el prompt del sistema con contexto
+    system_prompt = f"""Eres un asistente médico virtual para el sistema 'Vida en Mano', un sistema de monitoreo de pacientes en residencias de ancianos.
 
 INFORMACIÓN DEL USUARIO:
-- Nombre: {username}
 - Rol: {user_role}
 
 CONTEXTO DE LA BASE DE DATOS:
@@ -1528,9 +4192,7 @@ INSTRUCCIONES:
 1. Responde de forma clara, concisa y profesional
 2. Si te preguntan por pacientes, usa la información del contexto
 3. Si te preguntan por lecturas médicas (temperatura, ritmo cardíaco), explica los valores
-4. Valores normales de referencia:
-   - Temperatura: 36-37.5°C
-   - Ritmo cardíaco: 60-100 bpm
+4. Valores normales de referencia (generales): {obtener_clasificador().texto_rangos()}
 5. Si no tienes información suficiente, indícalo claramente
 6. Mantén un tono empático y profesional
 7. Responde en español
@@ -1540,22 +4202,535 @@ RESTRICCIONES:
 - Si es un familiar, solo habla de su paciente asignado
 - NO inventes datos que no estén en el contexto"""
 
-        # Llamar a Groq
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            model="llama-3.3-70b-versatile",  # Modelo rápido y capaz
-            temperature=0.7,
-            max_tokens=1024,
-        )
+    return [
+        {"role": "system", "content": system_prompt},
+        *mensajes_previos,
+        {"role": "user", "content": user_message}
+    ]
+
+
+def evento_sse(evento, datos):
+    """Formatea un evento Server-Sent Events con datos JSON."""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+
+# ---- Ejecución acotada de llamadas al LLM ----
+# Cada pregunta al modelo es una fila de trabajos_chatbot: el cupo (cola y por usuario) se cuenta
+# en la BD, compartido por todos los workers e instancias, y cualquiera puede responder la consulta
+# de un trabajo asíncrono. Las llamadas corren en un pool de hilos propio con tamaño fijo, así una
+# ráfaga de preguntas no ocupa los workers que atienden ingesta, semáforo y dashboard.
+LLM_MAX_CONCURRENCIA = int(os.getenv("LLM_MAX_CONCURRENCIA", "4"))
+# Preguntas que pueden esperar turno además de las que están en curso (en todas las instancias)
+LLM_MAX_EN_COLA = int(os.getenv("LLM_MAX_EN_COLA", "8"))
+# Preguntas simultáneas (en curso o en cola) por usuario
+LLM_MAX_POR_USUARIO = int(os.getenv("LLM_MAX_POR_USUARIO", "2"))
+# Segundos que se conserva un trabajo asíncrono para consultarlo
+TRABAJOS_CHATBOT_TTL = int(os.getenv("TRABAJOS_CHATBOT_TTL", "600"))
+# Trabajos asíncronos en el pool de hilos del proceso que los recibe. En serverless (Vercel define
+# VERCEL) la instancia se congela al devolver el 202: el trabajo queda sin propietario y lo toma la
+# primera consulta, que lo pone en su pool y transmite el avance mientras la instancia sigue viva.
+LLM_EN_SEGUNDO_PLANO = os.getenv("LLM_EN_SEGUNDO_PLANO", "0" if os.getenv("VERCEL") else "1") == "1"
+# Un trabajo en cola cuyo propietario no renovó `actualizado` en estos segundos se da por huérfano
+# (el proceso terminó) y otra instancia puede tomarlo. El propietario lo renueva cada tercio.
+LLM_RECLAMO_SEGUNDOS = float(os.getenv("LLM_RECLAMO_SEGUNDOS", "15"))
+# Un trabajo en proceso sin avances durante más que esto se da por perdido
+LLM_TRABAJO_VENCIDO = LLM_TIMEOUT + LLM_TIMEOUT_CONEXION
+# Segundos entre escrituras de la respuesta parcial mientras llega del modelo
+LLM_INTERVALO_AVANCE = float(os.getenv("LLM_INTERVALO_AVANCE", "0.5"))
+
+SQL_TRABAJOS_PENDIENTES = """
+    SELECT COUNT(*), COUNT(*) FILTER (WHERE usuario = %s)
+    FROM trabajos_chatbot
+    WHERE estado IN ('en_cola', 'en_proceso') AND actualizado > NOW() - make_interval(secs => %s);
+"""
+
+SQL_LEER_TRABAJO = """
+    SELECT id_trabajo, usuario, estado, mensajes, id_conversacion, pregunta, clave_respuesta,
+           respuesta, error, creado_en,
+           EXTRACT(EPOCH FROM NOW() - creado_en) AS edad,
+           EXTRACT(EPOCH FROM NOW() - actualizado) AS sin_avances
+    FROM trabajos_chatbot
+    WHERE id_trabajo = %s AND creado_en > NOW() - make_interval(secs => %s);
+"""
+
+
+class LLMOcupado(Exception):
+    """No hay cupo para otra llamada al LLM (cola llena o límite por usuario)."""
+
+
+class TrabajoChatbot:
+    """
+    Una pregunta al LLM. Va guardando los fragmentos de la respuesta a medida que llegan, en
+    memoria (para esperar el resultado o transmitirlo por SSE en el mismo proceso) y en
+    trabajos_chatbot (para consultarlo por id desde cualquier instancia). Al terminar registra el
+    turno en la conversación y cachea la respuesta.
+    """
+
+    def __init__(self, usuario, mensajes, id_conversacion=None, pregunta=None, clave_respuesta=None,
+                 id_trabajo=None):
+        self.id = id_trabajo or secrets.token_hex(16)
+        self.usuario = usuario
+        self.mensajes = mensajes
+        self.id_conversacion = id_conversacion
+        self.pregunta = pregunta
+        self.clave_respuesta = clave_respuesta
+        self.estado = "en_cola"  # en_cola -> en_proceso -> listo | error
+        self.partes = []
+        self.error = None
+        self.creado_en = datetime.now()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def desde_fila(cls, fila):
+        clave = fila["clave_respuesta"]
+        if clave is not None:
+            clave = (clave[0], tuple(clave[1]), clave[2])
+        return cls(fila["usuario"], fila["mensajes"], fila["id_conversacion"], fila["pregunta"], clave,
+                   id_trabajo=fila["id_trabajo"])
+
+    @property
+    def terminado(self):
+        return self.estado in ("listo", "error")
+
+    def respuesta(self):
+        with self._cond:
+            return "".join(self.partes)
+
+    def _actualizar_fila(self, sql, params):
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, params)
+            afectadas = cur.rowcount
+            conn.commit()
+            return afectadas
+        finally:
+            cur.close()
+            conn.close()
+
+    def reclamar(self):
+        """Pasa el trabajo de en_cola a en_proceso; False si otro proceso ya lo tomó."""
+        return self._actualizar_fila(
+            "UPDATE trabajos_chatbot SET estado = 'en_proceso', actualizado = NOW() "
+            "WHERE id_trabajo = %s AND estado = 'en_cola';", (self.id,)) == 1
+
+    def ejecutar(self):
+        inicio = time.perf_counter()
+        try:
+            if not self.reclamar():
+                return
+        except Exception as e:
+            print(f"Error al tomar trabajo del chatbot: {e}")
+            return
+        try:
+            client = obtener_cliente_llm()
+            if client is None:
+                raise RuntimeError("API key de Groq no configurada. Agrega GROQ_API_KEY a tu archivo .env")
+            with self._cond:
+                self.estado = "en_proceso"
+                self._cond.notify_all()
+            respuesta = client.chat.completions.create(
+                messages=self.mensajes,
+                model=MODELO_CHATBOT,
+                temperature=0.7,
+                max_tokens=1024,
+                stream=True,
+            )
+            ultimo_avance = time.perf_counter()
+            for chunk in respuesta:
+                texto = chunk.choices[0].delta.content if chunk.choices else None
+                if texto:
+                    if not self.partes:
+                        metrica_primer_fragmento_llm.observar(time.perf_counter() - inicio)
+                    with self._cond:
+                        self.partes.append(texto)
+                        self._cond.notify_all()
+                    if time.perf_counter() - ultimo_avance >= LLM_INTERVALO_AVANCE:
+                        self._actualizar_fila(
+                            "UPDATE trabajos_chatbot SET respuesta = %s, actualizado = NOW() WHERE id_trabajo = %s;",
+                            (self.respuesta(), self.id))
+                        ultimo_avance = time.perf_counter()
+            if self.partes:
+                self.al_terminar(self.respuesta())
+            estado, error = "listo", None
+        except Exception as e:
+            print(f"Error en llamada al LLM: {e}")
+            estado, error = "error", f"Error en chatbot: {str(e)}"
+        metrica_duracion_llm.observar(time.perf_counter() - inicio, estado)
+        try:
+            self._actualizar_fila(
+                "UPDATE trabajos_chatbot SET estado = %s, respuesta = %s, error = %s, actualizado = NOW() "
+                "WHERE id_trabajo = %s;", (estado, self.respuesta(), error, self.id))
+        except Exception as e:
+            print(f"Error al guardar trabajo del chatbot: {e}")
+        with self._cond:
+            self.estado, self.error = estado, error
+            self._cond.notify_all()
+
+    def al_terminar(self, respuesta_completa):
+        # Solo se guarda una respuesta completa
+        if self.id_conversacion is not None:
+            registrar_turno_chatbot(self.id_conversacion, deque(), self.pregunta, respuesta_completa)
+        if self.clave_respuesta is not None:
+            cache_respuestas_chatbot.guardar(self.clave_respuesta, respuesta_completa)
+
+    def esperar_partes(self, desde, timeout):
+        """Fragmentos nuevos a partir del índice `desde` (espera hasta que llegue alguno o termine)."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.partes) > desde or self.terminado, timeout)
+            return self.partes[desde:], self.terminado
+
+    def esperar(self, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.terminado, timeout)
+
+
+class PlanificadorLLM:
+    """
+    Admite trabajos según el cupo guardado en la BD y los ejecuta en un pool acotado de hilos.
+    Ninguna llamada al modelo corre en el hilo de un request: ni la de la pregunta ni la de un
+    trabajo que una consulta retoma.
+    """
+
+    def __init__(self, max_concurrencia, max_en_cola, max_por_usuario):
+        self.max_concurrencia = max_concurrencia
+        self.max_en_cola = max_en_cola
+        self.max_por_usuario = max_por_usuario
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrencia, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self._propios = set()    # ids en el pool de este proceso (en cola o en curso)
+        self._en_cola = set()    # de esos, los que esperan turno (se renuevan con _latir)
+        self._latido = None
+        self.completados = 0
+        self.rechazados = 0
+
+    @staticmethod
+    def propietario():
+        """Identifica a este proceso en trabajos_chatbot.propietario (se evalúa tras un fork)."""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def tiene(self, id_trabajo):
+        with self._lock:
+            return id_trabajo in self._propios
+
+    def admitir(self, trabajo, propietario=None):
+        """Registra el trabajo en trabajos_chatbot o lanza LLMOcupado si no hay cupo en ninguna instancia."""
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            # Contar y agregar bajo un mismo candado: dos preguntas simultáneas no superan el cupo
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('trabajos_chatbot'));")
+            cur.execute(SQL_TRABAJOS_PENDIENTES, (trabajo.usuario, LLM_TRABAJO_VENCIDO))
+            pendientes, del_usuario = cur.fetchone()
+            if del_usuario >= self.max_por_usuario:
+                motivo = "Ya tienes preguntas en proceso; espera la respuesta antes de enviar otra."
+            elif pendientes >= self.max_concurrencia + self.max_en_cola:
+                motivo = "El asistente está atendiendo muchas preguntas; intenta de nuevo en unos segundos."
+            else:
+                motivo = None
+            if motivo is not None:
+                with self._lock:
+                    self.rechazados += 1
+                raise LLMOcupado(motivo)
+            clave = json.dumps(trabajo.clave_respuesta) if trabajo.clave_respuesta is not None else None
+            cur.execute("""
+                INSERT INTO trabajos_chatbot
+                    (id_trabajo, usuario, mensajes, id_conversacion, pregunta, clave_respuesta, propietario)
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
+            """, (trabajo.id, trabajo.usuario, json.dumps(trabajo.mensajes, ensure_ascii=False),
+                  trabajo.id_conversacion, trabajo.pregunta, clave, propietario))
+            # Limpieza de trabajos viejos (ya nadie puede consultarlos)
+            cur.execute("DELETE FROM trabajos_chatbot WHERE creado_en < NOW() - make_interval(secs => %s);",
+                        (TRABAJOS_CHATBOT_TTL,))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+        return trabajo
+
+    def enviar(self, trabajo, en_segundo_plano=True):
+        """
+        Admite el trabajo (o lanza LLMOcupado sin bloquear) y, con `en_segundo_plano`, lo encola en
+        el pool de hilos. Sin él queda en la BD sin propietario para que lo tome la primera consulta.
+        """
+        self.admitir(trabajo, self.propietario() if en_segundo_plano else None)
+        if en_segundo_plano:
+            self._encolar(trabajo)
+        return trabajo
+
+    def retomar(self, fila):
+        """
+        Pone en el pool de este proceso un trabajo en cola sin propietario o huérfano (sin latido
+        hace más de LLM_RECLAMO_SEGUNDOS). Devuelve el trabajo, o None si su propietario sigue
+        vivo o si otra consulta lo tomó primero.
+        """
+        if self.tiene(fila["id_trabajo"]):
+            return None
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE trabajos_chatbot SET propietario = %s, actualizado = NOW()
+                WHERE id_trabajo = %s AND estado = 'en_cola'
+                  AND (propietario IS NULL OR actualizado < NOW() - make_interval(secs => %s));
+            """, (self.propietario(), fila["id_trabajo"], LLM_RECLAMO_SEGUNDOS))
+            tomado = cur.rowcount == 1
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+        if not tomado:
+            return None
+        trabajo = TrabajoChatbot.desde_fila(fila)
+        self._encolar(trabajo)
+        return trabajo
+
+    def _encolar(self, trabajo):
+        with self._lock:
+            self._pendientes += 1
+            self._propios.add(trabajo.id)
+            self._en_cola.add(trabajo.id)
+            if self._latido is None:
+                self._latido = threading.Thread(target=self._latir, name="llm-latido", daemon=True)
+                self._latido.start()
+        try:
+            futuro = self._executor.submit(self._correr, trabajo)
+        except Exception:
+            self._liberar(trabajo, completado=False)
+            raise
+        futuro.add_done_callback(lambda _: self._liberar(trabajo))
+
+    def _correr(self, trabajo):
+        with self._lock:
+            self._en_cola.discard(trabajo.id)
+        trabajo.ejecutar()
+
+    def _latir(self):
+        """Mientras haya trabajos de este proceso esperando turno, renueva su `actualizado`."""
+        while True:
+            time.sleep(LLM_RECLAMO_SEGUNDOS / 3)
+            with self._lock:
+                ids = list(self._en_cola)
+                if not ids:
+                    self._latido = None
+                    return
+            try:
+                conn = get_connection()
+                cur = conn.cursor()
+                try:
+                    cur.execute("""
+                        UPDATE trabajos_chatbot SET actualizado = NOW()
+                        WHERE id_trabajo = ANY(%s) AND estado = 'en_cola' AND propietario = %s;
+                    """, (ids, self.propietario()))
+                    conn.commit()
+                finally:
+                    cur.close()
+                    conn.close()
+            except Exception as e:
+                print(f"Error al renovar trabajos del chatbot: {e}")
+
+    def _liberar(self, trabajo, completado=True):
+        with self._lock:
+            self._pendientes -= 1
+            self._propios.discard(trabajo.id)
+            self._en_cola.discard(trabajo.id)
+            if completado:
+                self.completados += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "en_curso_o_en_cola": self._pendientes,
+                "max_concurrencia": self.max_concurrencia,
+                "max_en_cola": self.max_en_cola,
+                "completados": self.completados,
+                "rechazados": self.rechazados,
+            }
+
+
+planificador_llm = PlanificadorLLM(LLM_MAX_CONCURRENCIA, LLM_MAX_EN_COLA, LLM_MAX_POR_USUARIO)
+metrica_pendientes_llm = Medidor("vida_llm_trabajos_pendientes", "Preguntas al LLM en curso o en cola en el proceso",
+                                 funcion=lambda: planificador_llm.estadisticas()["en_curso_o_en_cola"])
+
+
+def leer_trabajo_chatbot(id_trabajo):
+    conn = get_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        cur.execute(SQL_LEER_TRABAJO, (id_trabajo, TRABAJOS_CHATBOT_TTL))
+        return cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def transmitir_avance_trabajo(trabajo):
+    """
+    Eventos SSE `avance` con el mismo JSON que la consulta de un trabajo (estado, response, error)
+    cada vez que llegan fragmentos, hasta que termina.
+    """
+    enviados = 0
+    while True:
+        partes, terminado = trabajo.esperar_partes(enviados, timeout=LLM_TRABAJO_VENCIDO)
+        enviados += len(partes)
+        if terminado:
+            yield evento_sse("avance", {"id_trabajo": trabajo.id, "estado": trabajo.estado,
+                                        "response": trabajo.respuesta(), "error": trabajo.error})
+            return
+        if not partes:
+            yield evento_sse("avance", {"id_trabajo": trabajo.id, "estado": "error", "response": trabajo.respuesta(),
+                                        "error": "Tiempo de espera agotado para la respuesta del asistente"})
+            return
+        yield evento_sse("avance", {"id_trabajo": trabajo.id, "estado": "en_proceso",
+                                    "response": trabajo.respuesta(), "error": None})
+
+
+def trabajo_como_dict(fila):
+    return {
+        "id_trabajo": fila["id_trabajo"],
+        "estado": fila["estado"],
+        "response": fila["respuesta"],
+        "error": fila["error"],
+        "creado_en": fila["creado_en"].isoformat(),
+    }
+
+
+def transmitir_trabajo_sse(trabajo):
+    """Eventos SSE (token / fin / error) con los fragmentos del trabajo a medida que llegan."""
+    enviados = 0
+    while True:
+        partes, terminado = trabajo.esperar_partes(enviados, timeout=LLM_TIMEOUT + LLM_TIMEOUT_CONEXION)
+        for texto in partes:
+            yield evento_sse("token", {"texto": texto})
+        enviados += len(partes)
+        if terminado:
+            break
+        if not partes:
+            yield evento_sse("error", {"error": "Tiempo de espera agotado para la respuesta del asistente"})
+            return
+    if trabajo.estado == "error":
+        yield evento_sse("error", {"error": trabajo.error})
+    else:
+        yield evento_sse("fin", {"timestamp": datetime.now().isoformat(), "origen": "llm"})
+
+
+@app.route("/api/chatbot", methods=["POST"])
+def chatbot_api():
+    """
+    API del chatbot - recibe mensaje y devuelve respuesta de IA.
+    Body JSON: {"message": str, "stream": bool, "async": bool}
+    Con "stream": true la respuesta es text/event-stream: eventos `token` ({"texto"}) a medida
+    que llegan del modelo, y al final `fin` ({"timestamp", "origen"}) o `error` ({"error"}).
+    "origen" indica si respondió el modelo ("llm"), la caché de respuestas ("cache") o las
+    respuestas locales ("local").
+    Con "async": true (lo que usa el dashboard), si la pregunta necesita al modelo se responde 202
+    con {"id_trabajo", "url"} y el resultado se consulta en /api/chatbot/trabajos/<id_trabajo>.
+    "stream" y el modo sincrónico retienen un worker hasta que el modelo termina.
+    Si no hay cupo en el pool del LLM responde 429 con Retry-After.
+    """
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+
+    try:
+        data = request.get_json()
+        user_message = data.get("message", "").strip()
+        stream = bool(data.get("stream"))
+        asincrono = bool(data.get("async"))
+
+        if not user_message:
+            return jsonify({"error": "Mensaje vacío"}), 400
+
+        # Obtener información del usuario
+        username = session.get("username")
+        user_role = session.get("tipo_usuario", "familiar")
 
-        respuesta_ia = chat_completion.choices[0].message.content
+        # Conversación de esta sesión (mensajes previos)
+        id_conversacion = id_conversacion_sesion()
+        historial = obtener_historial_chatbot()
+
+        # Preguntas factuales (estado, temperatura, críticos...) se responden sin LLM
+        try:
+            respuesta_local = responder_localmente(user_message, user_role, obtener_snapshot_cacheado(user_role))
+        except Exception as e:
+            print(f"Error en respuesta local del chatbot: {e}")
+            respuesta_local = None
+
+        if respuesta_local is not None:
+            registrar_turno_chatbot(id_conversacion, historial, user_message, respuesta_local)
+            timestamp = datetime.now().isoformat()
+            if stream:
+                eventos = [evento_sse("token", {"texto": respuesta_local}),
+                           evento_sse("fin", {"timestamp": timestamp, "origen": "local"})]
+                return Response(eventos, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+            return jsonify({
+                "success": True,
+                "response": respuesta_local,
+                "origen": "local",
+                "timestamp": timestamp
+            })
+
+        # Contexto según el rol del usuario (snapshot cacheado por alcance)
+        contexto_db = obtener_contexto_chatbot(user_role)
+        try:
+            hechos = hechos_paciente_mencionado(user_role, user_message, historial)
+        except Exception as e:
+            print(f"Error obteniendo datos del paciente mencionado: {e}")
+            hechos = ""
+
+        # Misma pregunta, mismo alcance y mismo contexto: reutilizar la respuesta anterior
+        clave_respuesta = None
+        if not contexto_db.startswith("\n[Error"):
+            clave_respuesta = clave_respuesta_chatbot(user_message, user_role, contexto_db + hechos, historial)
+            respuesta_cacheada = cache_respuestas_chatbot.obtener(clave_respuesta)
+            if respuesta_cacheada is not None:
+                registrar_turno_chatbot(id_conversacion, historial, user_message, respuesta_cacheada)
+                timestamp = datetime.now().isoformat()
+                if stream:
+                    eventos = [evento_sse("token", {"texto": respuesta_cacheada}),
+                               evento_sse("fin", {"timestamp": timestamp, "origen": "cache"})]
+                    return Response(eventos, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+                return jsonify({
+                    "success": True,
+                    "response": respuesta_cacheada,
+                    "origen": "cache",
+                    "timestamp": timestamp
+                })
+
+        # Cliente de Groq reutilizado entre peticiones
+        if obtener_cliente_llm() is None:
+            return jsonify({"error": "API key de Groq no configurada. Agrega GROQ_API_KEY a tu archivo .env"}), 500
+
+        mensajes = construir_mensajes_chatbot(user_role, contexto_db, user_message, historial, hechos)
+
+        # La llamada a Groq corre en el pool acotado; sin cupo se responde 429 de inmediato
+        trabajo = TrabajoChatbot(username, mensajes, id_conversacion, user_message, clave_respuesta)
+        try:
+            planificador_llm.enviar(trabajo, en_segundo_plano=LLM_EN_SEGUNDO_PLANO or not asincrono)
+        except LLMOcupado as e:
+            return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
+
+        if asincrono:
+            return jsonify({
+                "success": True,
+                "id_trabajo": trabajo.id,
+                "estado": trabajo.estado,
+                "url": url_for("chatbot_trabajo", id_trabajo=trabajo.id),
+            }), 202
+
+        if stream:
+            return Response(stream_with_context(transmitir_trabajo_sse(trabajo)), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+        if not trabajo.esperar(timeout=LLM_TIMEOUT + LLM_TIMEOUT_CONEXION):
+            return jsonify({"error": "Tiempo de espera agotado para la respuesta del asistente"}), 504
+        if trabajo.estado == "error":
+            return jsonify({"error": trabajo.error}), 500
 
         return jsonify({
             "success": True,
-            "response": respuesta_ia,
+            "response": trabajo.respuesta(),
+            "origen": "llm",
             "timestamp": datetime.now().isoformat()
         })
 
@@ -1563,34 +4738,140 @@ RESTRICCIONES:
         return jsonify({"error": f"Error en chatbot: {str(e)}"}), 500
 
 
-def obtener_contexto_chatbot(cur, user_role, username):
-    """Obtiene información relevante de la BD para el contexto del chatbot"""
-    contexto = ""
+@app.route("/api/chatbot/historial", methods=["DELETE"])
+def chatbot_borrar_historial():
+    """Olvida la conversación de la sesión (botón 'Limpiar' del chat)."""
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
 
     try:
-        # Estadísticas generales
-        cur.execute("SELECT COUNT(*) FROM pacientes;")
-        total_pacientes = cur.fetchone()[0]
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM conversaciones_chatbot WHERE id_conversacion = %s;", (id_conversacion_sesion(),))
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"Error al borrar historial del chatbot: {e}")
+    session.pop("id_conversacion", None)
+    return jsonify({"success": True})
 
-        cur.execute("SELECT COUNT(*) FROM lecturas WHERE momento_lectura > NOW() - INTERVAL '24 hours';")
-        lecturas_24h = cur.fetchone()[0]
 
-        contexto += f"ESTADÍSTICAS GENERALES:\n"
-        contexto += f"- Total de pacientes: {total_pacientes}\n"
-        contexto += f"- Lecturas en últimas 24h: {lecturas_24h}\n\n"
+@app.route("/api/chatbot/trabajos/<id_trabajo>")
+def chatbot_trabajo(id_trabajo):
+    """
+    Estado de una pregunta asíncrona: {"estado", "response", "error"}; "response" trae la parte
+    de la respuesta que ya llegó. Responde cualquier instancia.
+    Un trabajo en cola sin propietario (serverless) o huérfano (su proceso terminó) lo toma esta
+    instancia en su pool de hilos, nunca en el hilo del request. En serverless, si el cliente
+    acepta text/event-stream, la respuesta transmite eventos `avance` con ese mismo JSON: la
+    instancia sigue viva mientras el modelo responde y las cabeceras salen enseguida.
+    """
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+
+    fila = leer_trabajo_chatbot(id_trabajo)
+    if fila is None or fila["usuario"] != session.get("username"):
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+
+    transmite = not LLM_EN_SEGUNDO_PLANO and request.accept_mimetypes["text/event-stream"] > 0
+    if fila["estado"] == "en_cola" and (LLM_EN_SEGUNDO_PLANO or transmite):
+        trabajo = planificador_llm.retomar(fila)
+        if trabajo is not None and transmite:
+            return Response(stream_with_context(transmitir_avance_trabajo(trabajo)), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        if trabajo is not None:
+            fila = leer_trabajo_chatbot(id_trabajo)
+    elif fila["estado"] == "en_proceso" and fila["sin_avances"] > LLM_TRABAJO_VENCIDO:
+        # El proceso que lo ejecutaba terminó sin cerrarlo
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE trabajos_chatbot SET estado = 'error', error = %s, actualizado = NOW()
+            WHERE id_trabajo = %s AND estado = 'en_proceso';
+        """, ("Tiempo de espera agotado para la respuesta del asistente", id_trabajo))
+        conn.commit()
+        cur.close()
+        conn.close()
+        fila = leer_trabajo_chatbot(id_trabajo)
+
+    return jsonify(trabajo_como_dict(fila))
+
+
+@app.route("/api/chatbot/estadisticas")
+def chatbot_estadisticas():
+    """Aciertos de las cachés del chatbot (solo personal)."""
+    if not is_logged_in():
+        return jsonify({"error": "No autorizado"}), 401
+
+    return jsonify({
+        "contexto": cache_contexto_chatbot.estadisticas(),
+        "respuestas": cache_respuestas_chatbot.estadisticas(),
+        "llm": planificador_llm.estadisticas(),
+    })
+
+
+# Segundos que un snapshot de contexto sigue vigente si no llegan lecturas nuevas
+CONTEXTO_CHATBOT_TTL = int(os.getenv("CONTEXTO_CHATBOT_TTL", "60"))
+
+# Un snapshot para todo el personal y uno por paciente (familiares y consultas por nombre)
+cache_contexto_chatbot = CacheTTL("contexto_chatbot", max_entradas=500, ttl=CONTEXTO_CHATBOT_TTL)
 
-        # Si es familiar, solo su paciente
-        if user_role == "familiar":
-            cur.execute("""
-                SELECT u.id_paciente_asignado
-                FROM usuarios u
-                WHERE u.username = %s;
-            """, (username,))
-            result = cur.fetchone()
 
-            if result and result[0]:
-                id_paciente = result[0]
+def alcance_chatbot(user_role):
+    """Clave de caché del contexto: ('personal',) o ('paciente', id_paciente) para familiares."""
+    if user_role == "familiar":
+        return ("paciente", paciente_asignado_actual())
+    return ("personal",)
 
+
+def invalidar_contexto_chatbot(id_paciente=None):
+    """Tras una lectura nueva: descartar el snapshot y las respuestas del personal y del paciente afectado."""
+    alcances = [("personal",)]
+    if id_paciente is not None:
+        alcances.append(("paciente", id_paciente))
+    for alcance in alcances:
+        cache_contexto_chatbot.invalidar(alcance)
+    cache_respuestas_chatbot.invalidar_si(lambda clave: clave[1] in alcances)
+
+
+# Respuestas del LLM reutilizables mientras el contexto del alcance no cambie
+RESPUESTAS_CHATBOT_TTL = int(os.getenv("RESPUESTAS_CHATBOT_TTL", "900"))
+cache_respuestas_chatbot = CacheTTL("respuestas_chatbot", max_entradas=2000, ttl=RESPUESTAS_CHATBOT_TTL)
+
+
+def clave_respuesta_chatbot(user_message, user_role, contexto_db, historial=()):
+    """
+    (pregunta normalizada, alcance, versión del contexto). La versión es un hash del texto de
+    contexto y del historial previo, así una respuesta nunca se sirve con datos distintos a los
+    que vio el modelo; las primeras preguntas de una conversación se comparten entre sesiones.
+    Nada del usuario en particular entra al prompt (ver construir_mensajes_chatbot).
+    """
+    datos = contexto_db + json.dumps(list(historial), ensure_ascii=False)
+    version = hashlib.sha1(datos.encode("utf-8")).hexdigest()[:16]
+    return (normalizar_pregunta(user_message), alcance_chatbot(user_role), version)
+
+
+def obtener_snapshot_chatbot(alcance):
+    """Datos de la BD que el chatbot usa como contexto, para un alcance dado (ver alcance_chatbot)."""
+    snapshot = {"alcance": alcance[0], "generado_en": datetime.now(), "paciente": None,
+                "ultima_lectura": None, "recientes": [], "criticos_24h": None, "estables_24h": None,
+                "pacientes_criticos": None}
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # Estadísticas generales
+        cur.execute("SELECT COUNT(*) FROM pacientes;")
+        snapshot["total_pacientes"] = cur.fetchone()[0]
+
+        cur.execute("SELECT COUNT(*) FROM lecturas WHERE momento_lectura > NOW() - INTERVAL '24 hours';")
+        snapshot["lecturas_24h"] = cur.fetchone()[0]
+
+        # Si es familiar (o una consulta sobre un paciente), solo ese paciente
+        if alcance[0] == "paciente":
+            id_paciente = alcance[1]
+            if id_paciente:
                 # Información del paciente
                 cur.execute("""
                     SELECT p.nombre, p.apellido_paterno, p.apellido_materno,
@@ -1601,11 +4882,12 @@ def obtener_contexto_chatbot(cur, user_role, username):
                 paciente = cur.fetchone()
 
                 if paciente:
-                    edad = (date.today() - paciente[3]).days // 365
-                    contexto += f"PACIENTE ASIGNADO:\n"
-                    contexto += f"- Nombre: {paciente[0]} {paciente[1]} {paciente[2]}\n"
-                    contexto += f"- Edad: {edad} años\n"
-                    contexto += f"- Género: {paciente[4]}\n\n"
+                    snapshot["paciente"] = {
+                        "id_paciente": id_paciente,
+                        "nombre": f"{paciente[0]} {paciente[1]} {paciente[2]}",
+                        "edad": (date.today() - paciente[3]).days // 365 if paciente[3] else None,
+                        "genero": paciente[4],
+                    }
 
                     # Última lectura
                     cur.execute("""
@@ -1619,11 +4901,12 @@ def obtener_contexto_chatbot(cur, user_role, username):
                     lectura = cur.fetchone()
 
                     if lectura:
-                        contexto += f"ÚLTIMA LECTURA:\n"
-                        contexto += f"- Temperatura: {lectura[0]}°C\n"
-                        contexto += f"- Ritmo cardíaco: {lectura[1]} bpm\n"
-                        contexto += f"- Pulsera puesta: {'Sí' if lectura[2] else 'No'}\n"
-                        contexto += f"- Momento: {lectura[3]}\n"
+                        snapshot["ultima_lectura"] = {
+                            "temperatura_c": lectura[0],
+                            "ritmo_cardiaco": lectura[1],
+                            "esta_puesta": lectura[2],
+                            "momento_lectura": lectura[3],
+                        }
 
         # Si es staff, información general
         else:
@@ -1643,38 +4926,270 @@ def obtener_contexto_chatbot(cur, user_role, username):
                 ORDER BY l.momento_lectura DESC
                 LIMIT 5;
             """)
-            pacientes_recientes = cur.fetchall()
-
-            if pacientes_recientes:
-                contexto += "PACIENTES CON LECTURAS RECIENTES:\n"
-                for pac in pacientes_recientes:
-                    contexto += f"- {pac[0]} {pac[1]}: Temp {pac[2]}°C, Ritmo {pac[3]} bpm, Pulsera: {'Sí' if pac[4] else 'No'}\n"
-                contexto += "\n"
+            snapshot["recientes"] = [{
+                "nombre": f"{pac[0]} {pac[1]}",
+                "temperatura_c": pac[2],
+                "ritmo_cardiaco": pac[3],
+                "esta_puesta": pac[4],
+                "momento_lectura": pac[5],
+            } for pac in cur.fetchall()]
 
             # Estadísticas de criticidad
-            cur.execute("""
-                SELECT
-                    COUNT(*) FILTER (WHERE (temperatura_c < 35 OR temperatura_c > 39.5)
-                                       OR (ritmo_cardiaco < 40 OR ritmo_cardiaco > 130)) as criticos,
-                    COUNT(*) FILTER (WHERE (temperatura_c BETWEEN 36 AND 37.5)
-                                       AND (ritmo_cardiaco BETWEEN 60 AND 100)
-                                       AND esta_puesta = true) as estables
-                FROM lecturas
-                WHERE momento_lectura > NOW() - INTERVAL '24 hours';
-            """)
+            cur.execute(*consulta_estadisticas_24h())
             stats = cur.fetchone()
-
             if stats:
-                contexto += f"ESTADO DE PACIENTES (últimas 24h):\n"
-                contexto += f"- Lecturas críticas: {stats[0]}\n"
-                contexto += f"- Lecturas estables: {stats[1]}\n"
+                snapshot["criticos_24h"], snapshot["estables_24h"] = stats[0], stats[1]
 
-    except Exception as e:
-        contexto += f"\n[Error obteniendo contexto: {str(e)}]"
+            # Pacientes cuya lectura más reciente es crítica
+            cur.execute(f"""
+                SELECT p.id_paciente, p.nombre, p.apellido_paterno, l.temperatura_c, l.ritmo_cardiaco
+                FROM pacientes p
+                JOIN pulseras pu ON pu.id_paciente = p.id_paciente
+                JOIN LATERAL (
+                    SELECT temperatura_c, ritmo_cardiaco, esta_puesta, momento_lectura FROM lecturas
+                    WHERE id_pulsera = pu.id_pulsera
+                    ORDER BY momento_lectura DESC
+                    LIMIT 1
+                ) l ON true
+                {sql_join_umbrales()}
+                WHERE {sql_filtro_estado('rojo')}
+                ORDER BY l.momento_lectura DESC;
+            """)
+            snapshot["pacientes_criticos"] = [{
+                "id_paciente": pac[0],
+                "nombre": f"{pac[1]} {pac[2]}",
+                "temperatura_c": pac[3],
+                "ritmo_cardiaco": pac[4],
+            } for pac in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+    return snapshot
+
+
+def formatear_paciente_chatbot(snapshot, titulo):
+    """Datos del paciente y su última lectura de un snapshot de alcance 'paciente'."""
+    contexto = ""
+    paciente = snapshot["paciente"]
+    if paciente:
+        contexto += f"{titulo}:\n"
+        contexto += f"- Nombre: {paciente['nombre']}\n"
+        contexto += f"- Edad: {paciente['edad']} años\n"
+        contexto += f"- Género: {paciente['genero']}\n"
+        clasificador = obtener_clasificador()
+        if paciente['id_paciente'] in clasificador.excepciones:
+            contexto += f"- Rangos normales propios: {clasificador.texto_rangos(paciente['id_paciente'])}\n"
+        contexto += "\n"
+
+    lectura = snapshot["ultima_lectura"]
+    if lectura:
+        contexto += f"ÚLTIMA LECTURA:\n"
+        contexto += f"- Temperatura: {lectura['temperatura_c']}°C\n"
+        contexto += f"- Ritmo cardíaco: {lectura['ritmo_cardiaco']} bpm\n"
+        contexto += f"- Pulsera puesta: {'Sí' if lectura['esta_puesta'] else 'No'}\n"
+        contexto += f"- Momento: {lectura['momento_lectura']}\n"
+    return contexto
+
+
+def formatear_contexto_chatbot(snapshot):
+    """Texto de contexto para el prompt a partir de un snapshot."""
+    contexto = ""
+    contexto += f"ESTADÍSTICAS GENERALES:\n"
+    contexto += f"- Total de pacientes: {snapshot['total_pacientes']}\n"
+    contexto += f"- Lecturas en últimas 24h: {snapshot['lecturas_24h']}\n\n"
+
+    contexto += formatear_paciente_chatbot(snapshot, "PACIENTE ASIGNADO")
+
+    if snapshot["recientes"]:
+        contexto += "PACIENTES CON LECTURAS RECIENTES:\n"
+        for pac in snapshot["recientes"]:
+            contexto += f"- {pac['nombre']}: Temp {pac['temperatura_c']}°C, Ritmo {pac['ritmo_cardiaco']} bpm, Pulsera: {'Sí' if pac['esta_puesta'] else 'No'}\n"
+        contexto += "\n"
+
+    if snapshot["criticos_24h"] is not None:
+        contexto += f"ESTADO DE PACIENTES (últimas 24h):\n"
+        contexto += f"- Lecturas críticas: {snapshot['criticos_24h']}\n"
+        contexto += f"- Lecturas estables: {snapshot['estables_24h']}\n"
+
+    if snapshot["pacientes_criticos"]:
+        contexto += f"\nPACIENTES EN ESTADO CRÍTICO (última lectura): {len(snapshot['pacientes_criticos'])}\n"
+        for pac in snapshot["pacientes_criticos"][:10]:
+            contexto += f"- {pac['nombre']}: Temp {pac['temperatura_c']}°C, Ritmo {pac['ritmo_cardiaco']} bpm\n"
 
     return contexto
 
 
+def obtener_snapshot_cacheado(user_role):
+    """Snapshot del alcance del usuario, desde la caché si sigue vigente."""
+    alcance = alcance_chatbot(user_role)
+    return cache_contexto_chatbot.obtener_o_calcular(alcance, lambda: obtener_snapshot_chatbot(alcance))
+
+
+def obtener_contexto_chatbot(user_role):
+    """Obtiene información relevante de la BD para el contexto del chatbot"""
+    try:
+        return formatear_contexto_chatbot(obtener_snapshot_cacheado(user_role))
+    except Exception as e:
+        return f"\n[Error obteniendo contexto: {str(e)}]"
+
+
+# ================================
+#   RESPUESTAS LOCALES DEL CHATBOT (SIN LLM)
+# ================================
+# Preguntas factuales frecuentes se responden con el snapshot cacheado, sin llamar a Groq.
+# Cada intención se reconoce por patrones sobre el texto normalizado (sin acentos ni signos).
+INTENCIONES_CHATBOT = [
+    ("temperatura", [r"\btemperatura\b", r"\bfiebre\b", r"\bgrados\b"]),
+    ("ritmo", [r"\britmo\b", r"\bpulso\b", r"\bfrecuencia cardiaca\b", r"\blatidos\b", r"\bbpm\b"]),
+    ("criticos", [r"\bcriticos?\b", r"\bcriticas?\b", r"\bgraves?\b", r"\burgentes?\b"]),
+    ("total_pacientes", [r"\bcuantos (pacientes|residentes)\b", r"\btotal de (pacientes|residentes)\b"]),
+    ("lecturas_24h", [r"\bcuantas lecturas\b", r"\blecturas (de|en) (hoy|las ultimas 24)"]),
+    ("estado_paciente", [r"\bcomo (esta|se encuentra|sigue|amanecio|se siente)\b", r"\bestado de\b",
+                         r"\bsu estado\b", r"\bultima lectura\b"]),
+]
+
+# Preguntas abiertas (explicaciones, consejos) siempre van al LLM
+PATRONES_PREGUNTA_ABIERTA = [
+    r"\bpor ?que\b", r"\bque significa\b", r"\bexplica", r"\brecomienda", r"\bdeberia\b",
+    r"\bconsejo", r"\bque hago\b", r"\bque puedo\b", r"\bes normal\b", r"\bes grave\b", r"\bpreocupa",
+]
+
+# Palabras que no forman parte de un nombre al buscar a qué paciente se refiere la pregunta
+PALABRAS_NO_NOMBRE = {
+    "como", "esta", "estan", "se", "encuentra", "sigue", "siente", "amanecio", "cual", "cuales", "es", "son",
+    "la", "el", "los", "las", "de", "del", "a", "al", "mi", "su", "que", "tiene", "tuvo", "hoy", "ultima",
+    "ultimo", "lectura", "estado", "temperatura", "fiebre", "grados", "ritmo", "pulso", "frecuencia",
+    "cardiaca", "latidos", "bpm", "paciente", "residente", "senor", "senora", "don", "dona", "por", "favor",
+    "hola", "dime", "me", "puedes", "decir", "quiero", "saber", "actual", "y", "o", "en",
+}
+
+def normalizar_pregunta(mensaje):
+    """Texto de la pregunta sin acentos, mayúsculas, signos ni espacios repetidos."""
+    return " ".join(re.sub(r"[^\w\s]", " ", normalizar_texto(mensaje)).split())
+
+
+def clasificar_intencion(mensaje):
+    """Devuelve (intención, texto normalizado) o (None, texto) si la pregunta debe ir al LLM."""
+    texto = normalizar_pregunta(mensaje)
+    if any(re.search(p, texto) for p in PATRONES_PREGUNTA_ABIERTA):
+        return None, texto
+    for intencion, patrones in INTENCIONES_CHATBOT:
+        if any(re.search(p, texto) for p in patrones):
+            return intencion, texto
+    return None, texto
+
+
+def resolver_paciente_mencionado(texto):
+    """
+    Busca en el índice de pacientes el nombre (o 'ID n') mencionado en la pregunta.
+    Devuelve (id_paciente, None), (None, [nombres]) si es ambiguo, o (None, None) si no hay nombre.
+    """
+    por_id = re.search(r"\b(?:id|paciente)\s+(\d+)\b", texto)
+    if por_id:
+        return int(por_id.group(1)), None
+    indice = obtener_indice_pacientes()
+    # Tramo contiguo más largo de palabras que aparecen en algún nombre ("... de lucia lopez nunez es ...")
+    tramos, actual = [], []
+    for w in texto.split():
+        if w not in PALABRAS_NO_NOMBRE and not w.isdigit() and indice.es_palabra_de_nombre(w):
+            actual.append(w)
+        elif actual:
+            tramos.append(actual)
+            actual = []
+    if actual:
+        tramos.append(actual)
+    if not tramos:
+        return None, None
+    resultados = indice.buscar(" ".join(max(tramos, key=len)), limite=LIMITE_RESULTADOS_BUSQUEDA)
+    # Solo coincidencias literales (puntaje >= 1): las aproximadas son demasiado ambiguas para responder solo
+    exactos = [r for r in resultados if r[1] >= 1.0]
+    if not exactos:
+        return None, None
+    mejores = [id_p for id_p, puntaje in exactos if puntaje == exactos[0][1]]
+    if len(mejores) == 1:
+        return mejores[0], None
+    opciones = [f"{indice.nombre(id_p)} (ID {id_p})" for id_p in mejores[:5]]
+    if len(mejores) > 5:
+        opciones.append(f"y {len(mejores) - 5} más")
+    return None, opciones
+
+
+def _describir_lectura(paciente, lectura, intencion):
+    nombre = paciente["nombre"]
+    if not lectura:
+        return f"Todavía no hay lecturas registradas para {nombre}."
+    momento = lectura["momento_lectura"].strftime("%d/%m/%Y %H:%M") if lectura["momento_lectura"] else "sin fecha"
+    clasificador = obtener_clasificador()
+    estado = clasificador.estado(lectura["temperatura_c"], lectura["ritmo_cardiaco"], lectura["esta_puesta"],
+                                 paciente["id_paciente"])
+    if intencion == "temperatura":
+        texto = f"La última temperatura de {nombre} es {lectura['temperatura_c']} °C ({momento})."
+    elif intencion == "ritmo":
+        texto = f"El último ritmo cardíaco de {nombre} es {lectura['ritmo_cardiaco']} bpm ({momento})."
+    else:
+        texto = (f"Última lectura de {nombre} ({momento}):\n"
+                 f"- Temperatura: {lectura['temperatura_c']} °C\n"
+                 f"- Ritmo cardíaco: {lectura['ritmo_cardiaco']} bpm\n"
+                 f"- Pulsera puesta: {'Sí' if lectura['esta_puesta'] else 'No'}")
+    texto += f"\nEstado: {TEXTO_ESTADO[estado]}."
+    if estado == "rojo":
+        texto += " Los valores están fuera del rango seguro; avisa al personal de enfermería si aún no lo saben."
+    elif not lectura["esta_puesta"]:
+        texto += " La pulsera no estaba puesta en esa lectura."
+    texto += f"\n(Valores de referencia: {clasificador.texto_rangos(paciente['id_paciente'])}.)"
+    return texto
+
+
+def responder_localmente(mensaje, user_role, snapshot):
+    """
+    Respuesta armada con datos del snapshot para preguntas factuales, o None si la
+    pregunta es abierta o no se reconoce (entonces responde el LLM).
+    """
+    intencion, texto = clasificar_intencion(mensaje)
+    if intencion is None:
+        return None
+
+    if intencion == "total_pacientes":
+        return f"Hay {snapshot['total_pacientes']} pacientes registrados en el sistema."
+
+    if intencion == "lecturas_24h":
+        return f"Se registraron {snapshot['lecturas_24h']} lecturas en las últimas 24 horas."
+
+    if user_role == "familiar":
+        # Un familiar solo recibe información de su paciente asignado
+        paciente = snapshot["paciente"]
+        if not paciente:
+            return "No tienes un paciente asignado. Pide al personal que te asigne uno para ver sus lecturas."
+        return _describir_lectura(paciente, snapshot["ultima_lectura"], intencion)
+
+    # Personal: pregunta sobre un paciente concreto
+    id_paciente, ambiguos = resolver_paciente_mencionado(texto)
+    if ambiguos:
+        return ("Encontré varios pacientes con ese nombre: " + ", ".join(ambiguos) +
+                ". ¿A cuál te refieres? Puedes indicar el nombre completo o el ID del paciente.")
+    if id_paciente is not None:
+        alcance = ("paciente", id_paciente)
+        datos = cache_contexto_chatbot.obtener_o_calcular(alcance, lambda: obtener_snapshot_chatbot(alcance))
+        if datos["paciente"]:
+            return _describir_lectura(datos["paciente"], datos["ultima_lectura"], intencion)
+
+    if intencion == "criticos":
+        criticos = snapshot["pacientes_criticos"] or []
+        if not criticos:
+            texto_resp = "Ningún paciente está en estado crítico según su última lectura."
+        else:
+            texto_resp = f"{len(criticos)} paciente(s) en estado crítico según su última lectura:\n"
+            texto_resp += "\n".join(f"- {p['nombre']}: {p['temperatura_c']} °C, {p['ritmo_cardiaco']} bpm"
+                                    for p in criticos[:10])
+            if len(criticos) > 10:
+                texto_resp += f"\n... y {len(criticos) - 10} más (ver Semáforo)."
+        return texto_resp + f"\nLecturas críticas en las últimas 24h: {snapshot['criticos_24h']}."
+
+    # Pregunta sobre un paciente sin nombre reconocible: que la responda el LLM
+    return None
+
+
 # -----------------------------
 # Ejecutar aplicación cuando se lance el script
 # -----------------------------
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+benchmark_rutas.py
+Mide la latencia y las consultas SQL por request de las rutas principales de app.py y las compara
+contra una línea base guardada, para detectar regresiones antes de desplegar.
+- Por cada escala crea (si no existe) la base vida_bench_<escala> en el servidor indicado y la llena
+  con los datos sintéticos de verificar_planes.py: 100, 1k o 10k pacientes con ~11 mil lecturas por
+  pulsera (≈1M, 10M y 100M lecturas). La carga de 10k tarda bastante y ocupa decenas de GB.
+- Cada escala se mide en un proceso aparte (app.py lee DB_URL al importarse) usando el test client
+  de Flask con sesión de admin. obtener_cliente_llm se reemplaza por un cliente que falla si se usa
+  (aunque .env defina GROQ_API_KEY): ninguna ruta medida debe llamar al LLM.
+- Las consultas por request salen de las métricas de app.py (vida_db_consultas_por_request).
+- Con --guardar-base escribe la línea base; si no, compara contra ella y termina con código 1 si
+  alguna ruta empeoró (p50 más de --tolerancia por encima de la base, o más consultas por request).
+  La base no está en el repositorio: los tiempos dependen de la máquina, así que cada una genera
+  la suya (con el código de main) antes de comparar.
+Usar un servidor de prueba, nunca el de producción: registrar_lectura inserta lecturas.
+
+Uso:
+    python api/benchmark_rutas.py --servidor postgresql://postgres@localhost/postgres --guardar-base
+    python api/benchmark_rutas.py --servidor postgresql://postgres@localhost/postgres --escalas 100,1k
+(o definir BENCH_SERVIDOR_URL en lugar de --servidor)
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extensions import make_dsn
+
+load_dotenv()
+
+DIR_API = os.path.dirname(os.path.abspath(__file__))
+BASE_DEFECTO = os.path.join(DIR_API, 'benchmark_base.json')
+
+# escala: (pacientes, lecturas por pulsera); 9 de cada 10 pacientes tienen pulsera
+ESCALAS = {
+    '100': (100, 11_112),
+    '1k': (1_000, 11_112),
+    '10k': (10_000, 11_112),
+}
+# Diferencias de p50 por debajo de este margen se consideran ruido aunque superen la tolerancia
+MARGEN_RUIDO_MS = 2.0
+
+
+# ================================
+#   BASES DE PRUEBA
+# ================================
+def url_base(servidor, nombre):
+    return make_dsn(servidor, dbname=nombre)
+
+
+def preparar_base(servidor, escala, dias):
+    """Crea y llena vida_bench_<escala> si hace falta. Devuelve su URL."""
+    from verificar_planes import cargar_datos
+
+    nombre = f"vida_bench_{escala}"
+    admin = psycopg2.connect(servidor)
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_database WHERE datname = %s);", (nombre,))
+    if not cur.fetchone()[0]:
+        print(f"→ creando {nombre}")
+        cur.execute(f"CREATE DATABASE {nombre} ENCODING 'UTF8' TEMPLATE template0;")
+    cur.close()
+    admin.close()
+
+    url = url_base(servidor, nombre)
+    conn = psycopg2.connect(url)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('pacientes') IS NOT NULL;")
+        cargada = cur.fetchone()[0]
+        if cargada:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pacientes);")
+            cargada = cur.fetchone()[0]
+        cur.close()
+        conn.rollback()
+        if not cargada:
+            pacientes, lecturas_por_pulsera = ESCALAS[escala]
+            print(f"→ cargando {nombre}: {pacientes} pacientes, {lecturas_por_pulsera} lecturas por pulsera")
+            cargar_datos(conn, pacientes, lecturas_por_pulsera, dias)
+    finally:
+        conn.close()
+    return url
+
+
+# ================================
+#   MEDICIÓN (proceso por escala)
+# ================================
+def rutas_a_medir(ids_pulsera, ids_paciente):
+    """(endpoint, método, función que arma url y cuerpo JSON) de las rutas medidas."""
+    def pulsera():
+        return random.choice(ids_pulsera)
+
+    def paciente():
+        return random.choice(ids_paciente)
+
+    return [
+        ("dashboard", "GET", lambda: ("/dashboard", None)),
+        ("semaforo", "GET", lambda: ("/semaforo", None)),
+        ("ver_pacientes", "GET", lambda: ("/ver-pacientes", None)),
+        ("buscar_pacientes", "GET",
+         lambda: (f"/buscar-pacientes?busqueda=Paterno{random.randint(1, 499)}", None)),
+        ("obtener_lecturas", "GET", lambda: (f"/pulsera/{pulsera()}/lecturas?limit=50", None)),
+        ("historial_paciente", "GET", lambda: (f"/historial-paciente/{paciente()}", None)),
+        # Al final: cada lectura nueva invalida la versión de datos de las rutas anteriores
+        ("registrar_lectura", "POST",
+         lambda: (f"/pulsera/{pulsera()}/lectura",
+                  {"ritmo_cardiaco": random.randint(60, 100), "temperatura_c": round(random.uniform(36, 37.5), 1),
+                   "esta_puesta": True})),
+    ]
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+class ClienteLLMProhibido:
+    """Reemplazo del cliente de Groq durante la medición: cualquier uso es un error de la ruta."""
+
+    def __getattr__(self, nombre):
+        raise RuntimeError(f"Una ruta medida intentó usar el LLM ({nombre})")
+
+
+def medir(db_url, repeticiones, calentamiento):
+    """Mide las rutas contra db_url. Devuelve {ruta: {p50_ms, p95_ms, media_ms, consultas}}."""
+    os.environ['DB_URL'] = db_url
+    import app as modulo_app
+    # app.py carga .env al importarse: quitar GROQ_API_KEY del entorno antes no alcanza
+    modulo_app.obtener_cliente_llm = ClienteLLMProhibido
+
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+    cur.execute("SELECT id_pulsera FROM pulseras WHERE id_paciente IS NOT NULL ORDER BY id_pulsera LIMIT 50;")
+    ids_pulsera = [fila[0] for fila in cur.fetchall()]
+    cur.execute("SELECT id_paciente FROM pacientes ORDER BY id_paciente LIMIT 50;")
+    ids_paciente = [fila[0] for fila in cur.fetchall()]
+    cur.close()
+    conn.close()
+    if not ids_pulsera:
+        raise RuntimeError("La base de prueba no tiene pulseras asignadas")
+
+    # Misma secuencia de ids y valores en cada corrida, para que los resultados sean comparables
+    random.seed(0)
+    modulo_app.app.testing = True
+    cliente = modulo_app.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['logged_in'] = True
+        sesion['username'] = 'benchmark'
+        sesion['tipo_usuario'] = 'admin'
+
+    resultados = {}
+    for endpoint, metodo, armar in rutas_a_medir(ids_pulsera, ids_paciente):
+        tiempos = []
+        for i in range(calentamiento + repeticiones):
+            if i == calentamiento:
+                total_antes, consultas_antes = modulo_app.metrica_consultas_request.resumen(endpoint)
+            url, cuerpo = armar()
+            inicio = time.perf_counter()
+            respuesta = cliente.open(url, method=metodo, json=cuerpo)
+            respuesta.get_data()  # las páginas en stream se consultan mientras se envían
+            duracion = time.perf_counter() - inicio
+            respuesta.close()
+            if respuesta.status_code >= 400:
+                raise RuntimeError(f"{endpoint} respondió {respuesta.status_code} ({url})")
+            if i >= calentamiento:
+                tiempos.append(duracion * 1000)
+        total, consultas = modulo_app.metrica_consultas_request.resumen(endpoint)
+        medidas = total - total_antes
+        resultados[endpoint] = {
+            "p50_ms": round(statistics.median(tiempos), 2),
+            "p95_ms": round(percentil(tiempos, 95), 2),
+            "media_ms": round(statistics.fmean(tiempos), 2),
+            "consultas": round((consultas - consultas_antes) / medidas, 2) if medidas else 0.0,
+        }
+    return resultados
+
+
+# ================================
+#   LÍNEA BASE
+# ================================
+def comparar(resultados, base, tolerancia):
+    """Lista de (escala, ruta, problema) donde los resultados empeoraron respecto de la base."""
+    regresiones = []
+    for escala, rutas in resultados.items():
+        for ruta, actual in rutas.items():
+            anterior = base.get(escala, {}).get(ruta)
+            if anterior is None:
+                continue
+            limite = anterior["p50_ms"] * (1 + tolerancia)
+            if actual["p50_ms"] > limite and actual["p50_ms"] - anterior["p50_ms"] > MARGEN_RUIDO_MS:
+                regresiones.append((escala, ruta, f"p50 {actual['p50_ms']:.1f} ms > {limite:.1f} ms"))
+            # Las consultas por request no dependen de la máquina; registrar_lectura varía un poco
+            # según las alertas que dispare cada lectura
+            if actual["consultas"] > anterior["consultas"] * 1.1 + 0.5:
+                regresiones.append((escala, ruta,
+                                    f"{actual['consultas']:.1f} consultas/request (base {anterior['consultas']:.1f})"))
+    return regresiones
+
+
+def imprimir(escala, rutas, base):
+    print(f"\nEscala {escala}")
+    print(f"{'ruta':<20} {'p50 ms':>9} {'p95 ms':>9} {'media ms':>9} {'consultas':>10}  {'base p50':>9}")
+    print("-" * 74)
+    for ruta, r in rutas.items():
+        anterior = base.get(escala, {}).get(ruta)
+        referencia = f"{anterior['p50_ms']:>9.1f}" if anterior else f"{'-':>9}"
+        print(f"{ruta:<20} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['media_ms']:>9.1f} "
+              f"{r['consultas']:>10.1f}  {referencia}")
+
+
+def medir_escala(db_url, args):
+    """Corre la medición en un proceso nuevo (app.py toma DB_URL y sus cachés al importarse)."""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        salida = f.name
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--medir', db_url, '--salida', salida,
+                        '--repeticiones', str(args.repeticiones), '--calentamiento', str(args.calentamiento)],
+                       check=True, cwd=DIR_API)
+        with open(salida, encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.unlink(salida)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de las rutas principales de app.py")
+    parser.add_argument('--servidor', default=os.getenv('BENCH_SERVIDOR_URL'),
+                        help="URL de un servidor Postgres de prueba (base de mantenimiento, ej. /postgres)")
+    parser.add_argument('--escalas', default='100', help=f"Escalas separadas por coma: {', '.join(ESCALAS)}")
+    parser.add_argument('--repeticiones', type=int, default=30)
+    parser.add_argument('--calentamiento', type=int, default=3)
+    parser.add_argument('--dias', type=int, default=90, help="Periodo que cubren las lecturas sintéticas")
+    parser.add_argument('--base', default=BASE_DEFECTO, help="Archivo JSON de la línea base")
+    parser.add_argument('--guardar-base', action='store_true', help="Guardar los resultados como línea base")
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="Aumento de p50 tolerado (0.25 = 25%%)")
+    parser.add_argument('--medir', metavar='DB_URL', help=argparse.SUPPRESS)
+    parser.add_argument('--salida', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(medir(args.medir, args.repeticiones, args.calentamiento), f)
+        sys.exit(0)
+
+    if not args.servidor:
+        raise RuntimeError('Indicar el servidor de prueba con --servidor o BENCH_SERVIDOR_URL')
+    escalas = [e.strip() for e in args.escalas.split(',') if e.strip()]
+    desconocidas = [e for e in escalas if e not in ESCALAS]
+    if desconocidas:
+        raise RuntimeError(f"Escalas desconocidas: {', '.join(desconocidas)} (válidas: {', '.join(ESCALAS)})")
+
+    base = {}
+    if os.path.exists(args.base):
+        with open(args.base, encoding='utf-8') as f:
+            base = json.load(f)
+
+    resultados = {}
+    for escala in escalas:
+        db_url = preparar_base(args.servidor, escala, args.dias)
+        resultados[escala] = medir_escala(db_url, args)
+        imprimir(escala, resultados[escala], base)
+    print()
+
+    if args.guardar_base:
+        base.update(resultados)
+        with open(args.base, 'w', encoding='utf-8') as f:
+            json.dump(base, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"✅ Línea base guardada en {args.base}")
+        sys.exit(0)
+    if not base:
+        print(f"⚠️  No hay línea base en {args.base}: correr con --guardar-base para crearla")
+        sys.exit(0)
+
+    regresiones = comparar(resultados, base, args.tolerancia)
+    for escala, ruta, problema in regresiones:
+        print(f"❌ [{escala}] {ruta}: {problema}")
+    print(f"❌ {len(regresiones)} regresiones" if regresiones else "✅ Sin regresiones respecto de la línea base")
+    sys.exit(1 if regresiones else 0)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+compilar_templates.py
+Precompila los templates de api/templates/ en la caché de bytecode de Jinja que usa app.py
+(TEMPLATES_CACHE_DIR, por defecto api/templates_cache/).
+- Correr en el paso de despliegue, con la misma versión de Python que atiende: el bytecode depende
+  de ella y Jinja ignora el de otra versión.
+- Jinja guarda cada template con la huella de su código fuente: si el archivo cambia, lo vuelve a
+  compilar en lugar de usar el bytecode viejo.
+- Informa lo que tarda compilar cada template contra cargarlo desde la caché.
+No se conecta a la base: si DB_URL no está definida usa una URL de relleno.
+
+Uso:
+    python api/compilar_templates.py               # compila los templates pendientes
+    python api/compilar_templates.py --limpiar     # borra la caché y compila todo de nuevo
+(junto con `python -m compileall api` para que app.py tampoco se compile en cada arranque)
+"""
+import argparse
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DIR_API = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_CACHE_DIR = os.getenv("TEMPLATES_CACHE_DIR", os.path.join(DIR_API, "templates_cache"))
+
+
+def cargar_app():
+    """Importa app.py con la caché ya creada (app.py solo la activa si el directorio existe)."""
+    os.makedirs(TEMPLATES_CACHE_DIR, exist_ok=True)
+    os.environ['TEMPLATES_CACHE_DIR'] = TEMPLATES_CACHE_DIR
+    os.environ.setdefault('DB_URL', 'postgresql://templates@localhost/templates')
+    sys.path.insert(0, DIR_API)
+    import app
+    return app.app
+
+
+def medir(entorno, nombre):
+    inicio = time.perf_counter()
+    entorno.get_template(nombre)
+    return (time.perf_counter() - inicio) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompila los templates en la caché de bytecode de Jinja")
+    parser.add_argument('--limpiar', action='store_true', help="Borrar la caché antes de compilar")
+    args = parser.parse_args()
+
+    flask_app = cargar_app()
+    cache = flask_app.jinja_env.bytecode_cache
+    if cache is None:
+        raise RuntimeError(f"app.py no activó la caché de bytecode en {TEMPLATES_CACHE_DIR}")
+    if args.limpiar:
+        cache.clear()
+
+    # Entornos con los filtros de app.py pero sin templates en memoria (cache_size=0)
+    sin_bytecode = flask_app.jinja_env.overlay(cache_size=0, bytecode_cache=None)
+    con_bytecode = flask_app.jinja_env.overlay(cache_size=0)
+
+    print(f"{'template':<32} {'compilar ms':>12} {'cargar ms':>10}")
+    print("-" * 56)
+    total_compilar = total_cargar = 0.0
+    nombres = sorted(n for n in flask_app.jinja_env.list_templates() if n.endswith('.html'))
+    for nombre in nombres:
+        compilar = medir(sin_bytecode, nombre)
+        con_bytecode.get_template(nombre)  # compila y guarda si no estaba en la caché
+        cargar = medir(con_bytecode, nombre)
+        total_compilar += compilar
+        total_cargar += cargar
+        print(f"{nombre:<32} {compilar:>12.1f} {cargar:>10.1f}")
+    print("-" * 56)
+    print(f"{'total':<32} {total_compilar:>12.1f} {total_cargar:>10.1f}")
+    print(f"\n✅ {len(nombres)} templates en {TEMPLATES_CACHE_DIR}")
@@ -0,0 +1,46 @@
+-- Tablas base de la aplicación. Antes las creaba un init_db.sql externo al repositorio;
+-- con IF NOT EXISTS esta migración no cambia nada en bases ya creadas con ese script.
+
+CREATE TABLE IF NOT EXISTS pacientes (
+    id_paciente SERIAL PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    apellido_paterno TEXT NOT NULL,
+    apellido_materno TEXT,
+    fecha_nacimiento DATE,
+    genero TEXT
+);
+
+CREATE TABLE IF NOT EXISTS usuarios (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT,
+    fecha_creacion TIMESTAMP DEFAULT NOW(),
+    nombre_completo TEXT,
+    tipo_usuario TEXT,
+    id_paciente_asignado INTEGER REFERENCES pacientes(id_paciente),
+    parentesco TEXT
+);
+
+CREATE TABLE IF NOT EXISTS pulseras (
+    id_pulsera INTEGER PRIMARY KEY,
+    id_paciente INTEGER REFERENCES pacientes(id_paciente),
+    fecha_asignacion TIMESTAMP DEFAULT NOW()
+);
+
+-- Para particionarla por tiempo ver particiones_lecturas.py
+CREATE TABLE IF NOT EXISTS lecturas (
+    id_lectura SERIAL PRIMARY KEY,
+    id_pulsera INTEGER REFERENCES pulseras(id_pulsera),
+    ritmo_cardiaco INTEGER,
+    temperatura_c NUMERIC(4,1),
+    esta_puesta BOOLEAN,
+    momento_lectura TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS historial_medico (
+    id_historial SERIAL PRIMARY KEY,
+    id_paciente INTEGER NOT NULL REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
+    titulo TEXT NOT NULL,
+    descripcion TEXT,
+    creado_por TEXT,
+    fecha TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
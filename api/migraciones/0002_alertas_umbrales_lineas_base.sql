@@ -0,0 +1,49 @@
+-- Tablas del motor de alertas, de los umbrales del semáforo y de las líneas base por paciente.
+
+-- Eventos del motor de alertas (solo cambios de estado: 'activada' / 'resuelta')
+CREATE TABLE IF NOT EXISTS alertas (
+    id_alerta SERIAL PRIMARY KEY,
+    id_paciente INTEGER NOT NULL REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
+    id_lectura INTEGER,
+    signo TEXT NOT NULL,
+    evento TEXT NOT NULL,
+    valor NUMERIC(5,1),
+    mensaje TEXT,
+    momento TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_alertas_paciente_signo ON alertas (id_paciente, signo, momento DESC);
+CREATE INDEX IF NOT EXISTS idx_alertas_momento ON alertas (momento DESC);
+
+-- Umbrales del semáforo: id_paciente NULL = generales, con id = excepción para ese paciente.
+-- Sin fila general se usan los valores de UMBRALES_DEFECTO (app.py).
+CREATE TABLE IF NOT EXISTS umbrales_vitales (
+    id_umbral SERIAL PRIMARY KEY,
+    id_paciente INTEGER REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
+    signo TEXT NOT NULL CHECK (signo IN ('temperatura', 'ritmo')),
+    critico_min NUMERIC(5,1) NOT NULL,
+    estable_min NUMERIC(5,1) NOT NULL,
+    estable_max NUMERIC(5,1) NOT NULL,
+    critico_max NUMERIC(5,1) NOT NULL,
+    modificado_por TEXT,
+    actualizado TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    CHECK (critico_min <= estable_min AND estable_min <= estable_max AND estable_max <= critico_max)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_umbrales_paciente_signo ON umbrales_vitales ((COALESCE(id_paciente, 0)), signo);
+
+-- Línea base de signos vitales por paciente (detección de tendencias anómalas)
+CREATE TABLE IF NOT EXISTS lineas_base_vitales (
+    id_paciente INTEGER NOT NULL REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
+    signo TEXT NOT NULL,
+    rapida DOUBLE PRECISION NOT NULL,
+    lenta DOUBLE PRECISION NOT NULL,
+    peso_rapida DOUBLE PRECISION NOT NULL,
+    peso_lenta DOUBLE PRECISION NOT NULL,
+    varianza DOUBLE PRECISION NOT NULL,
+    n INTEGER NOT NULL,
+    ultima_lectura TIMESTAMP NOT NULL,
+    anomalo BOOLEAN NOT NULL DEFAULT FALSE,
+    z DOUBLE PRECISION,
+    actualizado TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (id_paciente, signo)
+);
+CREATE INDEX IF NOT EXISTS idx_lineas_base_anomalas ON lineas_base_vitales (id_paciente) WHERE anomalo;
@@ -0,0 +1,26 @@
+-- migracion: sin-transaccion
+-- Índices de las consultas frecuentes de app.py. Se crean con CONCURRENTLY para no bloquear
+-- escrituras en una base en uso (migrar.py lo adapta si `lecturas` está particionada).
+--
+-- Consultas ya cubiertas por claves primarias, sin índice adicional:
+--   pacientes.id_paciente, pulseras.id_pulsera (validar pulsera al registrar una lectura),
+--   lecturas.id_lectura (versión de datos: ORDER BY id_lectura DESC LIMIT 1),
+--   historial_medico.id_historial, lineas_base_vitales (id_paciente, signo).
+
+-- Última lectura por pulsera (LATERAL ... ORDER BY momento_lectura DESC LIMIT 1 en semáforo,
+-- listas, búsqueda, dashboard y chatbot), historial de una pulsera y versión por pulsera.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lecturas_pulsera_momento ON lecturas (id_pulsera, momento_lectura DESC);
+
+-- Ventanas de tiempo: conteos de 24h, tendencia de 7 días, recálculo de líneas base.
+-- Las lecturas se insertan en orden de tiempo, así que BRIN alcanza y casi no ocupa espacio.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lecturas_momento ON lecturas USING brin (momento_lectura);
+
+-- Historial médico de un paciente (WHERE id_paciente = %s ORDER BY fecha DESC).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_historial_paciente_fecha ON historial_medico (id_paciente, fecha DESC);
+
+-- Login, perfil y paciente asignado de un familiar (WHERE username = %s). En bases donde username
+-- no es clave primaria es el único índice de esta búsqueda.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_usuarios_username ON usuarios (username);
+
+-- Pulsera de un paciente (JOIN pulseras pu ON pu.id_paciente = p.id_paciente, familiar).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pulseras_paciente ON pulseras (id_paciente);
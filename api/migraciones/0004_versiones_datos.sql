@@ -0,0 +1,41 @@
+-- Contadores de cambios por tabla para la versión de datos de los GET condicionales (ETag).
+-- Cada sentencia que escribe en una de estas tablas suma 1 a su fila; leer la versión cuesta
+-- una lectura de esta tabla chica en lugar de COUNT(*) sobre pacientes y pulseras.
+-- Las lecturas no pasan por aquí: su versión es el id más alto (solo se insertan).
+CREATE TABLE IF NOT EXISTS versiones_datos (
+    tabla TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    cambiado_en TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO versiones_datos (tabla)
+VALUES ('pacientes'), ('pulseras'), ('usuarios'), ('alertas'), ('umbrales_vitales')
+ON CONFLICT (tabla) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION registrar_version_datos() RETURNS trigger AS $$
+BEGIN
+    UPDATE versiones_datos SET version = version + 1, cambiado_en = NOW() WHERE tabla = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS version_datos ON pacientes;
+CREATE TRIGGER version_datos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pacientes
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_version_datos();
+
+DROP TRIGGER IF EXISTS version_datos ON pulseras;
+CREATE TRIGGER version_datos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pulseras
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_version_datos();
+
+-- De usuarios solo importa lo que cambia el alcance de un familiar (no contraseñas ni nombres)
+DROP TRIGGER IF EXISTS version_datos ON usuarios;
+CREATE TRIGGER version_datos AFTER INSERT OR DELETE OR UPDATE OF id_paciente_asignado, tipo_usuario ON usuarios
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_version_datos();
+
+DROP TRIGGER IF EXISTS version_datos ON alertas;
+CREATE TRIGGER version_datos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON alertas
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_version_datos();
+
+DROP TRIGGER IF EXISTS version_datos ON umbrales_vitales;
+CREATE TRIGGER version_datos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON umbrales_vitales
+    FOR EACH STATEMENT EXECUTE FUNCTION registrar_version_datos();
@@ -0,0 +1,9 @@
+-- Historial de conversación del chatbot, compartido por todos los procesos e instancias.
+-- La clave es el id aleatorio guardado en la sesión firmada; `mensajes` es una lista de
+-- [rol, texto] acotada por app.py. Las conversaciones vencidas se borran al registrar turnos.
+CREATE TABLE IF NOT EXISTS conversaciones_chatbot (
+    id_conversacion TEXT PRIMARY KEY,
+    mensajes JSONB NOT NULL DEFAULT '[]',
+    actualizado TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_conversaciones_chatbot_actualizado ON conversaciones_chatbot (actualizado);
@@ -0,0 +1,22 @@
+-- Preguntas al LLM (modo asíncrono del chatbot y cupo compartido por todos los procesos).
+-- Cualquier instancia puede responder la consulta de un trabajo o, si nadie lo tomó, ejecutarlo.
+-- estado: en_cola -> en_proceso -> listo | error. `respuesta` se va completando a medida que llega.
+CREATE TABLE IF NOT EXISTS trabajos_chatbot (
+    id_trabajo TEXT PRIMARY KEY,
+    usuario TEXT NOT NULL,
+    estado TEXT NOT NULL DEFAULT 'en_cola',
+    mensajes JSONB NOT NULL,
+    -- Para registrar el turno en conversaciones_chatbot y cachear la respuesta al terminar
+    id_conversacion TEXT,
+    pregunta TEXT,
+    clave_respuesta JSONB,
+    respuesta TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    creado_en TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    actualizado TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+-- Cupo: trabajos pendientes por usuario y en total
+CREATE INDEX IF NOT EXISTS idx_trabajos_chatbot_pendientes ON trabajos_chatbot (usuario)
+    WHERE estado IN ('en_cola', 'en_proceso');
+CREATE INDEX IF NOT EXISTS idx_trabajos_chatbot_creado ON trabajos_chatbot (creado_en);
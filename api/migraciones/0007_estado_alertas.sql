@@ -0,0 +1,22 @@
+-- Estado del motor de alertas por paciente y signo, compartido por todos los procesos.
+-- Se lee con FOR UPDATE y se actualiza en la misma transacción que inserta la lectura, así
+-- dos lecturas del mismo paciente en workers distintos no pierden el conteo del antirrebote.
+CREATE TABLE IF NOT EXISTS estado_alertas (
+    id_paciente INTEGER NOT NULL REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
+    signo TEXT NOT NULL,
+    critico BOOLEAN NOT NULL DEFAULT FALSE,
+    -- Lecturas consecutivas en el estado contrario al actual
+    seguidas INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (id_paciente, signo)
+);
+
+-- Alertas que ya estaban activas según el último evento de cada signo
+INSERT INTO estado_alertas (id_paciente, signo, critico)
+SELECT id_paciente, signo, evento = 'activada'
+FROM (
+    SELECT DISTINCT ON (id_paciente, signo) id_paciente, signo, evento
+    FROM alertas
+    WHERE signo IN ('temperatura', 'ritmo')
+    ORDER BY id_paciente, signo, momento DESC, id_alerta DESC
+) ultimos
+ON CONFLICT (id_paciente, signo) DO NOTHING;
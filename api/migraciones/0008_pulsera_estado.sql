@@ -0,0 +1,27 @@
+-- Última lectura de cada pulsera y si ya se avisó que dejó de enviar datos, compartido por todos
+-- los procesos. registrar_lectura actualiza la fila en la transacción de la lectura; la revisión
+-- de plazos vencidos (app.py, DetectorPulseras.revisar) marca sin_datos bajo un advisory lock.
+CREATE TABLE IF NOT EXISTS pulsera_estado (
+    id_pulsera INTEGER PRIMARY KEY REFERENCES pulseras(id_pulsera) ON DELETE CASCADE,
+    -- Mismo tipo que lecturas.momento_lectura
+    ultima_lectura TIMESTAMP NOT NULL,
+    esta_puesta BOOLEAN,
+    sin_datos BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+-- Revisión de plazos: solo las pulseras que todavía no están marcadas sin datos
+CREATE INDEX IF NOT EXISTS idx_pulsera_estado_pendientes ON pulsera_estado (ultima_lectura) WHERE NOT sin_datos;
+
+-- Estado inicial desde la última lectura de cada pulsera. Las que ya llevan más de 15 minutos
+-- (PULSERA_MINUTOS_SIN_DATOS por defecto) quedan marcadas, para que la primera revisión no
+-- avise de golpe por todas las pulseras que dejaron de enviar antes de esta migración.
+INSERT INTO pulsera_estado (id_pulsera, ultima_lectura, esta_puesta, sin_datos)
+SELECT pu.id_pulsera, l.momento_lectura, l.esta_puesta, l.momento_lectura < NOW() - INTERVAL '15 minutes'
+FROM pulseras pu
+JOIN LATERAL (
+    SELECT esta_puesta, momento_lectura FROM lecturas
+    WHERE id_pulsera = pu.id_pulsera
+    ORDER BY momento_lectura DESC
+    LIMIT 1
+) l ON true
+ON CONFLICT (id_pulsera) DO NOTHING;
@@ -0,0 +1,4 @@
+-- Proceso que tiene el trabajo en su pool de hilos (host:pid). Mientras espera turno, ese proceso
+-- renueva `actualizado`; otra instancia solo lo reclama si no tiene propietario (serverless) o si
+-- el latido se detuvo (el proceso terminó).
+ALTER TABLE trabajos_chatbot ADD COLUMN IF NOT EXISTS propietario TEXT;
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+migrar.py
+Aplica en orden las migraciones de esquema de api/migraciones/ (NNNN_descripcion.sql).
+- Cada migración se aplica una sola vez y queda registrada en `migraciones_aplicadas` con un
+  checksum; si un archivo ya aplicado cambia, se avisa (no se vuelve a aplicar).
+- Cada archivo corre en una transacción. Los que empiezan con `-- migracion: sin-transaccion`
+  (los que usan CREATE INDEX CONCURRENTLY) se ejecutan sentencia por sentencia en autocommit;
+  por eso deben ser idempotentes (IF NOT EXISTS) y no usar bloques DO.
+- CREATE INDEX CONCURRENTLY no existe para tablas particionadas: en ese caso se crea el índice
+  en cada partición con CONCURRENTLY y luego el del padre con ON ONLY + ATTACH PARTITION.
+- Un bloqueo consultivo evita que dos procesos migren a la vez.
+
+Uso:
+    python api/migrar.py            # aplica las migraciones pendientes
+    python api/migrar.py estado     # lista aplicadas y pendientes
+"""
+import hashlib
+import os
+import re
+import sys
+from collections import namedtuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+DIR_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migraciones')
+PATRON_ARCHIVO = re.compile(r'^(\d{4})_(\w+)\.sql$')
+MARCA_SIN_TRANSACCION = '-- migracion: sin-transaccion'
+# Identificador del bloqueo consultivo (pg_advisory_lock) de las migraciones
+CLAVE_BLOQUEO = 4_272_042
+
+PATRON_INDICE_CONCURRENTE = re.compile(
+    r'^CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+ON\s+(\w+)\s+(.*)$',
+    re.IGNORECASE | re.DOTALL)
+
+Migracion = namedtuple('Migracion', 'version nombre sql checksum transaccional')
+
+
+def leer_migraciones():
+    migraciones = []
+    for archivo in sorted(os.listdir(DIR_MIGRACIONES)):
+        coincidencia = PATRON_ARCHIVO.match(archivo)
+        if not coincidencia:
+            continue
+        with open(os.path.join(DIR_MIGRACIONES, archivo), encoding='utf-8') as f:
+            sql = f.read()
+        migraciones.append(Migracion(
+            version=coincidencia.group(1),
+            nombre=coincidencia.group(2),
+            sql=sql,
+            checksum=hashlib.sha256(sql.encode('utf-8')).hexdigest(),
+            transaccional=not sql.lstrip().startswith(MARCA_SIN_TRANSACCION),
+        ))
+    versiones = [m.version for m in migraciones]
+    if len(set(versiones)) != len(versiones):
+        raise RuntimeError(f"Hay versiones de migración repetidas en {DIR_MIGRACIONES}")
+    return migraciones
+
+
+def dividir_sentencias(sql):
+    """Sentencias de un archivo sin transacción: separadas por ';' al final de línea, sin comentarios."""
+    lineas = [linea for linea in sql.splitlines() if not linea.strip().startswith('--')]
+    return [s.strip() for s in re.split(r';\s*$', '\n'.join(lineas), flags=re.MULTILINE) if s.strip()]
+
+
+# ---- Índices concurrentes ----
+
+def _existe_relacion(cur, nombre):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (nombre,))
+    return cur.fetchone()[0]
+
+
+def _particiones(cur, tabla):
+    """Particiones directas de `tabla`, o None si no es una tabla particionada."""
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s));", (tabla,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname;
+    """, (tabla,))
+    return [fila[0] for fila in cur.fetchall()]
+
+
+def _borrar_indice_invalido(cur, nombre):
+    """Un CREATE INDEX CONCURRENTLY interrumpido deja un índice inválido que IF NOT EXISTS saltearía."""
+    cur.execute("""
+        SELECT NOT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s);
+    """, (nombre,))
+    fila = cur.fetchone()
+    if fila and fila[0]:
+        print(f"   borrando índice inválido {nombre}")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre};")
+
+
+def crear_indice_concurrente(cur, unico, nombre, tabla, definicion):
+    particiones = _particiones(cur, tabla)
+    if particiones is None:
+        _borrar_indice_invalido(cur, nombre)
+        cur.execute(f"CREATE {unico}INDEX CONCURRENTLY IF NOT EXISTS {nombre} ON {tabla} {definicion};")
+        return
+    if _existe_relacion(cur, nombre):
+        return
+    # Índice por partición sin bloquear escrituras, luego el del padre (ON ONLY no recorre datos)
+    hijos = []
+    for particion in particiones:
+        hijo = f"{particion}_{nombre}"[:63]
+        _borrar_indice_invalido(cur, hijo)
+        cur.execute(f"CREATE {unico}INDEX CONCURRENTLY IF NOT EXISTS {hijo} ON {particion} {definicion};")
+        hijos.append(hijo)
+    cur.execute(f"CREATE {unico}INDEX IF NOT EXISTS {nombre} ON ONLY {tabla} {definicion};")
+    for hijo in hijos:
+        cur.execute(f"ALTER INDEX {nombre} ATTACH PARTITION {hijo};")
+
+
+def ejecutar_sin_transaccion(cur, sql):
+    for sentencia in dividir_sentencias(sql):
+        indice = PATRON_INDICE_CONCURRENTE.match(sentencia)
+        if indice:
+            unico, nombre, tabla, definicion = indice.groups()
+            crear_indice_concurrente(cur, unico or '', nombre, tabla, definicion)
+        else:
+            cur.execute(sentencia)
+
+
+# ---- Aplicar ----
+
+def _preparar(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS migraciones_aplicadas (
+            version TEXT PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            aplicada_en TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """)
+    cur.execute("SELECT version, checksum FROM migraciones_aplicadas;")
+    return dict(cur.fetchall())
+
+
+def aplicar_migraciones(conn):
+    """Aplica las migraciones pendientes. Devuelve la lista de versiones aplicadas."""
+    autocommit_original = conn.autocommit
+    conn.commit()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (CLAVE_BLOQUEO,))
+    aplicadas = []
+    try:
+        registradas = _preparar(cur)
+        for migracion in leer_migraciones():
+            checksum = registradas.get(migracion.version)
+            if checksum is not None:
+                if checksum != migracion.checksum:
+                    print(f"⚠️  {migracion.version}_{migracion.nombre} cambió después de aplicarse (no se reaplica)")
+                continue
+
+            print(f"→ {migracion.version}_{migracion.nombre}")
+            if migracion.transaccional:
+                conn.autocommit = False
+                try:
+                    cur.execute(migracion.sql)
+                    cur.execute("INSERT INTO migraciones_aplicadas (version, nombre, checksum) VALUES (%s, %s, %s);",
+                                (migracion.version, migracion.nombre, migracion.checksum))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            else:
+                ejecutar_sin_transaccion(cur, migracion.sql)
+                cur.execute("INSERT INTO migraciones_aplicadas (version, nombre, checksum) VALUES (%s, %s, %s);",
+                            (migracion.version, migracion.nombre, migracion.checksum))
+            aplicadas.append(migracion.version)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s);", (CLAVE_BLOQUEO,))
+        cur.close()
+        conn.autocommit = autocommit_original
+    return aplicadas
+
+
+def estado(conn):
+    cur = conn.cursor()
+    registradas = _preparar(cur)
+    conn.commit()
+    cur.execute("SELECT version, aplicada_en FROM migraciones_aplicadas;")
+    fechas = dict(cur.fetchall())
+    cur.close()
+    for migracion in leer_migraciones():
+        if migracion.version not in registradas:
+            marca = "pendiente"
+        elif registradas[migracion.version] != migracion.checksum:
+            marca = f"aplicada {fechas[migracion.version]:%Y-%m-%d %H:%M} (archivo modificado)"
+        else:
+            marca = f"aplicada {fechas[migracion.version]:%Y-%m-%d %H:%M}"
+        print(f"{migracion.version}_{migracion.nombre:<40} {marca}")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    db_url = os.getenv('DB_URL')
+    if not db_url:
+        raise RuntimeError('No se encontró la variable de entorno DB_URL')
+
+    conn = psycopg2.connect(db_url)
+    try:
+        if sys.argv[1:] == ['estado']:
+            estado(conn)
+        elif sys.argv[1:]:
+            sys.exit(__doc__)
+        else:
+            aplicadas = aplicar_migraciones(conn)
+            print(f"✅ {len(aplicadas)} migraciones aplicadas" if aplicadas else "✅ Esquema al día")
+    finally:
+        conn.close()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+particiones_lecturas.py
+Particionado por tiempo de la tabla `lecturas` (PARTITION BY RANGE (momento_lectura)).
+
+Todas las consultas de la aplicación filtran `lecturas` por momento_lectura (conteos de 24h,
+tendencia de 7 días, última lectura por pulsera), así que con particiones mensuales o semanales
+PostgreSQL descarta las particiones viejas y borrar datos antiguos es quitar una tabla entera en
+vez de un DELETE masivo.
+
+Subcomandos:
+- migrar:   convierte `lecturas` en tabla particionada (una sola vez). Crea la tabla nueva con
+            las particiones del historial, las próximas y una partición DEFAULT que recibe
+            cualquier lectura fuera de rango, para que nunca falle un INSERT. Copia las filas en
+            lotes mientras la aplicación sigue insertando; el bloqueo exclusivo se toma solo al
+            final, para copiar las lecturas que llegaron durante la copia y cambiar los nombres.
+- mantener: crea las particiones de los próximos periodos (LECTURAS_PARTICIONES_ADELANTE) y
+            archiva las que quedaron fuera de la retención: exporta sus filas a un CSV comprimido
+            en LECTURAS_DIR_ARCHIVO y quita la partición. Pensado para un cron diario.
+- estado:   lista las particiones con su rango y cantidad de filas.
+
+Configuración (variables de entorno):
+    LECTURAS_PARTICION              'mes' (defecto) o 'semana'
+    LECTURAS_PARTICIONES_ADELANTE   periodos futuros creados por adelantado (defecto 3)
+    LECTURAS_RETENCION_DIAS         antigüedad a partir de la cual se archiva (defecto 365; 0 = nunca)
+    LECTURAS_DIR_ARCHIVO            carpeta de los archivos .csv.gz (defecto archivo_lecturas)
+    LECTURAS_LOTE_COPIA             lecturas por transacción al migrar (defecto 50000)
+
+Uso:
+    python api/particiones_lecturas.py migrar
+    python api/particiones_lecturas.py mantener
+    python api/particiones_lecturas.py mantener --sin-archivar
+    python api/particiones_lecturas.py estado
+"""
+import argparse
+import gzip
+import os
+import re
+from datetime import datetime, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_URL = os.getenv('DB_URL')
+if not DB_URL:
+    raise RuntimeError('No se encontró la variable de entorno DB_URL')
+
+PERIODO = os.getenv('LECTURAS_PARTICION', 'mes')
+if PERIODO not in ('mes', 'semana'):
+    raise RuntimeError("LECTURAS_PARTICION debe ser 'mes' o 'semana'")
+PARTICIONES_ADELANTE = int(os.getenv('LECTURAS_PARTICIONES_ADELANTE', '3'))
+RETENCION_DIAS = int(os.getenv('LECTURAS_RETENCION_DIAS', '365'))
+DIR_ARCHIVO = os.getenv('LECTURAS_DIR_ARCHIVO', 'archivo_lecturas')
+LOTE_COPIA = int(os.getenv('LECTURAS_LOTE_COPIA', '50000'))
+
+PARTICION_DEFECTO = 'lecturas_default'
+TABLA_ANTERIOR = 'lecturas_sin_particionar'
+# Nombre de la tabla particionada mientras se copia; al terminar pasa a ser `lecturas`
+TABLA_NUEVA = 'lecturas_particionada'
+
+# "FOR VALUES FROM ('2026-10-01 00:00:00') TO ('2026-11-01 00:00:00')"
+PATRON_RANGO = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+# ---- Periodos ----
+
+def inicio_periodo(momento):
+    """Comienzo del mes o de la semana (lunes) que contiene `momento`."""
+    dia = datetime(momento.year, momento.month, momento.day)
+    if PERIODO == 'semana':
+        return dia - timedelta(days=dia.weekday())
+    return dia.replace(day=1)
+
+
+def periodo_siguiente(inicio):
+    if PERIODO == 'semana':
+        return inicio + timedelta(days=7)
+    return datetime(inicio.year + inicio.month // 12, inicio.month % 12 + 1, 1)
+
+
+def nombre_particion(inicio):
+    if PERIODO == 'semana':
+        anio, semana, _ = inicio.isocalendar()
+        return f"lecturas_p{anio}w{semana:02d}"
+    return f"lecturas_p{inicio:%Y_%m}"
+
+
+def periodos_entre(desde, hasta):
+    """Periodos [inicio, fin) desde el que contiene `desde` hasta el que contiene `hasta`."""
+    inicio = inicio_periodo(desde)
+    while inicio <= hasta:
+        fin = periodo_siguiente(inicio)
+        yield inicio, fin
+        inicio = fin
+
+
+# ---- Consultas de catálogo ----
+
+def esta_particionada(cur):
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'lecturas'::regclass);
+    """)
+    return cur.fetchone()[0]
+
+
+def listar_particiones(cur):
+    """[(nombre, inicio, fin)] ordenadas por inicio; la partición DEFAULT tiene inicio/fin None."""
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'lecturas'::regclass;
+    """)
+    particiones = []
+    for nombre, rango in cur.fetchall():
+        coincidencia = PATRON_RANGO.search(rango)
+        if coincidencia:
+            inicio, fin = (datetime.fromisoformat(v) for v in coincidencia.groups())
+            particiones.append((nombre, inicio, fin))
+        else:
+            particiones.append((nombre, None, None))
+    return sorted(particiones, key=lambda p: (p[1] is None, p[1] or datetime.min))
+
+
+def crear_particion(cur, inicio, fin):
+    """
+    Crea la partición [inicio, fin). Si la partición DEFAULT ya tiene filas de ese rango
+    (lecturas que llegaron antes de crearla), se separa, se crea la partición, se mueven esas
+    filas y se vuelve a adjuntar, todo en la transacción en curso.
+    """
+    nombre = nombre_particion(inicio)
+    cur.execute(f"""
+        SELECT EXISTS (
+            SELECT 1 FROM {PARTICION_DEFECTO}
+            WHERE momento_lectura >= %s AND momento_lectura < %s
+        );
+    """, (inicio, fin))
+    con_filas = cur.fetchone()[0]
+
+    if con_filas:
+        cur.execute(f"ALTER TABLE lecturas DETACH PARTITION {PARTICION_DEFECTO};")
+    cur.execute(f"CREATE TABLE {nombre} PARTITION OF lecturas FOR VALUES FROM (%s) TO (%s);", (inicio, fin))
+    if con_filas:
+        cur.execute(f"""
+            WITH movidas AS (
+                DELETE FROM {PARTICION_DEFECTO}
+                WHERE momento_lectura >= %s AND momento_lectura < %s
+                RETURNING *
+            )
+            INSERT INTO lecturas SELECT * FROM movidas;
+        """, (inicio, fin))
+        print(f"   {cur.rowcount} lecturas movidas desde {PARTICION_DEFECTO}")
+        cur.execute(f"ALTER TABLE lecturas ATTACH PARTITION {PARTICION_DEFECTO} DEFAULT;")
+    return nombre
+
+
+def crear_particiones_futuras(cur, ahora):
+    existentes = {inicio for _, inicio, _ in listar_particiones(cur) if inicio is not None}
+    hasta = inicio_periodo(ahora)
+    for _ in range(PARTICIONES_ADELANTE):
+        hasta = periodo_siguiente(hasta)
+    creadas = []
+    for inicio, fin in periodos_entre(ahora, hasta):
+        if inicio not in existentes:
+            creadas.append(crear_particion(cur, inicio, fin))
+    return creadas
+
+
+# ---- Subcomandos ----
+
+def crear_tabla_nueva(cur, primera, ahora):
+    """
+    Tabla particionada TABLA_NUEVA con las mismas columnas y valores por defecto que `lecturas`
+    (incluida la secuencia de id_lectura). La clave primaria debe incluir la columna de partición.
+    Los índices llevan el sufijo _nueva hasta el cambio de nombres. Devuelve las particiones creadas.
+    """
+    cur.execute(f"""
+        CREATE TABLE {TABLA_NUEVA} (LIKE lecturas INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE (momento_lectura);
+        ALTER TABLE {TABLA_NUEVA} ADD CONSTRAINT lecturas_pkey_nueva PRIMARY KEY (id_lectura, momento_lectura);
+        ALTER TABLE {TABLA_NUEVA} ADD CONSTRAINT lecturas_id_pulsera_fkey
+            FOREIGN KEY (id_pulsera) REFERENCES pulseras(id_pulsera);
+        CREATE INDEX idx_lecturas_pulsera_momento_nueva ON {TABLA_NUEVA} (id_pulsera, momento_lectura DESC);
+        -- Dentro de cada partición las lecturas llegan en orden de tiempo: BRIN alcanza para rangos
+        CREATE INDEX idx_lecturas_momento_nueva ON {TABLA_NUEVA} USING brin (momento_lectura);
+        CREATE TABLE {PARTICION_DEFECTO} PARTITION OF {TABLA_NUEVA} DEFAULT;
+    """)
+    hasta = inicio_periodo(ahora)
+    for _ in range(PARTICIONES_ADELANTE):
+        hasta = periodo_siguiente(hasta)
+    creadas = 0
+    for inicio, fin in periodos_entre(primera or ahora, hasta):
+        cur.execute(f"CREATE TABLE {nombre_particion(inicio)} PARTITION OF {TABLA_NUEVA} "
+                    "FOR VALUES FROM (%s) TO (%s);", (inicio, fin))
+        creadas += 1
+    return creadas
+
+
+def copiar_en_lotes(conn, cur, tope):
+    """
+    Copia las lecturas con id_lectura <= tope en transacciones de LOTE_COPIA ids. Solo toma el
+    bloqueo de lectura de cada SELECT: la aplicación sigue insertando. `lecturas` solo recibe
+    INSERT, así que las filas ya copiadas no cambian. Devuelve las filas copiadas.
+    """
+    cur.execute("SELECT MIN(id_lectura) FROM lecturas;")
+    desde = (cur.fetchone()[0] or 1) - 1
+    copiadas = 0
+    while desde < tope:
+        hasta = min(desde + LOTE_COPIA, tope)
+        cur.execute(f"INSERT INTO {TABLA_NUEVA} SELECT * FROM lecturas WHERE id_lectura > %s AND id_lectura <= %s;",
+                    (desde, hasta))
+        copiadas += cur.rowcount
+        conn.commit()
+        print(f"   {copiadas} lecturas copiadas (id {hasta} de {tope})", end="\r", flush=True)
+        desde = hasta
+    print()
+    return copiadas
+
+
+def migrar(conn, conservar=False):
+    cur = conn.cursor()
+    if esta_particionada(cur):
+        print("ℹ️  `lecturas` ya está particionada; nada que migrar")
+        return
+
+    cur.execute("SELECT COUNT(*) FILTER (WHERE momento_lectura IS NULL), MIN(momento_lectura) FROM lecturas;")
+    sin_momento, primera = cur.fetchone()
+    if sin_momento:
+        raise RuntimeError(f"{sin_momento} lecturas sin momento_lectura; corrígelas antes de particionar")
+    creadas = crear_tabla_nueva(cur, primera, datetime.now())
+    conn.commit()
+
+    # Tope de la copia en lotes. SHARE espera a que terminen los INSERT en curso y frena los nuevos
+    # un instante: al leer el máximo no queda ningún id menor sin confirmar (un INSERT toma el id
+    # de la secuencia después de obtener su bloqueo).
+    cur.execute("LOCK TABLE lecturas IN SHARE MODE;")
+    cur.execute("SELECT COALESCE(MAX(id_lectura), 0), COUNT(*) FROM lecturas;")
+    tope, hasta_tope = cur.fetchone()
+    conn.commit()
+
+    try:
+        copiadas = copiar_en_lotes(conn, cur, tope)
+        if copiadas != hasta_tope:
+            raise RuntimeError(f"Se copiaron {copiadas} de {hasta_tope} lecturas; migración cancelada")
+
+        # Bloqueo exclusivo solo para las lecturas que llegaron durante la copia y el cambio de nombres
+        cur.execute("LOCK TABLE lecturas IN ACCESS EXCLUSIVE MODE;")
+        cur.execute(f"INSERT INTO {TABLA_NUEVA} SELECT * FROM lecturas WHERE id_lectura > %s;", (tope,))
+        nuevas = cur.rowcount
+        cur.execute("SELECT COUNT(*) FROM lecturas WHERE id_lectura > %s;", (tope,))
+        if cur.fetchone()[0] != nuevas:
+            raise RuntimeError("Las lecturas recibidas durante la copia no coinciden; migración cancelada")
+
+        # La tabla actual queda con otro nombre y sus índices (clave primaria y los de migraciones/)
+        # liberan el nombre para los de la tabla nueva
+        cur.execute(f"ALTER TABLE lecturas RENAME TO {TABLA_ANTERIOR};")
+        cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s;",
+                    (TABLA_ANTERIOR,))
+        for (indice,) in cur.fetchall():
+            cur.execute(f"ALTER INDEX {indice} RENAME TO {indice[:50]}_anterior;")
+        cur.execute(f"""
+            ALTER TABLE {TABLA_NUEVA} RENAME TO lecturas;
+            ALTER TABLE lecturas RENAME CONSTRAINT lecturas_pkey_nueva TO lecturas_pkey;
+            ALTER INDEX idx_lecturas_pulsera_momento_nueva RENAME TO idx_lecturas_pulsera_momento;
+            ALTER INDEX idx_lecturas_momento_nueva RENAME TO idx_lecturas_momento;
+            ALTER SEQUENCE IF EXISTS lecturas_id_lectura_seq OWNED BY lecturas.id_lectura;
+        """)
+        if not conservar:
+            cur.execute(f"DROP TABLE {TABLA_ANTERIOR};")
+        conn.commit()
+    except Exception:
+        # La tabla original sigue intacta; se quita la copia a medio hacer
+        conn.rollback()
+        cur.execute(f"DROP TABLE IF EXISTS {TABLA_NUEVA};")
+        conn.commit()
+        raise
+    cur.execute("ANALYZE lecturas;")
+    conn.commit()
+    cur.close()
+    print(f"✅ `lecturas` particionada por {PERIODO}: {copiadas + nuevas} lecturas en {creadas} particiones "
+          f"({nuevas} recibidas durante la copia)")
+    if conservar:
+        print(f"   La tabla original quedó como {TABLA_ANTERIOR}")
+
+
+def archivar_particion(conn, nombre):
+    """
+    Exporta la partición a DIR_ARCHIVO/<nombre>.csv.gz y la quita de `lecturas`. La partición se
+    bloquea contra escrituras durante la exportación y solo se borra si el archivo tiene todas
+    las filas.
+    """
+    os.makedirs(DIR_ARCHIVO, exist_ok=True)
+    ruta = os.path.join(DIR_ARCHIVO, f"{nombre}.csv.gz")
+    cur = conn.cursor()
+    cur.execute(f"LOCK TABLE {nombre} IN SHARE MODE;")
+    cur.execute(f"SELECT COUNT(*) FROM {nombre};")
+    filas = cur.fetchone()[0]
+    with gzip.open(ruta, 'wt', encoding='utf-8', newline='') as archivo:
+        cur.copy_expert(f"COPY (SELECT * FROM {nombre} ORDER BY momento_lectura) TO STDOUT WITH CSV HEADER",
+                        archivo)
+    with gzip.open(ruta, 'rt', encoding='utf-8', newline='') as archivo:
+        escritas = sum(1 for _ in archivo) - 1
+    if escritas != filas:
+        conn.rollback()
+        raise RuntimeError(f"{ruta}: {escritas} de {filas} filas; la partición no se quita")
+    cur.execute(f"ALTER TABLE lecturas DETACH PARTITION {nombre};")
+    cur.execute(f"DROP TABLE {nombre};")
+    conn.commit()
+    cur.close()
+    print(f"   📦 {nombre}: {filas} lecturas → {ruta}")
+    return filas
+
+
+def mantener(conn, archivar=True):
+    cur = conn.cursor()
+    if not esta_particionada(cur):
+        raise RuntimeError("`lecturas` no está particionada; ejecuta primero: particiones_lecturas.py migrar")
+
+    ahora = datetime.now()
+    creadas = crear_particiones_futuras(cur, ahora)
+    conn.commit()
+    print(f"✅ Particiones creadas: {', '.join(creadas) if creadas else 'ninguna (ya existían)'}")
+
+    if not archivar or RETENCION_DIAS <= 0:
+        cur.close()
+        return
+    limite = ahora - timedelta(days=RETENCION_DIAS)
+    viejas = [nombre for nombre, _, fin in listar_particiones(cur) if fin is not None and fin <= limite]
+    cur.close()
+    archivadas = sum(archivar_particion(conn, nombre) for nombre in viejas)
+    print(f"✅ Particiones archivadas: {len(viejas)} ({archivadas} lecturas anteriores a {limite:%Y-%m-%d})")
+
+
+def estado(conn):
+    cur = conn.cursor()
+    if not esta_particionada(cur):
+        cur.execute("SELECT COUNT(*) FROM lecturas;")
+        print(f"`lecturas` no está particionada ({cur.fetchone()[0]} lecturas)")
+        return
+    for nombre, inicio, fin in listar_particiones(cur):
+        cur.execute(f"SELECT COUNT(*) FROM {nombre};")
+        rango = f"{inicio:%Y-%m-%d} → {fin:%Y-%m-%d}" if inicio else "DEFAULT"
+        print(f"{nombre:<24} {rango:<26} {cur.fetchone()[0]:>10} lecturas")
+    cur.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Particionado, retención y archivo de `lecturas`")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_migrar = sub.add_parser("migrar", help="convertir `lecturas` en tabla particionada")
+    p_migrar.add_argument("--conservar", action="store_true", help=f"no borrar {TABLA_ANTERIOR}")
+    p_mantener = sub.add_parser("mantener", help="crear particiones futuras y archivar las viejas")
+    p_mantener.add_argument("--sin-archivar", action="store_true", help="solo crear particiones")
+    sub.add_parser("estado", help="listar particiones")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DB_URL)
+    try:
+        if args.comando == "migrar":
+            migrar(conn, conservar=args.conservar)
+        elif args.comando == "mantener":
+            mantener(conn, archivar=not args.sin_archivar)
+        else:
+            estado(conn)
+    finally:
+        conn.close()
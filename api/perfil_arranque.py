@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+perfil_arranque.py
+Mide el arranque en frío de app.py tal como lo paga cada instancia nueva de la función serverless.
+- Importa app.py en procesos nuevos y mide la importación, el primer request (compila el template)
+  y el segundo; informa la mediana de --repeticiones corridas.
+- Con -X importtime lista los módulos que más tardan en importarse desde app.py.
+- Verifica que los módulos que solo usan algunas rutas (groq, bcrypt...) no se carguen al importar,
+  y avisa si app.py no tiene bytecode precompilado (en un sistema de archivos de solo lectura se
+  compilaría en cada arranque: correr `python -m compileall api` al desplegar).
+- Termina con código 1 si la importación supera --presupuesto-ms o si se cargó un módulo diferido.
+No se conecta a la base: si DB_URL no está definida usa una URL de relleno.
+
+Uso:
+    python api/perfil_arranque.py
+    python api/perfil_arranque.py --repeticiones 10 --presupuesto-ms 250
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DIR_API = os.path.dirname(os.path.abspath(__file__))
+PRESUPUESTO_ARRANQUE_MS = float(os.getenv("PRESUPUESTO_ARRANQUE_MS", "300"))
+
+# Módulos que app.py importa recién al usarlos (chatbot, login/registro)
+MODULOS_DIFERIDOS = ('groq', 'httpx', 'pydantic', 'bcrypt')
+
+CODIGO_MEDICION = """
+import json, sys, time
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+cliente = app.app.test_client()
+cliente.get('/').close()
+primera = time.perf_counter()
+cliente.get('/').close()
+segunda = time.perf_counter()
+print(json.dumps({
+    "importar_ms": (importado - inicio) * 1000,
+    "primer_request_ms": (primera - importado) * 1000,
+    "segundo_request_ms": (segunda - primera) * 1000,
+    "modulos": sorted(sys.modules),
+}))
+"""
+
+
+def entorno():
+    variables = dict(os.environ)
+    variables.setdefault('DB_URL', 'postgresql://perfil@localhost/perfil')
+    return variables
+
+
+def medir_arranque():
+    resultado = subprocess.run([sys.executable, '-c', CODIGO_MEDICION], cwd=DIR_API, env=entorno(),
+                               capture_output=True, text=True, check=True)
+    return json.loads(resultado.stdout.strip().splitlines()[-1])
+
+
+def modulos_mas_lentos(cantidad):
+    """(ms acumulados, módulo) de las importaciones directas de app.py, de la más lenta a la más rápida."""
+    resultado = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=DIR_API,
+                               env=entorno(), capture_output=True, text=True, check=True)
+    directos = []
+    for linea in resultado.stderr.splitlines():
+        if not linea.startswith('import time:') or linea.endswith('| module'):
+            continue
+        _, acumulado, nombre = linea[len('import time:'):].split('|')
+        nombre = nombre[1:]
+        # Las importaciones directas de app.py aparecen con dos espacios de sangría
+        if nombre.startswith('  ') and not nombre.startswith('   '):
+            directos.append((int(acumulado) / 1000, nombre.strip()))
+    return sorted(directos, reverse=True)[:cantidad]
+
+
+def bytecode_al_dia():
+    fuente = os.path.join(DIR_API, 'app.py')
+    compilado = importlib.util.cache_from_source(fuente)
+    return os.path.exists(compilado) and os.path.getmtime(compilado) >= os.path.getmtime(fuente)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perfil del arranque en frío de app.py")
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--presupuesto-ms', type=float, default=PRESUPUESTO_ARRANQUE_MS,
+                        help="Tiempo máximo de importación de app.py (mediana)")
+    parser.add_argument('--modulos', type=int, default=10, help="Cantidad de módulos lentos a listar")
+    args = parser.parse_args()
+
+    corridas = [medir_arranque() for _ in range(args.repeticiones)]
+    importar = statistics.median(c["importar_ms"] for c in corridas)
+    primer_request = statistics.median(c["primer_request_ms"] for c in corridas)
+    segundo_request = statistics.median(c["segundo_request_ms"] for c in corridas)
+
+    print(f"Arranque en frío (mediana de {args.repeticiones} procesos)")
+    print(f"  importar app.py      {importar:8.1f} ms  (presupuesto {args.presupuesto_ms:.0f} ms)")
+    print(f"  primer request /     {primer_request:8.1f} ms")
+    print(f"  segundo request /    {segundo_request:8.1f} ms")
+    print("\nImportaciones directas más lentas")
+    for ms, nombre in modulos_mas_lentos(args.modulos):
+        print(f"  {nombre:<30} {ms:8.1f} ms")
+    print()
+
+    fallas = 0
+    if not bytecode_al_dia():
+        print("⚠️  app.py no tiene bytecode al día: se compila en cada arranque (python -m compileall api)")
+    cargados = sorted({m.split('.')[0] for m in corridas[0]["modulos"]} & set(MODULOS_DIFERIDOS))
+    if cargados:
+        fallas += 1
+        print(f"❌ Módulos diferidos cargados al importar app.py: {', '.join(cargados)}")
+    if importar > args.presupuesto_ms:
+        fallas += 1
+        print(f"❌ La importación tarda {importar:.0f} ms, más que el presupuesto de {args.presupuesto_ms:.0f} ms")
+    if not fallas:
+        print("✅ Arranque dentro del presupuesto")
+    sys.exit(1 if fallas else 0)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+recalcular_lineas_base.py
+Reconstruye la tabla `lineas_base_vitales` desde el historial de `lecturas` con NumPy.
+- Útil tras cargar lecturas históricas (seed_readings.py), cambiar LINEA_BASE_HORAS_* o si la
+  tabla quedó desfasada respecto de las lecturas.
+- Usa los mismos parámetros (variables de entorno) que la aplicación. Recorre los pacientes en
+  lotes de LINEA_BASE_LOTE_PACIENTES (una consulta y un commit por lote).
+- Requiere NumPy (en requirements.txt); la aplicación web lo importa solo al recalcular.
+
+Uso:
+    python api/recalcular_lineas_base.py
+    python api/recalcular_lineas_base.py --paciente 12
+"""
+import argparse
+import time
+
+from app import recalcular_lineas_base, obtener_pacientes_anomalos
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recalcula las líneas base de signos vitales")
+    parser.add_argument("--paciente", type=int, default=None, help="solo este id_paciente")
+    args = parser.parse_args()
+
+    inicio = time.perf_counter()
+    guardadas = recalcular_lineas_base(args.paciente)
+    print(f"✅ {guardadas} líneas base recalculadas en {time.perf_counter() - inicio:.2f}s")
+    print(f"Pacientes con tendencia anómala: {len(obtener_pacientes_anomalos())}")
@@ -4,18 +4,25 @@ from dotenv import load_dotenv
 import os
 import bcrypt
 
+from migrar import aplicar_migraciones
+
 load_dotenv()
 
 
 def init_database():
     conn = psycopg2.connect(os.getenv("DB_URL"), sslmode='require')
+
+    # Esquema versionado (tablas e índices) antes de los datos: ver migrar.py y api/migraciones/
+    aplicar_migraciones(conn)
+
     cur = conn.cursor()
 
-    # Ejecutar script SQL
-    with open('init_db.sql', 'r') as f:
-        sql_script = f.read()
+    # Script SQL inicial (usuarios de prueba), si está disponible; el esquema lo crean las migraciones
+    if os.path.exists('init_db.sql'):
+        with open('init_db.sql', 'r') as f:
+            sql_script = f.read()
 
-    cur.execute(sql_script)
+        cur.execute(sql_script)
 
     # Crear hash para contraseñas de prueba
     password = "123456"
@@ -28,20 +35,6 @@ def init_database():
         WHERE username IN ('admin', 'enfermero1', 'familiar1');
     """, (hashed_pw,))
 
-    conn.commit()
-
-    # Crear tabla para historiales médicos si no existe
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS historial_medico (
-            id_historial SERIAL PRIMARY KEY,
-            id_paciente INTEGER NOT NULL REFERENCES pacientes(id_paciente) ON DELETE CASCADE,
-            titulo TEXT NOT NULL,
-            descripcion TEXT,
-            creado_por TEXT,
-            fecha TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-        );
-    ''')
-
     conn.commit()
     cur.close()
     conn.close()
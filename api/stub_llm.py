@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+stub_llm.py
+Servidor local que imita la API de chat de Groq (compatible con OpenAI) para probar el chatbot sin red.
+- Responde POST /openai/v1/chat/completions con una respuesta fija que repite el último mensaje del usuario.
+- Con "stream": true envía la respuesta palabra por palabra como Server-Sent Events, con una pausa
+  configurable entre tokens para observar el streaming en el dashboard.
+
+Uso:
+    python api/stub_llm.py --port 8089 --delay 0.05
+    GROQ_BASE_URL=http://127.0.0.1:8089 GROQ_API_KEY=stub python api/app.py
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+delay = 0.05
+
+
+def respuesta_para(mensajes):
+    ultimo = next((m.get("content", "") for m in reversed(mensajes) if m.get("role") == "user"), "")
+    return f"Respuesta de prueba del servidor local. Tu pregunta fue: {ultimo}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _json(self, status, cuerpo):
+        datos = json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._json(404, {"error": {"message": "not found"}})
+            return
+
+        largo = int(self.headers.get("Content-Length", 0))
+        peticion = json.loads(self.rfile.read(largo) or b"{}")
+        texto = respuesta_para(peticion.get("messages", []))
+        modelo = peticion.get("model", "stub")
+        creado = int(time.time())
+
+        if not peticion.get("stream"):
+            self._json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": creado,
+                "model": modelo,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        palabras = texto.split(" ")
+        for i, palabra in enumerate(palabras):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": creado,
+                "model": modelo,
+                "choices": [{"index": 0, "delta": {"content": palabra + (" " if i < len(palabras) - 1 else "")},
+                             "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, formato, *args):
+        print(f"[stub_llm] {formato % args}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor LLM de prueba compatible con Groq")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=0.05, help="segundos entre tokens en modo stream")
+    args = parser.parse_args()
+    delay = args.delay
+
+    servidor = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub LLM escuchando en http://{args.host}:{args.port}")
+    servidor.serve_forever()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+verificar_planes.py
+Verifica que las consultas frecuentes de app.py sigan usando índices.
+- Con --cargar llena una base VACÍA con las migraciones y un volumen sintético de pacientes,
+  pulseras, lecturas (en orden de tiempo, como llegan en producción), historial y usuarios.
+- Corre EXPLAIN (FORMAT JSON) sobre cada consulta, tomando el SQL desde app.py, y revisa el plan:
+  tablas que deben leerse por índice, tablas grandes sin Seq Scan, costo máximo como fracción del
+  costo de recorrer `lecturas` completa y filas estimadas máximas.
+- Termina con código 1 si algún plan empeoró. Usar una base de prueba, nunca la de producción.
+
+Uso:
+    python api/verificar_planes.py --db postgresql://.../planes --cargar
+    python api/verificar_planes.py --db postgresql://.../planes     # solo verificar
+(o definir PLANES_DB_URL en lugar de --db)
+"""
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TABLAS_GRANDES = ('lecturas', 'historial_medico', 'usuarios')
+NODOS_INDICE = ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+
+
+# ================================
+#   DATOS SINTÉTICOS
+# ================================
+def cargar_datos(conn, pacientes, lecturas_por_pulsera, dias):
+    from migrar import aplicar_migraciones
+
+    aplicar_migraciones(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pacientes);")
+    if cur.fetchone()[0]:
+        raise RuntimeError("La base ya tiene pacientes: --cargar solo se usa sobre una base vacía")
+    inicio = time.time()
+    cur.execute("""
+        INSERT INTO pacientes (nombre, apellido_paterno, apellido_materno, fecha_nacimiento, genero)
+        SELECT 'Nombre' || i, 'Paterno' || (i %% 500), 'Materno' || (i %% 700),
+               DATE '1930-01-01' + (i %% 25000), CASE WHEN i %% 2 = 0 THEN 'F' ELSE 'M' END
+        FROM generate_series(1, %s) i;
+    """, (pacientes,))
+    # 9 de cada 10 pacientes con pulsera
+    cur.execute("""
+        INSERT INTO pulseras (id_pulsera, id_paciente)
+        SELECT id_paciente, id_paciente FROM pacientes WHERE id_paciente % 10 <> 0;
+    """)
+    # Todas las pulseras reportan a intervalos regulares durante `dias`; se insertan por momento
+    cur.execute("""
+        INSERT INTO lecturas (id_pulsera, ritmo_cardiaco, temperatura_c, esta_puesta, momento_lectura)
+        SELECT pu.id_pulsera,
+               60 + (pu.id_pulsera * 7 + i * 13) %% 70,
+               (35.5 + ((pu.id_pulsera + i * 3) %% 40) / 10.0)::numeric(4,1),
+               (pu.id_pulsera + i) %% 20 <> 0,
+               NOW() - make_interval(days => %(dias)s) + (i * make_interval(days => %(dias)s) / %(n)s)
+        FROM generate_series(1, %(n)s) i
+        CROSS JOIN pulseras pu
+        ORDER BY i, pu.id_pulsera;
+    """, {'dias': dias, 'n': lecturas_por_pulsera})
+    # Última lectura de cada pulsera, como la deja registrar_lectura
+    cur.execute("""
+        INSERT INTO pulsera_estado (id_pulsera, ultima_lectura, esta_puesta)
+        SELECT DISTINCT ON (id_pulsera) id_pulsera, momento_lectura, esta_puesta
+        FROM lecturas
+        ORDER BY id_pulsera, momento_lectura DESC;
+    """)
+    cur.execute("""
+        INSERT INTO historial_medico (id_paciente, titulo, descripcion, creado_por, fecha)
+        SELECT p.id_paciente, 'Nota ' || i, 'Observación de control', 'medico1',
+               NOW() - make_interval(days => i * 7)
+        FROM pacientes p CROSS JOIN generate_series(1, 5) i;
+    """)
+    cur.execute("""
+        INSERT INTO usuarios (username, password_hash, nombre_completo, tipo_usuario, id_paciente_asignado)
+        SELECT 'familiar' || id_paciente, 'x', 'Familiar ' || id_paciente, 'familiar', id_paciente
+        FROM pacientes;
+    """)
+    conn.commit()
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE;")
+    conn.autocommit = False
+    cur.execute("SELECT COUNT(*) FROM lecturas;")
+    print(f"✅ {pacientes} pacientes y {cur.fetchone()[0]} lecturas cargadas en {time.time() - inicio:.0f}s")
+    cur.close()
+
+
+# ================================
+#   CONSULTAS A VERIFICAR
+# ================================
+def consultas_frecuentes(cur):
+    """(nombre, sql, params, reglas) de las consultas frecuentes, armadas con el código de app.py."""
+    import app
+
+    cur.execute("SELECT id_pulsera, id_paciente FROM pulseras ORDER BY id_pulsera LIMIT 1;")
+    id_pulsera, id_paciente = cur.fetchone()
+    cur.execute("SELECT username FROM usuarios ORDER BY username LIMIT 1;")
+    username = cur.fetchone()[0]
+    pagina = app.TAMANO_PAGINA_DEFECTO
+
+    def lista(condiciones=(), params=None, orden='id'):
+        return app.preparar_consulta_pacientes(list(condiciones), params or {}, orden, None, pagina)
+
+    # Reglas: indice = tablas que deben leerse por índice; costo = fracción del recorrido completo
+    # de lecturas; filas = filas estimadas del resultado. Seq Scan en TABLAS_GRANDES siempre falla.
+    # Las consultas que calculan el estado de todos los pacientes hacen una búsqueda por índice por
+    # pulsera (~la mitad del recorrido completo con los datos de --cargar); al perder el índice pasan
+    # a un Seq Scan más ordenamiento y superan el límite.
+    consultas = [
+        ("pacientes por id", *lista(), dict(indice=['lecturas'], costo=0.05, filas=pagina + 1)),
+        ("pacientes por lectura", *lista(orden='lectura'), dict(indice=['lecturas'], costo=0.75, filas=pagina + 1)),
+        ("pacientes por estado", *lista(orden='estado'), dict(indice=['lecturas'], costo=0.75, filas=pagina + 1)),
+        ("pacientes en rojo", *lista([app.sql_filtro_estado('rojo')]),
+         dict(indice=['lecturas'], costo=0.75, filas=pagina + 1)),
+        ("búsqueda ILIKE", *lista([app.SQL_FILTRO_NOMBRE_ILIKE], {'termino': '%paterno12%'}),
+         dict(indice=['lecturas'], costo=0.25, filas=pagina + 1)),
+        ("versión de datos", app.SQL_VERSION_DATOS, (), dict(indice=['lecturas'], costo=0.01, filas=1)),
+        ("versión de pulsera", app.SQL_VERSION_PULSERA, (id_pulsera,),
+         dict(indice=['lecturas'], costo=0.001, filas=1)),
+        ("lecturas de pulsera", app.SQL_LECTURAS_PULSERA, (id_pulsera, 50),
+         dict(indice=['lecturas'], costo=0.02, filas=50)),
+        ("estadísticas 24h", *app.consulta_estadisticas_24h(), dict(indice=['lecturas'], costo=0.75, filas=1)),
+        ("estadísticas 24h pulsera", *app.consulta_estadisticas_24h(id_pulsera),
+         dict(indice=['lecturas'], costo=0.01, filas=1)),
+        ("tendencia 7 días", app.SQL_TENDENCIA_7_DIAS.format(filtro=""), (),
+         dict(indice=['lecturas'], costo=0.75, filas=1000)),
+        ("tendencia 7 días pulsera", app.SQL_TENDENCIA_7_DIAS.format(filtro="AND id_pulsera = %s"), (id_pulsera,),
+         dict(indice=['lecturas'], costo=0.01, filas=1000)),
+        ("historial de paciente", app.SQL_HISTORIAL_PACIENTE, (id_paciente,),
+         dict(indice=['historial_medico'], costo=0.002, filas=100)),
+        ("login", "SELECT password_hash, COALESCE(tipo_usuario, '') FROM usuarios WHERE username = %s;", (username,),
+         dict(indice=['usuarios'], costo=0.001, filas=1)),
+        ("estado de pulseras", app.SQL_ESTADO_PULSERAS, {"plazo": app.detector_pulseras.plazo},
+         dict(indice=[], costo=0.01, filas=None)),
+        ("revisión de pulseras", app.SQL_MARCAR_SIN_DATOS, (app.detector_pulseras.plazo,),
+         dict(indice=['pulsera_estado'], costo=0.01, filas=None)),
+    ]
+    return consultas
+
+
+# ================================
+#   REVISIÓN DE PLANES
+# ================================
+def nodos(plan):
+    yield plan
+    for hijo in plan.get('Plans', []):
+        yield from nodos(hijo)
+
+
+def es_tabla(relacion, tabla):
+    """`relacion` es `tabla` o una de sus particiones (lecturas_2025_01, lecturas_default...)."""
+    return relacion == tabla or relacion.startswith(tabla + '_')
+
+
+def explicar(cur, sql, params):
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql.strip(), params or None)
+    return cur.fetchone()[0][0]['Plan']
+
+
+def revisar_plan(plan, reglas, costo_referencia):
+    """Lista de problemas del plan según las reglas (vacía si está bien)."""
+    problemas = []
+    todos = list(nodos(plan))
+    for tabla in reglas['indice']:
+        if not any(n['Node Type'] in NODOS_INDICE and es_tabla(n.get('Relation Name', ''), tabla) for n in todos):
+            problemas.append(f"{tabla} sin índice")
+    for n in todos:
+        relacion = n.get('Relation Name', '')
+        if n['Node Type'] == 'Seq Scan' and any(es_tabla(relacion, t) for t in TABLAS_GRANDES):
+            problemas.append(f"Seq Scan en {relacion}")
+    limite_costo = reglas['costo'] * costo_referencia
+    if plan['Total Cost'] > limite_costo:
+        problemas.append(f"costo {plan['Total Cost']:.0f} > {limite_costo:.0f}")
+    if reglas['filas'] is not None and plan['Plan Rows'] > reglas['filas']:
+        problemas.append(f"filas {plan['Plan Rows']} > {reglas['filas']}")
+    return sorted(set(problemas), key=problemas.index)
+
+
+def verificar(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM lecturas;")
+    total = cur.fetchone()[0]
+    if total < 100_000:
+        print(f"⚠️  Solo hay {total} lecturas: con pocos datos los planes no son representativos (usar --cargar)")
+    costo_referencia = explicar(cur, "SELECT * FROM lecturas", None)['Total Cost']
+    print(f"Recorrido completo de lecturas ({total} filas): costo {costo_referencia:.0f}\n")
+
+    fallas = 0
+    print(f"{'consulta':<26} {'costo':>10} {'filas':>8}  resultado")
+    print("-" * 78)
+    for nombre, sql, params, reglas in consultas_frecuentes(cur):
+        try:
+            plan = explicar(cur, sql, params)
+        except Exception as e:
+            conn.rollback()
+            fallas += 1
+            print(f"{nombre:<26} {'-':>10} {'-':>8}  ❌ Error: {e}")
+            continue
+        problemas = revisar_plan(plan, reglas, costo_referencia)
+        fallas += bool(problemas)
+        resultado = "❌ " + "; ".join(problemas) if problemas else "✅"
+        print(f"{nombre:<26} {plan['Total Cost']:>10.0f} {plan['Plan Rows']:>8}  {resultado}")
+    cur.close()
+    print()
+    print(f"❌ {fallas} planes con regresiones" if fallas else "✅ Todos los planes usan los índices esperados")
+    return fallas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica los planes de las consultas frecuentes de app.py")
+    parser.add_argument('--db', default=os.getenv('PLANES_DB_URL'), help="URL de la base de prueba")
+    parser.add_argument('--cargar', action='store_true', help="Cargar datos sintéticos (solo en base vacía)")
+    parser.add_argument('--pacientes', type=int, default=2000)
+    parser.add_argument('--lecturas-por-pulsera', type=int, default=500)
+    parser.add_argument('--dias', type=int, default=90, help="Periodo que cubren las lecturas sintéticas")
+    args = parser.parse_args()
+    if not args.db:
+        raise RuntimeError('Indicar la base de prueba con --db o PLANES_DB_URL')
+
+    # app.py lee DB_URL al importarse (umbrales vigentes para las consultas de estado)
+    os.environ['DB_URL'] = args.db
+    conn = psycopg2.connect(args.db)
+    try:
+        if args.cargar:
+            cargar_datos(conn, args.pacientes, args.lecturas_por_pulsera, args.dias)
+        sys.exit(1 if verificar(conn) else 0)
+    finally:
+        conn.close()